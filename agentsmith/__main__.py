@@ -23,7 +23,8 @@ import click
 Monitor Neo4j servers and clusters.
 
 The ADDRESS should be supplied in either host:port format or as a simple host name or IP address.
-If the port is omitted, 7687 is assumed.
+If the port is omitted, 7687 is assumed. Several addresses may be given in headless mode; otherwise,
+further servers can be added from the overview.
 """)
 @click.option("-u", "--user",
               metavar="USER",
@@ -32,20 +33,174 @@ If the port is omitted, 7687 is assumed.
 @click.option("-p", "--password",
               metavar="PASSWORD",
               envvar="NEO4J_PASSWORD",
-              prompt="Neo4j password",
-              help="Neo4j password (can also be supplied in NEO4J_PASSWORD environment variable)",
-              confirmation_prompt=False,
-              hide_input=True)
+              help="Neo4j password (can also be supplied in NEO4J_PASSWORD environment variable); "
+                   "prompted for if not supplied")
+@click.option("--engine",
+              type=click.Choice(["thread", "asyncio", "aligned"]),
+              default="thread",
+              help="Collection engine: one thread per server (default), a single asyncio event loop, "
+                   "or parallel polls of all servers on a shared, time-aligned tick")
+@click.option("--max-concurrency",
+              metavar="N",
+              type=int,
+              default=8,
+              help="Maximum number of servers polled at once by the asyncio or aligned engine")
+@click.option("--period",
+              metavar="SECONDS",
+              type=float,
+              default=1.0,
+              help="Tick period for the aligned engine")
+@click.option("--sparklines",
+              is_flag=True,
+              default=False,
+              help="Show a row of CPU, heap, commit and page fault sparklines for each server")
+@click.option("--server-side",
+              is_flag=True,
+              default=False,
+              help="Sort and limit the transaction list on the server, fetching only the rows on screen")
+@click.option("--record",
+              metavar="FILE",
+              type=click.Path(dir_okay=False, writable=True),
+              help="Append every snapshot to a recording file")
+@click.option("--replay",
+              metavar="FILE",
+              type=click.Path(exists=True, dir_okay=False),
+              help="Play back a recording file instead of monitoring live servers")
+@click.option("--start",
+              metavar="OFFSET",
+              default="0",
+              help="Offset into the recording at which to start playback, as seconds, MM:SS or HH:MM:SS")
+@click.option("--headless",
+              is_flag=True,
+              default=False,
+              help="Write one JSON object per server per snapshot (JSON Lines) instead of running the UI")
+@click.option("-o", "--output",
+              metavar="FILE",
+              type=click.File("w"),
+              default="-",
+              help="File to which headless output is written (default: stdout)")
+@click.option("--sections",
+              metavar="LIST",
+              default="system,memory,storage,page_cache,transactions,accounts,rates",
+              help="Comma-separated sections to include in headless output, from: "
+                   "system, memory, storage, page_cache, transactions, accounts, locks, queries, rates, cluster")
+@click.option("--exporter",
+              metavar="[HOST:]PORT",
+              help="Serve metrics in Prometheus text format on the given port instead of running the UI; "
+                   "only 127.0.0.1 is listened on unless a HOST (such as 0.0.0.0) is given")
+@click.option("--max-label-values",
+              metavar="N",
+              type=int,
+              default=50,
+              help="Maximum number of distinct user or client label values per server in exported metrics")
+@click.option("--policy",
+              metavar="FILE",
+              type=click.Path(exists=True, dir_okay=False),
+              help="Kill transactions automatically according to the rules in a JSON policy file")
+@click.option("--dry-run",
+              is_flag=True,
+              default=False,
+              help="Log the transactions that the policy would kill, without killing them")
+@click.option("--max-kills-per-second",
+              metavar="N",
+              type=float,
+              default=20.0,
+              help="Maximum rate at which the policy kills transactions, across all servers")
+@click.option("--audit-log",
+              metavar="FILE",
+              type=click.File("a", lazy=True),
+              default="agentsmith-audit.log",
+              help="File to which every policy action is appended (default: agentsmith-audit.log)")
 @click.argument("address",
-                envvar="NEO4J_ADDRESS",
-                default="localhost:7687")
-def main(address=None, user=None, password=None):
+                nargs=-1,
+                envvar="NEO4J_ADDRESS")
+def main(address=None, user=None, password=None, engine=None, max_concurrency=None, period=None,
+         sparklines=False, record=None, replay=None, start=None, headless=False, output=None, sections=None,
+         exporter=None, max_label_values=None, server_side=False, policy=None, dry_run=False,
+         max_kills_per_second=None, audit_log=None):
     from agentsmith.application import AgentSmith
-    raise SystemExit(AgentSmith(
-        address=address,
-        user=user,
-        password=password,
-    ).run())
+    from agentsmith.monitor import ServerMonitor
+    if replay:
+        from agentsmith.controls.data import DataControl
+        from agentsmith.recording import RecordingError
+        from agentsmith.replay import Player, parse_offset
+        try:
+            offset = parse_offset(start)
+        except ValueError:
+            raise click.BadParameter("Invalid offset %r" % start, param_hint="--start")
+        try:
+            player = Player(replay, start=offset)
+        except RecordingError as error:
+            raise click.ClickException(str(error))
+        try:
+            DataControl.monitor_factory = player.monitor
+            raise SystemExit(AgentSmith(
+                address=next(iter(address or player.addresses), None),
+                user=user,
+                sparklines=sparklines,
+                player=player,
+            ).run())
+        finally:
+            player.close()
+    if headless:
+        from agentsmith.headless import SECTIONS
+        sections = [section.strip() for section in sections.split(",") if section.strip()]
+        for section in sections:
+            if section not in SECTIONS:
+                raise click.BadParameter("Unknown section %r" % section, param_hint="--sections")
+    if exporter:
+        exporter_host, _, exporter_port = exporter.rpartition(":")
+        # Metrics reveal users and client hosts, so listen more widely only
+        # when asked to explicitly
+        exporter_host = exporter_host or "127.0.0.1"
+        try:
+            exporter_port = int(exporter_port)
+        except ValueError:
+            raise click.BadParameter("Invalid port %r" % exporter_port, param_hint="--exporter")
+    if policy:
+        from agentsmith.policy import AuditLog, KillPolicy, PolicyError
+        try:
+            ServerMonitor.policy = KillPolicy.load(policy, dry_run=dry_run,
+                                                   max_kills_per_second=max_kills_per_second,
+                                                   audit=AuditLog(audit_log))
+        except PolicyError as error:
+            raise click.BadParameter(str(error), param_hint="--policy")
+    if password is None:
+        # Keep stdout clean for headless output
+        password = click.prompt("Neo4j password", hide_input=True, err=headless)
+    if engine == "asyncio":
+        from agentsmith.engine import CollectionEngine
+        ServerMonitor.engine = CollectionEngine(max_concurrency=max_concurrency)
+    elif engine == "aligned":
+        from agentsmith.coordinator import SnapshotCoordinator
+        ServerMonitor.engine = SnapshotCoordinator(period=period, max_concurrency=max_concurrency)
+    if record:
+        from agentsmith.recording import Recorder
+        ServerMonitor.recorder = Recorder(record)
+    try:
+        if headless:
+            from agentsmith.headless import run
+            run(address or ["localhost:7687"], (user or "neo4j", password), output, sections)
+            return
+        if exporter:
+            from agentsmith.exporter import serve
+            serve(address or ["localhost:7687"], (user or "neo4j", password), exporter_host, exporter_port,
+                  max_label_values)
+            return
+        raise SystemExit(AgentSmith(
+            address=next(iter(address), None),
+            user=user,
+            password=password,
+            sparklines=sparklines,
+            server_side=server_side,
+        ).run())
+    finally:
+        if ServerMonitor.engine is not None:
+            ServerMonitor.engine.close()
+        if ServerMonitor.recorder is not None:
+            ServerMonitor.recorder.close()
+        if ServerMonitor.policy is not None:
+            audit_log.close()
 
 
 if __name__ == '__main__':
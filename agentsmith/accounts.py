@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Resource accounting by user, client host and protocol, so that the cost
+of each tenant of a server can be ranked.
+"""
+
+from __future__ import division
+
+from agentsmith.tracking import ListData, RowTracker
+from agentsmith.units import Amount, BytesAmount, Load, Time
+
+
+def client_host(client_address):
+    """ Return the host part of a client address such as
+    "127.0.0.1:46718", or an empty string if there is none.
+    """
+    return (client_address or u"").rpartition(u":")[0]
+
+
+class AccountData(object):
+    """ Resources used by the transactions of a single user, from a single
+    client host, over a single protocol.
+
+    Running transactions and active locks are as of the latest poll. All
+    other figures are totals for every transaction seen since monitoring
+    began. Times are held in milliseconds and everything else as plain
+    numbers, and are wrapped in units on access.
+    """
+
+    __slots__ = ["user", "client", "protocol", "_values"]
+
+    def __init__(self, user, client, protocol, values):
+        self.user = user
+        self.client = client
+        self.protocol = protocol
+        self._values = values
+
+    def __repr__(self):
+        return "<AccountData user=%r client=%r protocol=%r cpu_time=%r>" % (
+            self.user, self.client, self.protocol, self.cpu_time)
+
+    @property
+    def running_count(self):
+        return Amount(self._values[0])
+
+    @property
+    def active_lock_count(self):
+        return Amount(self._values[1])
+
+    @property
+    def transaction_count(self):
+        """ Number of transactions seen.
+        """
+        return Amount(self._values[2])
+
+    @property
+    def cpu_time(self):
+        return Time(ms=self._values[3])
+
+    @property
+    def wait_time(self):
+        return Time(ms=self._values[4])
+
+    @property
+    def allocated_bytes(self):
+        return BytesAmount(self._values[5])
+
+    @property
+    def page_faults(self):
+        return Amount(self._values[6])
+
+    @property
+    def lock_share(self):
+        """ Proportion of all active locks held.
+        """
+        return Load(self._values[7])
+
+    @property
+    def cpu_share(self):
+        """ Proportion of all CPU time used.
+        """
+        return Load(self._values[8])
+
+    @property
+    def allocation_share(self):
+        """ Proportion of all bytes allocated.
+        """
+        return Load(self._values[9])
+
+    def raw(self, name):
+        """ Return the raw, undecoded value behind an attribute, which is
+        cheap to compare between snapshots.
+        """
+        try:
+            return self._values[_VALUES.index(name)]
+        except ValueError:
+            return getattr(self, name)
+
+
+_VALUES = (u"running_count", u"active_lock_count", u"transaction_count", u"cpu_time", u"wait_time",
+           u"allocated_bytes", u"page_faults", u"lock_share", u"cpu_share", u"allocation_share")
+
+
+class AccountListData(ListData):
+    """ Accounts of every user, client host and protocol seen, most costly
+    (by total CPU time) first.
+    """
+
+    def __init__(self, accounts):
+        super(AccountListData, self).__init__(
+            sorted(accounts, key=lambda account: account.raw(u"cpu_time"), reverse=True))
+
+
+class AccountTracker(RowTracker):
+    """ Accumulates :class:`.AccountData` for a single server from the
+    transaction list in each snapshot.
+
+    Transactions are followed by ID from one poll to the next (see
+    :class:`agentsmith.tracking.RowTracker`), so that each adds only the
+    CPU time, wait time, allocation and page faults accrued since it was
+    last seen. Only the transactions fetched are accounted for, so when
+    the list is limited on the server (see
+    :class:`agentsmith.monitor.TransactionView`), short transactions from
+    busy tenants may be missed.
+
+    At most `capacity` accounts are kept.
+    """
+
+    source = u"transactions"
+
+    def _sample(self, tx):
+        return tx.raw(u"id"), (tx.raw(u"user"), client_host(tx.raw(u"client_address")), tx.raw(u"protocol")), (
+            tx.raw(u"cpu_time") or 0, tx.raw(u"wait_time") or 0,
+            tx.raw(u"allocated_bytes") or 0, tx.raw(u"page_faults") or 0)
+
+    def _new_values(self, tx):
+        return [0, 0, 0, 0, 0]
+
+    def _accrue(self, values, tx, growth, new):
+        if new:
+            values[0] += 1
+        for i in range(4):
+            values[i + 1] += growth[i]
+
+    def _build(self, transactions, keys):
+        accounts = self._values
+        current = {}
+        for tx, key in zip(transactions, keys):
+            counts = current.setdefault(key, [0, 0])
+            counts[0] += 1
+            counts[1] += tx.raw(u"active_lock_count") or 0
+        total_locks = sum(locks for _, locks in current.values())
+        total_cpu = sum(values[1] for values in accounts.values())
+        total_allocated = sum(values[3] for values in accounts.values())
+        items = []
+        for key, values in accounts.items():
+            count, locks = current.get(key, (0, 0))
+            items.append(AccountData(key[0], key[1], key[2], (
+                count, locks, values[0], values[1], values[2], values[3], values[4],
+                locks / total_locks if total_locks else 0.0,
+                values[1] / total_cpu if total_cpu else 0.0,
+                values[3] / total_allocated if total_allocated else 0.0,
+            )))
+        return AccountListData(items)
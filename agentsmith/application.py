@@ -21,25 +21,43 @@
 from __future__ import unicode_literals
 
 from os import getenv
+from time import localtime, strftime
 
 from neo4j.exceptions import ServiceUnavailable
 from neo4j.v1 import SessionExpired
 from prompt_toolkit.application import Application
 from prompt_toolkit.application.current import get_app
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.filters import Condition
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.layout import FormattedTextControl
+from prompt_toolkit.layout.controls import BufferControl
 from prompt_toolkit.layout.containers import Window, VSplit, HSplit, WindowAlign
 from prompt_toolkit.layout.layout import Layout
+from prompt_toolkit.layout.processors import BeforeInput
 from prompt_toolkit.styles import Style
 
 from agentsmith.controls.overview import OverviewControl, StyleList
-from agentsmith.controls.server import ServerControl
+from agentsmith.controls.server import DEFAULT_SORT, SORT_FIELDS, ServerControl
+from agentsmith.filters import FilterError, TransactionFilter
 from agentsmith.meta import __version__
+from agentsmith.replay import SPEEDS, format_offset
 
 
 NEO4J_ADDRESS = getenv("NEO4J_ADDRESS", "localhost:7687")
 NEO4J_AUTH = tuple(getenv("NEO4J_AUTH", "neo4j:password").partition(":")[::2])
 
+# Keys to sort the transaction list by each field
+SORT_KEYS = [
+    ("t", "elapsed_time"),
+    ("c", "cpu_time"),
+    ("w", "wait_time"),
+    ("l", "active_lock_count"),
+    ("m", "allocated_bytes"),
+    ("f", "page_faults"),
+    ("u", "user"),
+]
+
 
 BASE03 = "#002b36"  # background
 BASE02 = "#073642"  # background highlights
@@ -68,6 +86,8 @@ class AgentSmith(Application):
     style = Style.from_dict({
         "page-header": "fg:{} bg:{}".format(BASE1, BASE02),
         "page-footer": "fg:{} bg:{}".format(BASE1, BASE02),
+        "filter-bar": "fg:{} bg:{}".format(BASE1, BASE03),
+        "filter-error": "fg:{} bg:{}".format(RED, BASE03),
         "overview": "fg:{} bg:{}".format(BASE0, BASE02),
         "server": "fg:{} bg:{}".format(BASE0, BASE03),
         "server-header-focus": "fg:{} bg:{}".format(BASE00, BASE3),
@@ -89,7 +109,25 @@ class AgentSmith(Application):
         # TODO
     })
 
-    def __init__(self, address=None, user=None, password=None):
+    def __init__(self, address=None, user=None, password=None, sparklines=False, player=None, server_side=False):
+        self.sparklines = sparklines
+        self.server_side = server_side
+        self.view = "transactions"
+        self.sort = DEFAULT_SORT
+        self.filter = None
+        self.filter_editing = False
+        self.filter_message = ""
+        self.filter_buffer = Buffer(multiline=False, accept_handler=self.accept_filter)
+        self.filter_input = Window(BufferControl(buffer=self.filter_buffer, input_processors=[BeforeInput("Filter: ")]),
+                                   height=1, dont_extend_height=True, style="class:filter-bar")
+        self.filter_bar = VSplit([
+            self.filter_input,
+            Window(FormattedTextControl(text=lambda: self.filter_message), height=1, dont_extend_width=True,
+                   style="class:filter-error"),
+        ])
+        self.filter_status = Window(FormattedTextControl(text=lambda: "Filter: {}".format(self.filter.text)),
+                                    height=1, dont_extend_height=True, style="class:filter-bar")
+        self.player = player
         host, _, port = (address or "localhost:7687").partition(":")
         self.address = "%s:%s" % (host or "localhost", port or 7687)
         self.user = user or "neo4j"
@@ -99,14 +137,32 @@ class AgentSmith(Application):
         primary_server = ServerControl(self, self.address, self.auth)
         primary_server.attach()
         self.server_windows = [Window(content=primary_server, style="class:server")]
-        self.header = Window(content=FormattedTextControl(text="AGENT SMITH v{}".format(__version__)),
+        self.header = Window(content=FormattedTextControl(text=self.header_text),
                              always_hide_cursor=True,
                              height=1, dont_extend_height=True, style="class:page-header")
-        self.footer = Window(content=FormattedTextControl(text="[Ctrl+O] Overview  "
-                                                               "[PgUp]/[PgDn] Server  "
-                                                               "[Up]/[Down] Transaction  "
-                                                               "[Ctrl+K] Kill  "
-                                                               "[Ctrl+C] Exit"), always_hide_cursor=True,
+        if self.player:
+            footer_text = ("[Ctrl+O] Overview  "
+                           "[PgUp]/[PgDn] Server  "
+                           "[Up]/[Down] Select  "
+                           "[F2]-[F5] Transactions/Statements/Accounts/Locks  "
+                           "[t]/[c]/[w]/[l]/[m]/[f]/[u] Sort  "
+                           "[Space] Pause  "
+                           "[1]/[2]/[3] Speed  "
+                           "[Left]/[Right] Seek  "
+                           "[/] Filter  "
+                           "[Ctrl+G] Graphs  "
+                           "[Ctrl+C] Exit")
+        else:
+            footer_text = ("[Ctrl+O] Overview  "
+                           "[PgUp]/[PgDn] Server  "
+                           "[Up]/[Down] Select  "
+                           "[F2]-[F5] Transactions/Statements/Accounts/Locks  "
+                           "[t]/[c]/[w]/[l]/[m]/[f]/[u] Sort  "
+                           "[Ctrl+K] Kill  "
+                           "[/] Filter  "
+                           "[Ctrl+G] Graphs  "
+                           "[Ctrl+C] Exit")
+        self.footer = Window(content=FormattedTextControl(text=footer_text), always_hide_cursor=True,
                              height=1, dont_extend_height=True, style="class:page-footer")
         self.focus_index = 0
         super(AgentSmith, self).__init__(
@@ -117,6 +173,18 @@ class AgentSmith(Application):
         )
         self.update_layout()
 
+    def header_text(self):
+        text = "AGENT SMITH v{}".format(__version__)
+        if self.player:
+            player = self.player
+            position = player.position
+            text += "  REPLAY {} ({} / {})  x{:g}{}".format(
+                strftime("%Y-%m-%d %H:%M:%S", localtime(position)),
+                format_offset(position - player.start_time),
+                format_offset(player.end_time - player.start_time),
+                player.speed, "  PAUSED" if player.paused else "")
+        return text
+
     @property
     def focused_address(self):
         if self.overview:
@@ -138,6 +206,7 @@ class AgentSmith(Application):
                                    dont_extend_height=True),
                         ]),
                     ]),
+                ] + self.filter_windows() + [
                     self.footer,
                 ]),
             )
@@ -148,9 +217,47 @@ class AgentSmith(Application):
                     VSplit([
                         HSplit(self.server_windows),
                     ]),
+                ] + self.filter_windows() + [
                     self.footer,
                 ]),
             )
+        if self.filter_editing:
+            self.layout.focus(self.filter_input)
+
+    def filter_windows(self):
+        if self.filter_editing:
+            return [self.filter_bar]
+        elif self.filter:
+            return [self.filter_status]
+        else:
+            return []
+
+    def edit_filter(self, _):
+        self.filter_editing = True
+        self.filter_message = ""
+        self.update_layout()
+
+    def cancel_filter(self, _):
+        self.filter_editing = False
+        self.filter_buffer.text = self.filter.text if self.filter else ""
+        self.update_layout()
+
+    def accept_filter(self, buffer):
+        """ Apply the expression in the filter bar to every server, or
+        clear the filter if it is empty.
+        """
+        try:
+            transaction_filter = TransactionFilter(buffer.text)
+        except FilterError as error:
+            self.filter_message = " {} ".format(error)
+            return True
+        self.filter = transaction_filter or None
+        for window in self.server_windows:
+            window.content.set_filter(self.filter)
+        self.filter_editing = False
+        self.filter_message = ""
+        self.update_layout()
+        return True
 
     def on_selection_change(self):
         windows = []
@@ -190,22 +297,61 @@ class AgentSmith(Application):
         bindings = KeyBindings()
         bindings.add('c-c')(self.do_exit)
 
-        bindings.add('c-o')(self.toggle_overview)
+        # Keys typed into the filter bar are not commands
+        editing = Condition(lambda: self.filter_editing)
+        not_editing = ~editing
+        bindings.add('/', filter=not_editing)(self.edit_filter)
+        bindings.add('escape', filter=editing)(self.cancel_filter)
+
+        bindings.add('c-o', filter=not_editing)(self.toggle_overview)
+
+        bindings.add('insert', filter=not_editing)(self.action(self.insert))
+        bindings.add('+', filter=not_editing)(self.action(self.insert))
+        bindings.add('delete', filter=not_editing)(self.action(self.delete))
+        bindings.add('-', filter=not_editing)(self.action(self.delete))
+        bindings.add('home', filter=not_editing)(self.action(self.home))
+        bindings.add('end', filter=not_editing)(self.action(self.end))
+        bindings.add('pageup', filter=not_editing)(self.action(self.page_up))
+        bindings.add('pagedown', filter=not_editing)(self.action(self.page_down))
+        bindings.add('up', filter=not_editing)(self.action(self.up))
+        bindings.add('down', filter=not_editing)(self.action(self.down))
+
+        bindings.add('c-k', filter=not_editing)(self.action(self.kill))
+        bindings.add('c-g', filter=not_editing)(self.toggle_sparklines)
+        bindings.add('f2', filter=not_editing)(self.show_view("transactions"))
+        bindings.add('f3', filter=not_editing)(self.show_view("statements"))
+        bindings.add('f4', filter=not_editing)(self.show_view("accounts"))
+        bindings.add('f5', filter=not_editing)(self.show_view("locks"))
+        for key, field in SORT_KEYS:
+            bindings.add(key, filter=not_editing)(self.sort_by(field))
+
+        if self.player:
+            bindings.add(' ', filter=not_editing)(self.toggle_pause)
+            for key, speed in zip("123", SPEEDS):
+                bindings.add(key, filter=not_editing)(self.set_speed(speed))
+            bindings.add('left', filter=not_editing)(self.skip(-10))
+            bindings.add('right', filter=not_editing)(self.skip(10))
+            bindings.add('c-left', filter=not_editing)(self.skip(-60))
+            bindings.add('c-right', filter=not_editing)(self.skip(60))
+
+        return bindings
 
-        bindings.add('insert')(self.action(self.insert))
-        bindings.add('+')(self.action(self.insert))
-        bindings.add('delete')(self.action(self.delete))
-        bindings.add('-')(self.action(self.delete))
-        bindings.add('home')(self.action(self.home))
-        bindings.add('end')(self.action(self.end))
-        bindings.add('pageup')(self.action(self.page_up))
-        bindings.add('pagedown')(self.action(self.page_down))
-        bindings.add('up')(self.action(self.up))
-        bindings.add('down')(self.action(self.down))
+    def toggle_pause(self, _):
+        self.player.toggle()
 
-        bindings.add('c-k')(self.action(self.kill))
+    def set_speed(self, speed):
 
-        return bindings
+        def f(_):
+            self.player.set_speed(speed)
+
+        return f
+
+    def skip(self, seconds):
+
+        def f(_):
+            self.player.skip(seconds)
+
+        return f
 
     def home(self, event):
         if self.overview:
@@ -266,6 +412,36 @@ class AgentSmith(Application):
         if window:
             window.content.kill(event)
 
+    def toggle_sparklines(self, _):
+        self.sparklines = not self.sparklines
+        for window in self.server_windows:
+            if window.content.show_sparklines != self.sparklines:
+                window.content.toggle_sparklines()
+
+    def show_view(self, view):
+
+        def f(_):
+            self.view = view
+            for window in self.server_windows:
+                window.content.show_view(view)
+
+        return f
+
+    def sort_by(self, field):
+
+        def f(_):
+            current, descending = self.sort
+            if field == current:
+                # Pressed again, so reverse the order
+                descending = not descending
+            else:
+                descending = SORT_FIELDS[field][1]
+            self.sort = (field, descending)
+            for window in self.server_windows:
+                window.content.set_sort(field, descending)
+
+        return f
+
     def action(self, handler, *args, **kwargs):
 
         def f(event):
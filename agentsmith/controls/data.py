@@ -24,9 +24,14 @@ from agentsmith.monitor import ServerMonitor
 
 class DataControl(UIControl):
 
+    #: Callable used to obtain the monitor for an address. This has the
+    #: same signature as :class:`agentsmith.monitor.ServerMonitor`, and can
+    #: be replaced, e.g. to display a recording instead of live data.
+    monitor_factory = ServerMonitor
+
     def __init__(self, address, auth, prefer_routing=False, key_bindings=None):
         self.address = address
-        self.monitor = ServerMonitor(address, auth, prefer_routing=prefer_routing, on_error=self.on_error)
+        self.monitor = self.monitor_factory(address, auth, prefer_routing=prefer_routing, on_error=self.on_error)
         self.key_bindings = key_bindings
         self.invalidate = Event(self)
 
@@ -18,38 +18,155 @@
 
 from __future__ import unicode_literals
 
+from collections import Counter
+from time import monotonic
+
 from prompt_toolkit.layout import UIContent
 
 from agentsmith.controls.data import DataControl
+from agentsmith.controls.sparkline import Sparkline
+from agentsmith.controls.table import Column, VirtualTable
+from agentsmith.monitor import TransactionView
+from agentsmith.units import Load, BytesAmount
+
+
+def stat_cell(stat):
+    s = str(stat)
+    if s == "0" or s == "~":
+        return "class:data-secondary", s
+    else:
+        return "class:data-primary", s
+
+
+def client_cell(tx):
+    if tx.protocol or tx.client_address:
+        return "class:data-primary", "{}/{}".format(tx.client_address, tx.protocol[0].upper())
+    else:
+        return "class:data-primary", ""
+
+
+def query_cell(tx):
+    if tx.status == "running":
+        payload_style = "class:data-status-running"
+    elif tx.status == "planning":
+        payload_style = "class:data-status-planning"
+    else:
+        payload_style = ""
+    return payload_style, tx.current_query.replace("\r\n", " ").replace("\r", " ").replace("\n", " ")
+
+
+def lock_wait_id_cell(lw):
+    # Transactions are indented under those they wait on
+    return ("class:data-primary" if lw.depth == 0 else "class:data-secondary"), "{}{}".format("  " * lw.depth, lw.id)
+
+
+def lock_wait_query_cell(lw):
+    return "", lw.current_query.replace("\r\n", " ").replace("\r", " ").replace("\n", " ")
+
+
+def raw(name):
+    return lambda tx: tx.raw(name)
+
 
+def raw_pair(name_1, name_2):
+    return lambda tx: (tx.raw(name_1), tx.raw(name_2))
 
-DEFAULT_FIELDS = [
-    ("", "TXID"),
-    ("", "USER"),
-    ("", "CLIENT"),
-    ("", "  MEM"),
-    ("", "LOCKS"),
-    ("", " HITS"),
-    ("", " FLTS"),
-    ("", " TIME"),
-    ("", "  CPU"),
-    ("", " WAIT"),
-    ("", " IDLE"),
-    ("", "QUERY"),
+
+def sort_key(name):
+    """ Return a sort key for a raw field. Fields without a value (such
+    as CPU time when CPU time tracking is disabled) sort as zero.
+    """
+    if name == "user":
+        return lambda tx: tx.raw(name) or ""
+    else:
+        return lambda tx: tx.raw(name) or 0
+
+
+# Every column has a cheap raw value, so that formatted cells can be
+# reused until the data behind them changes
+TRANSACTION_COLUMNS = [
+    Column("TXID", ">", lambda tx: ("class:data-primary", str(tx.id)), raw("id")),
+    Column("USER", "<", lambda tx: ("class:data-secondary" if tx.user == "neo4j" else "class:data-primary", tx.user),
+           raw("user")),
+    Column("CLIENT", "<", client_cell, raw_pair("client_address", "protocol")),
+    Column("  MEM", ">", lambda tx: ("class:data-primary", str(tx.allocated_bytes)), raw("allocated_bytes")),
+    Column("LOCKS", ">", lambda tx: stat_cell(tx.active_lock_count), raw("active_lock_count")),
+    Column(" HITS", ">", lambda tx: stat_cell(tx.page_hits), raw("page_hits")),
+    Column(" FLTS", ">", lambda tx: stat_cell(tx.page_faults), raw("page_faults")),
+    Column(" TIME", ">", lambda tx: stat_cell(tx.elapsed_time), raw("elapsed_time")),
+    Column("  CPU", ">", lambda tx: stat_cell(tx.cpu_time), raw("cpu_time")),
+    Column(" WAIT", ">", lambda tx: stat_cell(tx.wait_time), raw("wait_time")),
+    Column(" IDLE", ">", lambda tx: stat_cell(tx.idle_time), raw("idle_time")),
+    Column("QUERY", "<", query_cell, raw_pair("status", "current_query")),
+]
+ACCOUNT_COLUMNS = [
+    Column("USER", "<", lambda ac: ("class:data-secondary" if ac.user == "neo4j" else "class:data-primary", ac.user),
+           raw("user")),
+    Column("  TX", ">", lambda ac: stat_cell(ac.running_count), raw("running_count")),
+    Column("LOCKS", ">", lambda ac: stat_cell(ac.active_lock_count), raw("active_lock_count")),
+    Column("LOCK%", ">", lambda ac: stat_cell(ac.lock_share), raw("lock_share")),
+    Column(" SEEN", ">", lambda ac: stat_cell(ac.transaction_count), raw("transaction_count")),
+    Column("  CPU", ">", lambda ac: stat_cell(ac.cpu_time), raw("cpu_time")),
+    Column(" CPU%", ">", lambda ac: stat_cell(ac.cpu_share), raw("cpu_share")),
+    Column(" WAIT", ">", lambda ac: stat_cell(ac.wait_time), raw("wait_time")),
+    Column(" FLTS", ">", lambda ac: stat_cell(ac.page_faults), raw("page_faults")),
+    Column("  MEM", ">", lambda ac: stat_cell(ac.allocated_bytes), raw("allocated_bytes")),
+    Column(" MEM%", ">", lambda ac: stat_cell(ac.allocation_share), raw("allocation_share")),
+    Column("CLIENT", "<", lambda ac: ("class:data-primary", "{}/{}".format(ac.client, (ac.protocol or " ")[0].upper())),
+           raw_pair("client", "protocol")),
 ]
-DEFAULT_ALIGNMENTS = [
-    ">",
-    "<",
-    "<",
-    ">",
-    ">",
-    ">",
-    ">",
-    ">",
-    ">",
-    ">",
-    ">",
-    "<",
+LOCK_WAIT_COLUMNS = [
+    Column("TXID", "<", lock_wait_id_cell, raw_pair("id", "depth")),
+    Column("ROLE", "<", lambda lw: ("class:data-primary" if lw.depth == 0 else "class:data-secondary", lw.role),
+           raw_pair("role", "depth")),
+    Column("USER", "<", lambda lw: ("class:data-primary", lw.user or "?"), raw("user")),
+    Column("BLOCKS", ">", lambda lw: stat_cell(lw.blocked_count if lw.depth == 0 else "~"),
+           raw_pair("blocked_count", "depth")),
+    Column(" WAIT", ">", lambda lw: stat_cell(lw.wait_time), raw("wait_time")),
+    Column("LOCKS", ">", lambda lw: stat_cell(lw.active_lock_count), raw("active_lock_count")),
+    Column("WAITING FOR", "<", lambda lw: ("class:data-primary", lw.waiting_for), raw("resource_information")),
+    Column("HOLDING", "<", lambda lw: ("class:data-primary", lw.held_locks), raw("held_locks")),
+    Column("QUERY", "<", lock_wait_query_cell, raw("current_query")),
+]
+STATEMENT_COLUMNS = [
+    Column("COUNT", ">", lambda st: ("class:data-primary", str(st.count)), raw("count")),
+    Column("TOTAL", ">", lambda st: stat_cell(st.total_time), raw("total_time")),
+    Column(" MEAN", ">", lambda st: stat_cell(st.mean_time), raw_pair("total_time", "count")),
+    Column("  MAX", ">", lambda st: stat_cell(st.max_time), raw("max_time")),
+    Column("  CPU", ">", lambda st: stat_cell(st.cpu_time), raw("cpu_time")),
+    Column(" WAIT", ">", lambda st: stat_cell(st.wait_time), raw("wait_time")),
+    Column(" FLTS", ">", lambda st: stat_cell(st.page_faults), raw("page_faults")),
+    Column("  MEM", ">", lambda st: stat_cell(st.allocated_bytes), raw("allocated_bytes")),
+    Column("STATEMENT", "<", lambda st: ("", st.fingerprint), raw("fingerprint")),
+]
+# Fields the transaction list can be sorted by, with their titles and
+# whether they sort in descending order by default
+SORT_FIELDS = {
+    "elapsed_time": ("time", True),
+    "cpu_time": ("cpu", True),
+    "wait_time": ("wait", True),
+    "active_lock_count": ("locks", True),
+    "allocated_bytes": ("mem", True),
+    "page_faults": ("faults", True),
+    "user": ("user", False),
+}
+DEFAULT_SORT = ("elapsed_time", True)
+
+# How long the outcome of a kill is shown for
+KILL_STATUS_SECONDS = 5.0
+
+VIEW_TITLES = {
+    "transactions": "Transaction list",
+    "statements": "Statement statistics",
+    "accounts": "Resource accounting",
+    "locks": "Lock waits",
+}
+SPARKLINES = [
+    # (label, history metric, fixed maximum, value formatter)
+    ("CPU", "process_cpu_load", 1.0, lambda value: str(Load(value))),
+    ("HEAP", "heap_used", None, lambda value: str(BytesAmount(value))),
+    ("TX/s", "commits_per_second", None, lambda value: "%.1f" % value),
+    ("FLT/s", "page_faults_per_second", None, lambda value: "%.1f" % value),
 ]
 
 
@@ -61,94 +178,187 @@ class ServerControl(DataControl):
     def __init__(self, application, address, auth):
         super(ServerControl, self).__init__(address, auth)
         self.application = application
-        self.transactions = []
-        self.title = []
-        self.lines = [
-            self.title,
-            [("", "")],
-        ]
-        self.alignments = ["<"]
+        self.tables = {
+            "transactions": VirtualTable(TRANSACTION_COLUMNS, key=lambda tx: tx.id),
+            "statements": VirtualTable(STATEMENT_COLUMNS, key=lambda st: st.fingerprint),
+            "accounts": VirtualTable(ACCOUNT_COLUMNS, key=lambda ac: (ac.user, ac.client, ac.protocol)),
+            "locks": VirtualTable(LOCK_WAIT_COLUMNS, key=lambda lw: lw.id),
+        }
+        self.view = getattr(application, "view", "transactions")
+        self.filter = getattr(application, "filter", None)
+        self.sort = getattr(application, "sort", DEFAULT_SORT)
+        self.tables["transactions"].sort_by(sort_key(self.sort[0]), self.sort[1])
         self.status_style = self.application.style_list.get_style(self.address)
         self.header_style = "class:data-header"
-        self.selected_txid = None
         self.error = None
+        self.show_sparklines = getattr(application, "sparklines", False)
+        self.sparklines = [Sparkline(0, maximum) for _, _, maximum, _ in SPARKLINES]
+        self.sparkline_history = self.monitor.history
+        self.server_side = getattr(application, "server_side", False)
+        # (time, text) describing the outcome of the last kills
+        self.kill_status = None
 
-    def set_fields(self, fields):
-        self.lines[1] = list(fields or [("", "")])
+    @property
+    def table(self):
+        """ The table for the current view.
+        """
+        return self.tables[self.view]
 
-    def set_alignments(self, alignments):
-        self.alignments[:] = list(alignments or ["<"])
+    @property
+    def transactions(self):
+        return self.tables["transactions"].rows
 
-    def clear(self):
-        self.lines[2:] = []
+    @property
+    def selected_txid(self):
+        return self.tables["transactions"].selected
 
-    def append(self, values):
-        self.lines.append([(style, str(value)) for style, value in values])
+    def listing(self):
+        """ The data behind the current view, or :const:`None` if this is
+        not available from the server.
+        """
+        if self.data is None:
+            return None
+        elif self.view == "statements":
+            return self.data.statements
+        elif self.view == "accounts":
+            return self.data.accounts
+        elif self.view == "locks":
+            return self.data.lock_waits
+        else:
+            return self.data.transactions
 
-    def widths(self):
-        widths = list(map(len, self.lines[1]))
-        for row in self.lines[1:]:
-            for x, (_, cell) in enumerate(row):
-                size = len(cell)
-                if size > widths[x]:
-                    widths[x] = size
-        return widths
+    def show_view(self, view):
+        """ Switch between the "transactions", "statements", "accounts"
+        and "locks" views.
+        """
+        if view != self.view:
+            self.view = view
+            self.invalidate.fire()
 
     def on_refresh(self, data):
         self.data = data
         if self.data is None:
             self.invalidate.fire()
             return
-        self.clear()
-        self.set_fields(DEFAULT_FIELDS)
-        self.set_alignments(DEFAULT_ALIGNMENTS)
-
-        def stat_tuple(stat):
-            s = str(stat)
-            if s == "0" or s == "~":
-                return "class:data-secondary", s
-            else:
-                return "class:data-primary", s
-
-        self.transactions[:] = sorted(self.data.transactions, key=lambda q0: q0.elapsed_time, reverse=True)
-        for tx in self.transactions:
-            tx.current_query = tx.current_query.replace("\r\n", " ").replace("\r", " ").replace("\n", " ")
-            if tx.protocol or tx.client_address:
-                client = "{}/{}".format(tx.client_address, tx.protocol[0].upper())
-            else:
-                client = ""
-            if tx.status == "running":
-                payload_style = "class:data-status-running"
-            elif tx.status == "planning":
-                payload_style = "class:data-status-planning"
-            else:
-                payload_style = ""
-            self.append([
-                ("class:data-primary", tx.id),
-                ("class:data-secondary" if tx.user == "neo4j" else "class:data-primary", tx.user),
-                ("class:data-primary", client),
-                ("class:data-primary", tx.allocated_bytes),
-                stat_tuple(tx.active_lock_count),
-                stat_tuple(tx.page_hits),
-                stat_tuple(tx.page_faults),
-                stat_tuple(tx.elapsed_time),
-                stat_tuple(tx.cpu_time),
-                stat_tuple(tx.wait_time),
-                stat_tuple(tx.idle_time),
-                (payload_style, tx.current_query),
-            ])
+        self.update_sparklines()
+        self.update_transactions()
+        if self.data.statements is not None:
+            # Already sorted by total time
+            self.tables["statements"].set_rows(list(self.data.statements))
+        if self.data.accounts is not None:
+            # Already sorted by CPU time
+            self.tables["accounts"].set_rows(list(self.data.accounts))
+        if self.data.lock_waits is not None:
+            # Already in order, root blockers first
+            self.tables["locks"].set_rows(list(self.data.lock_waits))
         self.error = None
         self.invalidate.fire()
 
     def on_error(self, error):
         self.error = error
 
+    def update_transactions(self):
+        transactions = self.data.transactions
+        if self.filter is not None:
+            transactions = self.filter.select(transactions)
+        # Sorted by the table, only as far as the viewport reaches
+        self.tables["transactions"].set_rows(list(transactions))
+
+    def set_sort(self, field, descending):
+        """ Sort the transaction list by one of `SORT_FIELDS`.
+        """
+        self.sort = (field, descending)
+        table = self.tables["transactions"]
+        table.sort_by(sort_key(field), descending)
+        if self.data is not None:
+            self.update_transactions()
+        self.invalidate.fire()
+
+    def set_filter(self, transaction_filter):
+        """ Show only the transactions selected by a
+        :class:`agentsmith.filters.TransactionFilter`, or all
+        transactions if :const:`None`.
+        """
+        self.filter = transaction_filter
+        if self.data is not None:
+            self.update_transactions()
+        self.invalidate.fire()
+
+    def attach(self):
+        super(ServerControl, self).attach()
+        self.monitor.attach_kill_handler(self.on_kill)
+
+    def detach(self):
+        self.monitor.detach_kill_handler(self.on_kill)
+        super(ServerControl, self).detach()
+
+    def exit(self):
+        self.monitor.detach_kill_handler(self.on_kill)
+        super(ServerControl, self).exit()
+
+    def on_kill(self, results):
+        if len(results) == 1:
+            result = results[0]
+            text = "tx {} {}".format(result.transaction_id, result.outcome)
+        else:
+            counts = Counter(result.outcome for result in results)
+            text = ", ".join("{} {}".format(count, outcome) for outcome, count in sorted(counts.items()))
+        self.kill_status = (monotonic(), text)
+        self.invalidate.fire()
+
+    def update_sparklines(self):
+        history = self.monitor.history
+        if history is not self.sparkline_history:
+            # The monitor has started over (e.g. a replay has been seeked),
+            # so refill from the new history
+            self.sparkline_history = history
+            for sparkline, (_, metric, _, _) in zip(self.sparklines, SPARKLINES):
+                points = history.window(metric, sparkline.width)
+                sparkline.resize(sparkline.width, [v for _, v in points[-sparkline.width:]])
+            return
+        for sparkline, (_, metric, _, _) in zip(self.sparklines, SPARKLINES):
+            last = history.last(metric)
+            if last is not None and last[0] == history.last_time:
+                sparkline.push(last[1])
+            else:
+                sparkline.push(None)
+
+    def toggle_sparklines(self):
+        self.show_sparklines = not self.show_sparklines
+        self.invalidate.fire()
+
     def has_focus(self):
         return self.application.focused_address == self.address
 
+    def update_transaction_view(self, rows):
+        """ Ask the monitor to fetch only as many of the first transactions,
+        in the current sort order, as there are rows to display them in,
+        filtering on the server as far as the filter can be expressed in
+        Cypher. If only part of the filter can be, every row is fetched,
+        since the rows left after filtering locally may otherwise be too
+        few.
+        """
+        field, descending = self.sort
+        if self.filter is None:
+            view = TransactionView(order_by=field, descending=descending, limit=rows)
+        else:
+            view = TransactionView(order_by=field, descending=descending,
+                                   limit=rows if self.filter.complete else None,
+                                   where=self.filter.where, parameters=self.filter.parameters)
+        if view != self.monitor.transaction_view:
+            self.monitor.set_transaction_view(view)
+
     def create_content(self, width, height):
 
-        widths = self.widths()
+        extra = 1 if self.show_sparklines else 0
+        table = self.table
+        table.resize(height - 2 - extra)
+        if self.server_side:
+            self.update_transaction_view(table.height)
+
+        # Only the rows in the viewport are ever formatted
+        rows = [(table.key(table.rows[position]), table.format(position)) for position in table.visible()]
+        widths = list(table.widths)
         used_width = sum(widths)
         widths[-1] += width - used_width
 
@@ -163,6 +373,31 @@ class ServerControl(DataControl):
                     self.data.system.status_text(),
                     self.data.memory.heap_meter(10),
                     self.data.system.cpu_meter(10))
+                transactions = self.data.transactions
+                if self.view == "statements":
+                    if self.data.statements is not None:
+                        status_text += ", {} statements".format(len(self.data.statements))
+                elif self.view == "accounts":
+                    if self.data.accounts is not None:
+                        status_text += ", {} accounts".format(len(self.data.accounts))
+                elif self.view == "locks":
+                    lock_waits = self.data.lock_waits
+                    if lock_waits is not None:
+                        status_text += ", {} waiting, {} root blockers, longest chain {}".format(
+                            lock_waits.waiting_count, lock_waits.root_count, lock_waits.longest_chain)
+                        if lock_waits.cycles:
+                            status_text += ", {} cycles".format(lock_waits.cycle_count)
+                elif transactions is not None and self.filter is not None:
+                    status_text += ", {} of {} tx match".format(
+                        len(self.tables["transactions"]), transactions.listed_count or len(transactions))
+                elif transactions is not None and transactions.listed_count is not None \
+                        and transactions.listed_count > len(transactions):
+                    status_text += ", top {} of {} tx".format(len(transactions), transactions.listed_count)
+                if self.view == "transactions" and self.sort != DEFAULT_SORT:
+                    title, _ = SORT_FIELDS[self.sort[0]]
+                    status_text += ", by {} {}".format(title, "desc" if self.sort[1] else "asc")
+                if self.kill_status is not None and monotonic() - self.kill_status[0] < KILL_STATUS_SECONDS:
+                    status_text += ", kill: {}".format(self.kill_status[1])
                 # status_text += ", tx={}".format(self.data.transactions.begin_count)
                 # status_text += ", store={}".format(self.data.storage.total_store_size)
                 style = "class:server-header-focus" if self.has_focus() else "class:server-header"
@@ -175,96 +410,92 @@ class ServerControl(DataControl):
                 (style, status_text.ljust(width - 2)),
             ]
 
+        def get_sparkline_line():
+            if self.data is None:
+                return []
+            history = self.monitor.history
+            labels = ["{} ".format(label) for label, _, _, _ in SPARKLINES]
+            values = []
+            for _, metric, _, formatter in SPARKLINES:
+                last = history.last(metric)
+                values.append(" {}  ".format(formatter(last[1]) if last is not None else "~").ljust(9))
+            spark_width = max(0, (width - 2 - sum(map(len, labels)) - sum(map(len, values))) // len(SPARKLINES))
+            line = [(self.status_style, "  ")]
+            for sparkline, label, value, (_, metric, _, _) in zip(self.sparklines, labels, values, SPARKLINES):
+                if sparkline.width != spark_width:
+                    # Refill from history (one point per second) when resized
+                    points = history.window(metric, spark_width)
+                    sparkline.resize(spark_width, [v for _, v in points[-spark_width:]])
+                line.append((self.header_style, label))
+                line.append(("class:data-primary", str(sparkline)))
+                line.append(("class:data-secondary", value))
+            return line
+
         def get_header_line():
             line = []
             if self.data is None:
                 pass
-            elif self.transactions is None:
+            elif self.listing() is None:
                 dbms = self.data.system.dbms
-                message = "Transaction list not available in Neo4j {}.{} {}".format(
+                message = "{} not available in Neo4j {}.{} {}".format(
+                    VIEW_TITLES[self.view],
                     dbms.version.major, dbms.version.minor, dbms.edition)
                 line.append((self.header_style, message.ljust(width)))
             else:
-                try:
-                    li = self.lines[1]
-                except IndexError:
-                    pass
-                else:
-                    for x, (_, cell) in enumerate(li):
-                        if x > 0:
-                            line.append((self.header_style, " "))
-                        alignment = self.alignments[x]
-                        cell_width = widths[x]
-                        if alignment == ">":
-                            line.append((self.header_style, cell.rjust(cell_width)))
-                        else:
-                            line.append((self.header_style, cell.ljust(cell_width)))
+                for x, column in enumerate(table.columns):
+                    if x > 0:
+                        line.append((self.header_style, " "))
+                    line.append((self.header_style, column.pad(column.title, widths[x])))
             return line
 
         def get_data_line(y):
             line = []
-            if self.data is None:
-                pass
-            elif self.data.transactions is None:
-                pass
-            else:
-                try:
-                    li = self.lines[y]
-                except IndexError:
-                    pass
-                else:
-                    selected = str(self.selected_txid) == li[0][1]
-                    for x, (style, cell) in enumerate(li):
-                        if self.has_focus() and selected:
-                            style = "class:data-highlight"
-                        if x > 0:
-                            line.append((style, " "))
-                        alignment = self.alignments[x]
-                        cell_width = widths[x]
-                        if alignment == ">":
-                            line.append((style, cell.rjust(cell_width)))
-                        else:
-                            line.append((style, cell.ljust(cell_width)))
+            if self.listing() is None:
+                return line
+            try:
+                key, cells = rows[y]
+            except IndexError:
+                return line
+            selected = key == table.selected and self.has_focus()
+            for x, (style, cell) in enumerate(table.padded(cells, widths)):
+                if selected:
+                    style = "class:data-highlight"
+                if x > 0:
+                    line.append((style, " "))
+                line.append((style, cell))
             return line
 
         def get_line(y):
             if y == 0:
                 return get_status_line()
-            elif y == 1:
+            elif y == 1 and extra:
+                return get_sparkline_line()
+            elif y == 1 + extra:
                 return get_header_line()
             else:
-                return get_data_line(y)
+                return get_data_line(y - 2 - extra)
 
         return UIContent(
             get_line=get_line,
-            line_count=len(self.lines),
+            line_count=2 + extra + len(rows),
             show_cursor=False,
         )
 
     def up(self, event):
-        new_selected_txid = None
-        for tx in self.transactions:
-            if tx.id == self.selected_txid:
-                break
-            else:
-                new_selected_txid = tx.id
-        if new_selected_txid != self.selected_txid:
-            self.selected_txid = new_selected_txid
+        if self.table.move(-1):
             self.invalidate.fire()
 
     def down(self, event):
-        new_selected_txid = None
-        for tx in reversed(self.transactions):
-            if tx.id == self.selected_txid:
-                break
-            else:
-                new_selected_txid = tx.id
-        # print("%s -> %s" % (self.selected_txid, new_selected_txid), end="")
-        if new_selected_txid != self.selected_txid:
-            self.selected_txid = new_selected_txid
+        if self.table.move(1):
             self.invalidate.fire()
 
     def kill(self, event):
-        for tx in self.transactions:
-            if tx.id == self.selected_txid:
-                self.monitor.kill(tx)
+        if self.view == "transactions":
+            tx = self.table.selected_row
+        elif self.view == "locks":
+            lock_wait = self.table.selected_row
+            tx = None if lock_wait is None else lock_wait.transaction
+        else:
+            return
+        if tx is not None:
+            self.monitor.kill(tx)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import division, unicode_literals
+
+from collections import deque
+
+
+BLOCKS = " ▁▂▃▄▅▆▇█"
+
+
+class Sparkline(object):
+    """ Single-row chart of the most recent values of one metric, one
+    column per value.
+
+    Each new value is rendered as a single block character and shifted
+    onto the end of the line. The whole line is only redrawn when the
+    scale changes (because a new maximum has arrived or the old one has
+    scrolled off) or when the width changes.
+    """
+
+    def __init__(self, width, maximum=None):
+        self.fixed_maximum = maximum
+        self._values = deque(maxlen=width)
+        self._chars = deque(maxlen=width)
+        self._scale = None
+
+    def __len__(self):
+        return len(self._values)
+
+    def __str__(self):
+        return "".join(self._chars).rjust(self.width)
+
+    @property
+    def width(self):
+        return self._values.maxlen
+
+    def resize(self, width, values=None):
+        """ Change the width, refilling from the values given (oldest
+        first) if any are supplied.
+        """
+        old_values = list(self._values)
+        self._values = deque(old_values if values is None else values, maxlen=width)
+        self._chars = deque(maxlen=width)
+        self._redraw()
+
+    def push(self, value):
+        self._values.append(value)
+        if self._compute_scale() != self._scale:
+            self._redraw()
+        else:
+            self._chars.append(self._char(value))
+
+    def _compute_scale(self):
+        if self.fixed_maximum is not None:
+            return self.fixed_maximum
+        values = [value for value in self._values if value is not None]
+        return max(values) if values else None
+
+    def _char(self, value):
+        if value is None:
+            return " "
+        if not self._scale or value <= 0:
+            return BLOCKS[1]
+        level = int(round((len(BLOCKS) - 2) * min(value, self._scale) / self._scale)) + 1
+        return BLOCKS[level]
+
+    def _redraw(self):
+        self._scale = self._compute_scale()
+        self._chars.clear()
+        self._chars.extend(map(self._char, self._values))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import division, unicode_literals
+
+from heapq import nlargest, nsmallest
+
+
+class Column(object):
+    """ A table column. The `render` function takes a row object and
+    returns a (style, text) pair for its cell. The optional `value`
+    function returns a cheap, comparable token of everything the cell
+    depends on; if given, the rendered cell is cached per row and only
+    rendered again once the token changes.
+    """
+
+    def __init__(self, title, alignment, render, value=None):
+        self.title = title
+        self.alignment = alignment
+        self.render = render
+        self.value = value
+
+    def pad(self, text, width):
+        if self.alignment == ">":
+            return text.rjust(width)
+        else:
+            return text.ljust(width)
+
+    def __repr__(self):
+        return "<Column title=%r>" % self.title
+
+
+class VirtualTable(object):
+    """ Model of a scrollable table of row objects, of which only a
+    viewport is ever formatted.
+
+    Rows are identified by a key (such as transaction ID), with a
+    key-to-position index rebuilt on each refresh, so that moving the
+    selection costs the same however many rows there are. The selected
+    row keeps its place on screen across refreshes where possible, even
+    as rows above it come and go.
+
+    Column widths are kept up to date as rows are formatted. They only
+    ever grow, so the layout stays still as the table scrolls.
+
+    Formatted cells are cached by row key, along with their padded form
+    for the last width used. A cell is reformatted only when its column
+    value changes, and padded again only when its width changes. Entries
+    for rows that have gone are evicted on each refresh.
+
+    Rows may be given in any order and sorted by the table (see
+    :meth:`.sort_by`). Only the rows down to the bottom of the viewport
+    are picked out, with a heap, and put in order; the rest are sorted
+    only once the viewport or selection moves down into them. Until
+    then, :attr:`.rows` holds just the rows in order, while the length
+    of the table is that of all rows.
+    """
+
+    def __init__(self, columns, key):
+        self.columns = list(columns)
+        self.key = key
+        self.rows = []
+        self.index = {}
+        self.top = 0
+        self.height = 0
+        self.selected = None
+        self.widths = [len(column.title) for column in self.columns]
+        self.sort_key = None
+        self.descending = False
+        # All rows, in the order given, while only some are in order
+        self._unsorted = None
+        # Row key -> per column [value, style, text, padded width, padded text]
+        self._cache = {}
+
+    def __len__(self):
+        if self._unsorted is None:
+            return len(self.rows)
+        else:
+            return len(self._unsorted)
+
+    @property
+    def selected_position(self):
+        return self.index.get(self.selected)
+
+    @property
+    def selected_row(self):
+        position = self.selected_position
+        return None if position is None else self.rows[position]
+
+    def sort_by(self, key, descending=False):
+        """ Sort rows by a function returning a comparable value for each
+        (such as a raw field), or keep them in the order given if `key`
+        is :const:`None`. The new order applies from the next call to
+        :meth:`.set_rows`.
+        """
+        self.sort_key = key
+        self.descending = descending
+
+    def set_rows(self, rows):
+        """ Replace all rows, keeping the selection (and its position on
+        screen) if the selected row is still present. If it has gone, the
+        row that has taken its place is selected instead.
+        """
+        position = self.selected_position
+        offset = None if position is None else position - self.top
+        count = self.top + self.height
+        self._unsorted = None
+        if self.sort_key is None:
+            self.rows = rows
+        elif count >= len(rows):
+            self.rows = sorted(rows, key=self.sort_key, reverse=self.descending)
+        else:
+            pick = nlargest if self.descending else nsmallest
+            self.rows = pick(count, rows, key=self.sort_key)
+            self._unsorted = rows
+        rows = self.rows
+        self.index = index = {self.key(row): i for i, row in enumerate(rows)}
+        cache = self._cache
+        for key in [key for key in cache if key not in index]:
+            del cache[key]
+        if position is not None and self.selected not in index and self._unsorted is not None:
+            # The selected row may have dropped below the rows in order
+            key = self.key
+            selected = self.selected
+            if any(key(row) == selected for row in self._unsorted):
+                self._sort_all()
+        if position is not None and self.selected not in self.index:
+            if rows:
+                position = min(position, len(rows) - 1)
+                self.selected = self.key(rows[position])
+            else:
+                self.selected = None
+        new_position = self.selected_position
+        if new_position is not None and offset is not None:
+            self.top = new_position - offset
+        self._clamp()
+
+    def resize(self, height):
+        """ Set the number of rows in the viewport.
+        """
+        self.height = max(0, height)
+        self._clamp()
+
+    def move(self, delta):
+        """ Move the selection up (negative) or down (positive), scrolling
+        if need be. With nothing selected, the first visible row is
+        selected. Return :const:`True` if the selection changed.
+        """
+        if not self.rows:
+            return False
+        position = self.selected_position
+        if position is None:
+            new_position = min(self.top, len(self.rows) - 1)
+        else:
+            new_position = min(max(position + delta, 0), len(self) - 1)
+            if new_position == position:
+                return False
+            if new_position >= len(self.rows):
+                self._sort_all()
+        self.selected = self.key(self.rows[new_position])
+        self._clamp()
+        return True
+
+    def visible(self):
+        """ Return the range of row positions in the viewport.
+        """
+        return range(self.top, min(self.top + self.height, len(self.rows)))
+
+    def format(self, position):
+        """ Render the cells of a single row, widening columns as needed,
+        and return the cache entry for the row.
+        """
+        row = self.rows[position]
+        key = self.key(row)
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = self._cache[key] = [None] * len(self.columns)
+        widths = self.widths
+        for x, column in enumerate(self.columns):
+            cell = entry[x]
+            value = None if column.value is None else column.value(row)
+            if cell is None or column.value is None or cell[0] != value:
+                style, text = column.render(row)
+                entry[x] = [value, style, text, None, None]
+                if len(text) > widths[x]:
+                    widths[x] = len(text)
+        return entry
+
+    def padded(self, entry, widths):
+        """ Return (style, padded text) pairs for a formatted row, reusing
+        previously padded text where the width has not changed.
+        """
+        cells = []
+        for column, cell, width in zip(self.columns, entry, widths):
+            if cell[3] != width:
+                cell[3] = width
+                cell[4] = column.pad(cell[2], width)
+            cells.append((cell[1], cell[4]))
+        return cells
+
+    def _clamp(self):
+        """ Keep the viewport within the rows, and the selection within
+        the viewport.
+        """
+        position = self.selected_position
+        if position is not None and self.height:
+            if position < self.top:
+                self.top = position
+            elif position >= self.top + self.height:
+                self.top = position - self.height + 1
+        self.top = max(0, min(self.top, len(self) - self.height))
+        if self._unsorted is not None and self.top + self.height > len(self.rows):
+            # The viewport reaches below the rows in order (the selection
+            # is above, so keeps its place)
+            self._sort_all()
+
+    def _sort_all(self):
+        """ Put all rows in order.
+        """
+        rows = self._unsorted
+        self._unsorted = None
+        self.rows = sorted(rows, key=self.sort_key, reverse=self.descending)
+        self.index = {self.key(row): i for i, row in enumerate(self.rows)}
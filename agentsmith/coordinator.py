@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cluster snapshot coordinator. This drives every monitored server from a
+single clock, so that all members are polled in parallel at the same
+instant and every resulting snapshot carries the same collection
+timestamp.
+"""
+
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event
+from time import time, monotonic
+
+
+class SnapshotCoordinator(object):
+    """ Fires a tick for every registered monitor on a fixed period.
+
+    Tick times are computed from a fixed origin rather than by adding the
+    period to the end of the previous tick, so time spent collecting does
+    not accumulate as drift. If a tick is missed altogether (e.g. because
+    the machine was suspended) it is skipped rather than replayed.
+
+    A member whose previous fetch is still in progress is left out of
+    the next tick, so one slow member cannot hold up the others.
+    """
+
+    def __init__(self, period=1.0, max_concurrency=16):
+        self.period = period
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._lock = Lock()
+        self._monitors = set()
+        self._busy = set()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="agentsmith-coordinator", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<SnapshotCoordinator period=%r monitors=%r>" % (self.period, len(self._monitors))
+
+    def start(self, monitor):
+        with self._lock:
+            self._monitors.add(monitor)
+
+    def stop(self, monitor):
+        with self._lock:
+            self._monitors.discard(monitor)
+
+    def wake(self, monitor):
+        """ Ticks are never fired out of step, so any request to wake a
+        monitor is satisfied by the next aligned tick.
+        """
+
+    def _run(self):
+        origin = monotonic()
+        n = 0
+        while not self._stopped.is_set():
+            n += 1
+            now = monotonic()
+            if origin + n * self.period < now:
+                # One or more ticks were missed, so jump to the next one
+                n = int((now - origin) // self.period) + 1
+            if self._stopped.wait(origin + n * self.period - monotonic()):
+                break
+            self.fire(time())
+
+    def fire(self, collected_at):
+        """ Start a tick on every idle monitor in parallel, stamping each
+        resulting snapshot with the same collection time.
+        """
+        with self._lock:
+            monitors = [monitor for monitor in self._monitors if monitor not in self._busy]
+            self._busy.update(monitors)
+        for monitor in monitors:
+            self._executor.submit(self._tick, monitor, collected_at)
+
+    def _tick(self, monitor, collected_at):
+        try:
+            monitor.tick(collected_at)
+        except Exception as error:
+            # Nothing waits on the future, so report the failure here
+            monitor.report_error(error)
+        finally:
+            with self._lock:
+                self._busy.discard(monitor)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Collection engine that drives every monitored server from a single
+asyncio event loop, as an alternative to one thread per
+:class:`agentsmith.monitor.ServerMonitor`.
+
+The Neo4j driver is blocking, so each tick is still carried out on a
+worker thread, but the pool of workers is bounded and the workers are
+only busy while a tick is actually in progress. Waiting between ticks
+happens on the event loop rather than in sleeping threads.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+
+class CollectionEngine(object):
+
+    def __init__(self, max_concurrency=8):
+        self.max_concurrency = max_concurrency
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+        self._tasks = {}
+        self._wake_events = {}
+        self._thread = Thread(target=self._run, name="agentsmith-engine", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<CollectionEngine max_concurrency=%r monitors=%r>" % (self.max_concurrency, len(self._tasks))
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._loop.run_forever()
+
+    def _call(self, f, *args):
+        """ Run a function on the event loop thread and wait for it to
+        complete.
+        """
+        async def call():
+            return f(*args)
+
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result()
+
+    def start(self, monitor):
+        """ Begin driving a monitor.
+        """
+        self._call(self._start, monitor)
+
+    def _start(self, monitor):
+        if monitor not in self._tasks:
+            self._wake_events[monitor] = asyncio.Event()
+            self._tasks[monitor] = self._loop.create_task(self._drive(monitor))
+
+    def stop(self, monitor):
+        """ Stop driving a monitor, cancelling any pending tick. A tick
+        that is already running on a worker thread is allowed to finish.
+        """
+        task = self._call(self._stop, monitor)
+        if task is not None:
+            asyncio.run_coroutine_threadsafe(asyncio.wait([task]), self._loop).result()
+
+    def _stop(self, monitor):
+        self._wake_events.pop(monitor, None)
+        task = self._tasks.pop(monitor, None)
+        if task is not None:
+            task.cancel()
+        return task
+
+    def wake(self, monitor):
+        """ Cut short the wait before the next tick of a monitor, e.g.
+        because a handler has been attached or a kill has been queued.
+        """
+        self._loop.call_soon_threadsafe(self._wake, monitor)
+
+    def _wake(self, monitor):
+        event = self._wake_events.get(monitor)
+        if event is not None:
+            event.set()
+
+    async def _drive(self, monitor):
+        wake_event = self._wake_events[monitor]
+        while True:
+            wake_event.clear()
+            async with self._semaphore:
+                try:
+                    wait = await self._loop.run_in_executor(self._executor, monitor.tick)
+                except asyncio.CancelledError:
+                    # Before Python 3.8, this is an Exception too
+                    raise
+                except Exception as error:
+                    # Keep driving the monitor, so that it recovers along
+                    # with the server, but make the failure visible
+                    monitor.report_error(error)
+                    wait = monitor.refresh_period
+            try:
+                await asyncio.wait_for(wake_event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """ Stop driving all monitors and shut down the event loop.
+        """
+        for monitor in list(self._tasks):
+            self.stop(monitor)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prometheus exporter, serving the latest snapshot of every monitored
+server in the Prometheus text exposition format.
+
+Samples are rendered once per snapshot, on the thread that collected it,
+and the full exposition text is assembled at most once per change. A
+scrape therefore only ever returns cached text and never causes any
+extra work against the servers being monitored.
+"""
+
+from __future__ import division
+
+from collections import Counter
+from math import isinf, isnan
+from threading import Lock
+
+from agentsmith.accounts import client_host
+from agentsmith.rates import numeric
+
+
+GAUGE = "gauge"
+COUNTER = "counter"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Label value used for everything beyond the cardinality cap
+OTHER = u"__other__"
+
+# Metric families, in exposition order, as (name, type, help)
+FAMILIES = [
+    (u"agentsmith_up", GAUGE, u"Whether the last poll of the server succeeded"),
+    (u"agentsmith_dbms_info", GAUGE, u"DBMS version, edition and mode"),
+    (u"agentsmith_dbms_uptime_seconds", GAUGE, u"Time since the DBMS kernel started"),
+    (u"agentsmith_available_processors", GAUGE, u"Processors available to the JVM"),
+    (u"agentsmith_process_cpu_load", GAUGE, u"Recent CPU load of the server process (0-1)"),
+    (u"agentsmith_system_cpu_load", GAUGE, u"Recent CPU load of the whole system (0-1)"),
+    (u"agentsmith_system_load_average", GAUGE, u"System load average over the last minute"),
+    (u"agentsmith_process_cpu_seconds_total", COUNTER, u"CPU time used by the server process"),
+    (u"agentsmith_threads", GAUGE, u"Live JVM threads"),
+    (u"agentsmith_daemon_threads", GAUGE, u"Live JVM daemon threads"),
+    (u"agentsmith_physical_memory_bytes", GAUGE, u"Physical memory, by state"),
+    (u"agentsmith_swap_space_bytes", GAUGE, u"Swap space, by state"),
+    (u"agentsmith_committed_virtual_memory_bytes", GAUGE, u"Virtual memory committed to the server process"),
+    (u"agentsmith_heap_memory_bytes", GAUGE, u"JVM heap memory, by state"),
+    (u"agentsmith_non_heap_memory_bytes", GAUGE, u"JVM non-heap memory, by state"),
+    (u"agentsmith_open_file_descriptors", GAUGE, u"Open file descriptors"),
+    (u"agentsmith_max_file_descriptors", GAUGE, u"Maximum file descriptors"),
+    (u"agentsmith_store_size_bytes", GAUGE, u"Size of each store file"),
+    (u"agentsmith_transaction_logs_size_bytes", GAUGE, u"Size of the transaction logs"),
+    (u"agentsmith_ids_in_use", GAUGE, u"Number of IDs in use, by primitive type"),
+    (u"agentsmith_page_cache_hits_total", COUNTER, u"Page cache hits"),
+    (u"agentsmith_page_cache_faults_total", COUNTER, u"Page cache faults"),
+    (u"agentsmith_page_cache_pins_total", COUNTER, u"Page cache pins"),
+    (u"agentsmith_page_cache_evictions_total", COUNTER, u"Page cache evictions"),
+    (u"agentsmith_page_cache_flushes_total", COUNTER, u"Page cache flushes"),
+    (u"agentsmith_page_cache_read_bytes_total", COUNTER, u"Bytes read by the page cache"),
+    (u"agentsmith_page_cache_written_bytes_total", COUNTER, u"Bytes written by the page cache"),
+    (u"agentsmith_page_cache_hit_ratio", GAUGE, u"Lifetime page cache hit ratio reported by the server"),
+    (u"agentsmith_page_cache_usage_ratio", GAUGE, u"Proportion of the page cache in use"),
+    (u"agentsmith_transactions_begun_total", COUNTER, u"Transactions begun"),
+    (u"agentsmith_transactions_committed_total", COUNTER, u"Transactions committed"),
+    (u"agentsmith_transactions_rolled_back_total", COUNTER, u"Transactions rolled back"),
+    (u"agentsmith_transactions_open", GAUGE, u"Transactions currently open"),
+    (u"agentsmith_transactions_peak_concurrent", GAUGE, u"Peak number of concurrent transactions"),
+    (u"agentsmith_last_committed_transaction_id", GAUGE, u"ID of the last committed transaction"),
+    (u"agentsmith_running_transactions_by_user", GAUGE, u"Running transactions per user"),
+    (u"agentsmith_running_transactions_by_client", GAUGE, u"Running transactions per client host"),
+    (u"agentsmith_account_transactions_total", COUNTER, u"Transactions seen, by user, client host and protocol"),
+    (u"agentsmith_account_cpu_seconds_total", COUNTER, u"CPU time used, by user, client host and protocol"),
+    (u"agentsmith_account_wait_seconds_total", COUNTER, u"Time spent waiting, by user, client host and protocol"),
+    (u"agentsmith_account_allocated_bytes_total", COUNTER, u"Bytes allocated, by user, client host and protocol"),
+    (u"agentsmith_account_page_faults_total", COUNTER, u"Page faults, by user, client host and protocol"),
+    (u"agentsmith_account_active_locks", GAUGE, u"Active locks held, by user, client host and protocol"),
+    (u"agentsmith_averted_deadlocks_total", COUNTER, u"Deadlocks detected and broken by the server"),
+    (u"agentsmith_lock_waits_total", COUNTER, u"Transactions seen starting to wait for a lock"),
+    (u"agentsmith_lock_waiting_transactions", GAUGE, u"Transactions waiting for a lock"),
+    (u"agentsmith_lock_root_blockers", GAUGE, u"Transactions blocking others while not waiting themselves"),
+    (u"agentsmith_lock_wait_cycles", GAUGE, u"Cycles of transactions waiting on one another"),
+    (u"agentsmith_lock_wait_longest_chain", GAUGE, u"Most transactions in a single chain of lock waits"),
+]
+
+# Account samples, as (family, AccountData attribute, scale)
+ACCOUNT_SAMPLES = [
+    (u"agentsmith_account_transactions_total", u"transaction_count", 1),
+    (u"agentsmith_account_cpu_seconds_total", u"cpu_time", 1e-9),
+    (u"agentsmith_account_wait_seconds_total", u"wait_time", 1e-9),
+    (u"agentsmith_account_allocated_bytes_total", u"allocated_bytes", 1),
+    (u"agentsmith_account_page_faults_total", u"page_faults", 1),
+    (u"agentsmith_account_active_locks", u"active_lock_count", 1),
+]
+
+# Families whose samples only ever go up
+COUNTERS = {family for family, metric_type, _ in FAMILIES if metric_type == COUNTER}
+
+# Simple samples, as (family, ServerData attribute, data attribute,
+# extra labels, scale)
+SCALARS = [
+    (u"agentsmith_available_processors", u"system", u"available_processors", u"", 1),
+    (u"agentsmith_process_cpu_load", u"system", u"process_cpu_load", u"", 1),
+    (u"agentsmith_system_cpu_load", u"system", u"system_cpu_load", u"", 1),
+    (u"agentsmith_system_load_average", u"system", u"system_load_average", u"", 1),
+    (u"agentsmith_process_cpu_seconds_total", u"system", u"process_cpu_time", u"", 1e-9),
+    (u"agentsmith_dbms_uptime_seconds", u"system", u"dbms_uptime", u"", 1e-9),
+    (u"agentsmith_threads", u"system", u"thread_count", u"", 1),
+    (u"agentsmith_daemon_threads", u"system", u"daemon_thread_count", u"", 1),
+    (u"agentsmith_physical_memory_bytes", u"memory", u"total_physical_memory_size", u'state="total"', 1),
+    (u"agentsmith_physical_memory_bytes", u"memory", u"free_physical_memory_size", u'state="free"', 1),
+    (u"agentsmith_swap_space_bytes", u"memory", u"total_swap_space_size", u'state="total"', 1),
+    (u"agentsmith_swap_space_bytes", u"memory", u"free_swap_space_size", u'state="free"', 1),
+    (u"agentsmith_committed_virtual_memory_bytes", u"memory", u"committed_virtual_memory_size", u"", 1),
+    (u"agentsmith_heap_memory_bytes", u"memory", u"used_heap_memory_size", u'state="used"', 1),
+    (u"agentsmith_heap_memory_bytes", u"memory", u"committed_heap_memory_size", u'state="committed"', 1),
+    (u"agentsmith_heap_memory_bytes", u"memory", u"max_heap_memory_size", u'state="max"', 1),
+    (u"agentsmith_non_heap_memory_bytes", u"memory", u"used_non_heap_memory_size", u'state="used"', 1),
+    (u"agentsmith_non_heap_memory_bytes", u"memory", u"committed_non_heap_memory_size", u'state="committed"', 1),
+    (u"agentsmith_non_heap_memory_bytes", u"memory", u"max_non_heap_memory_size", u'state="max"', 1),
+    (u"agentsmith_open_file_descriptors", u"storage", u"open_file_descriptor_count", u"", 1),
+    (u"agentsmith_max_file_descriptors", u"storage", u"max_file_descriptor_count", u"", 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"total_store_size", u'store="total"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"node_store_size", u'store="node"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"relationship_store_size", u'store="relationship"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"property_store_size", u'store="property"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"string_store_size", u'store="string"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"array_store_size", u'store="array"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"label_store_size", u'store="label"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"schema_store_size", u'store="schema"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"index_store_size", u'store="index"', 1),
+    (u"agentsmith_store_size_bytes", u"storage", u"count_store_size", u'store="count"', 1),
+    (u"agentsmith_transaction_logs_size_bytes", u"storage", u"transaction_logs_size", u"", 1),
+    (u"agentsmith_ids_in_use", u"storage", u"node_id_count", u'type="node"', 1),
+    (u"agentsmith_ids_in_use", u"storage", u"relationship_id_count", u'type="relationship"', 1),
+    (u"agentsmith_ids_in_use", u"storage", u"property_id_count", u'type="property"', 1),
+    (u"agentsmith_ids_in_use", u"storage", u"relationship_type_id_count", u'type="relationship_type"', 1),
+    (u"agentsmith_page_cache_hits_total", u"page_cache", u"hits", u"", 1),
+    (u"agentsmith_page_cache_faults_total", u"page_cache", u"faults", u"", 1),
+    (u"agentsmith_page_cache_pins_total", u"page_cache", u"pins", u"", 1),
+    (u"agentsmith_page_cache_evictions_total", u"page_cache", u"evictions", u"", 1),
+    (u"agentsmith_page_cache_flushes_total", u"page_cache", u"flushes", u"", 1),
+    (u"agentsmith_page_cache_read_bytes_total", u"page_cache", u"bytes_read", u"", 1),
+    (u"agentsmith_page_cache_written_bytes_total", u"page_cache", u"bytes_written", u"", 1),
+    (u"agentsmith_page_cache_hit_ratio", u"page_cache", u"hit_ratio", u"", 1),
+    (u"agentsmith_page_cache_usage_ratio", u"page_cache", u"usage_ratio", u"", 1),
+    (u"agentsmith_transactions_begun_total", u"transactions", u"begin_count", u"", 1),
+    (u"agentsmith_transactions_committed_total", u"transactions", u"commit_count", u"", 1),
+    (u"agentsmith_transactions_rolled_back_total", u"transactions", u"rollback_count", u"", 1),
+    (u"agentsmith_transactions_open", u"transactions", u"open_count", u"", 1),
+    (u"agentsmith_transactions_peak_concurrent", u"transactions", u"peak_concurrent", u"", 1),
+    (u"agentsmith_last_committed_transaction_id", u"transactions", u"last_committed_id", u"", 1),
+    (u"agentsmith_averted_deadlocks_total", u"locking", u"averted_deadlocks", u"", 1),
+    (u"agentsmith_lock_waits_total", u"lock_waits", u"wait_count", u"", 1),
+    (u"agentsmith_lock_waiting_transactions", u"lock_waits", u"waiting_count", u"", 1),
+    (u"agentsmith_lock_root_blockers", u"lock_waits", u"root_count", u"", 1),
+    (u"agentsmith_lock_wait_cycles", u"lock_waits", u"cycle_count", u"", 1),
+    (u"agentsmith_lock_wait_longest_chain", u"lock_waits", u"longest_chain", u"", 1),
+]
+
+
+def escape(value):
+    """ Escape a label value for the text exposition format.
+    """
+    return (u"%s" % value).replace(u"\\", u"\\\\").replace(u"\"", u"\\\"").replace(u"\n", u"\\n")
+
+
+def format_value(value):
+    if value is True:
+        return u"1"
+    elif value is False:
+        return u"0"
+    elif isnan(value):
+        return u"NaN"
+    elif isinf(value):
+        return u"+Inf" if value > 0 else u"-Inf"
+    else:
+        return repr(value)
+
+
+def cap(counts, limit):
+    """ Limit a :class:`collections.Counter` to its `limit` most common
+    keys, folding the remainder into a single :data:`OTHER` key.
+    """
+    if len(counts) <= limit:
+        return counts
+    capped = Counter(dict(counts.most_common(limit)))
+    capped[OTHER] = sum(counts.values()) - sum(capped.values())
+    return capped
+
+
+class AccountSeries(object):
+    """ Label membership of the account series of a single server, kept
+    stable from one snapshot to the next so that the account counters
+    only ever go up.
+
+    The first `limit` accounts seen get series of their own, for as long
+    as they are tracked. Every other account is folded into the
+    `__other__` series, which adds the growth of each since the last
+    snapshot, so it keeps counting what accounts have used even after
+    they are no longer tracked.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._labelled = set()
+        self._folded = {}
+        self._other = [0] * len(ACCOUNT_SAMPLES)
+
+    def samples(self, accounts):
+        """ Return (labels, values) pairs for the accounts in a snapshot,
+        each with values in the order of :data:`ACCOUNT_SAMPLES`.
+        """
+        current = [((account.user, account.client, account.protocol),
+                    [numeric(getattr(account, attr)) * scale for _, attr, scale in ACCOUNT_SAMPLES])
+                   for account in accounts]
+        keys = {key for key, _ in current}
+        self._labelled.intersection_update(keys)
+        for key in set(self._folded) - keys:
+            del self._folded[key]
+        samples = []
+        other_gauges = [0] * len(ACCOUNT_SAMPLES)
+        for key, values in current:
+            if key not in self._labelled and key not in self._folded and len(self._labelled) < self.limit:
+                self._labelled.add(key)
+            if key in self._labelled:
+                user, client, protocol = key
+                samples.append((u'user="%s",client="%s",protocol="%s"' % (
+                    escape(user or u""), escape(client), escape(protocol or u"")), values))
+                continue
+            last = self._folded.get(key)
+            for i, (family, _, _) in enumerate(ACCOUNT_SAMPLES):
+                if family in COUNTERS:
+                    self._other[i] += max(values[i] - (0 if last is None else last[i]), 0)
+                else:
+                    other_gauges[i] += values[i]
+            self._folded[key] = values
+        if self._folded or any(self._other):
+            samples.append((u'user="%s",client="%s",protocol="%s"' % (OTHER, OTHER, OTHER),
+                            [other if family in COUNTERS else gauge for (family, _, _), other, gauge
+                             in zip(ACCOUNT_SAMPLES, self._other, other_gauges)]))
+        return samples
+
+
+class MetricsExporter(object):
+    """ Renders snapshots from any number of monitors into Prometheus
+    text exposition format.
+
+    :param max_label_values: maximum number of distinct user, client or
+        account label values per server; the least busy users and clients,
+        and any accounts seen once the label values have run out, are
+        folded into a single `__other__` series
+    """
+
+    def __init__(self, max_label_values=50):
+        self.max_label_values = max_label_values
+        self._lock = Lock()
+        self._samples = {}
+        self._accounts = {}
+        self._text = None
+
+    def handler(self, address):
+        """ Return a snapshot handler for the server at `address`, for
+        attaching to its monitor.
+        """
+
+        def f(data):
+            self.update(address, data)
+
+        return f
+
+    def error_handler(self, address):
+        """ Return an error handler for the server at `address`, which marks
+        the server as down.
+        """
+
+        def f(error):
+            self.update(address, None)
+
+        return f
+
+    def update(self, address, data):
+        samples = self.render(address, data)
+        with self._lock:
+            self._samples[address] = samples
+            self._text = None
+
+    def render(self, address, data):
+        """ Render the samples for a single snapshot, as a dictionary of
+        family name to sample lines.
+        """
+        server = u'server="%s"' % escape(address)
+        samples = {}
+
+        def add(family, labels, value):
+            value = numeric(value)
+            if value is None:
+                return
+            labels = u"%s,%s" % (server, labels) if labels else server
+            samples.setdefault(family, []).append(u"%s{%s} %s\n" % (family, labels, format_value(value)))
+
+        add(u"agentsmith_up", u"", data is not None)
+        if data is None:
+            return samples
+        if data.system is not None:
+            dbms = data.system.dbms
+            add(u"agentsmith_dbms_info", u'version="%s",edition="%s",mode="%s"' % (
+                escape(dbms.version), escape(dbms.edition), escape(dbms.mode)), 1)
+        for family, section, attr, labels, scale in SCALARS:
+            value = numeric(getattr(getattr(data, section, None), attr, None))
+            if value is not None:
+                add(family, labels, value * scale if scale != 1 else value)
+        if data.transactions is not None:
+            users = Counter()
+            clients = Counter()
+            for tx in data.transactions:
+                users[tx.user] += 1
+                clients[client_host(tx.client_address)] += 1
+            for user, count in sorted(cap(users, self.max_label_values).items()):
+                add(u"agentsmith_running_transactions_by_user", u'user="%s"' % escape(user), count)
+            for client, count in sorted(cap(clients, self.max_label_values).items()):
+                add(u"agentsmith_running_transactions_by_client", u'client="%s"' % escape(client), count)
+        if data.accounts is not None:
+            self.render_accounts(add, address, data.accounts)
+        return samples
+
+    def render_accounts(self, add, address, accounts):
+        """ Render account samples, with the accounts beyond the label cap
+        folded together into a single series (see :class:`.AccountSeries`).
+        """
+        try:
+            series = self._accounts[address]
+        except KeyError:
+            series = self._accounts[address] = AccountSeries(self.max_label_values)
+        for labels, values in series.samples(accounts):
+            for (family, _, _), value in zip(ACCOUNT_SAMPLES, values):
+                add(family, labels, value)
+
+    def exposition(self):
+        """ Return the full exposition text for all servers. This is only
+        rebuilt after a new snapshot has arrived.
+        """
+        with self._lock:
+            if self._text is None:
+                servers = [self._samples[address] for address in sorted(self._samples)]
+                lines = []
+                for family, metric_type, help_text in FAMILIES:
+                    family_lines = [line for samples in servers for line in samples.get(family, ())]
+                    if family_lines:
+                        lines.append(u"# HELP %s %s\n" % (family, help_text))
+                        lines.append(u"# TYPE %s %s\n" % (family, metric_type))
+                        lines.extend(family_lines)
+                self._text = u"".join(lines).encode("utf-8")
+            return self._text
+
+
+def serve(addresses, auth, host="127.0.0.1", port=9471, max_label_values=50):
+    """ Monitor the servers at the addresses given and serve their metrics
+    over HTTP until interrupted. Only the loopback interface is listened
+    on unless another host (such as "0.0.0.0") is given.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from agentsmith.monitor import ServerMonitor
+
+    exporter = MetricsExporter(max_label_values)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.partition("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = exporter.exposition()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    monitors = []
+    server = Server((host, port), Handler)
+    try:
+        for address in addresses:
+            server_host, _, server_port = address.partition(":")
+            address = "%s:%s" % (server_host or "localhost", server_port or 7687)
+            monitor = ServerMonitor(address, auth, on_error=exporter.error_handler(address))
+            monitor.attach(exporter.handler(address))
+            monitors.append(monitor)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for monitor in monitors:
+            monitor.exit()
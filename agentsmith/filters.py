@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Filter expressions over the transaction list, such as:
+
+    user != 'neo4j' and elapsed > 5s and query ~ 'MERGE'
+
+An expression is made of comparisons between a field and a literal,
+combined with `and`, `or`, `not` and parentheses. Text fields can be
+compared with `==` (or `=`) and `!=`, and searched for a regular
+expression with `~` (or `!~` for no match). Numeric fields can also be
+compared with `<`, `<=`, `>` and `>=`; times may be given in `ms`, `s`,
+`m` or `h` (milliseconds if no unit is given) and sizes in `K`, `M`,
+`G` or `T` (bytes if no unit is given). A comparison with a field that
+has no value (such as CPU time when CPU time tracking is disabled) is
+always false.
+
+Each expression is parsed once and compiled into a single Python
+function that filters a whole list of transactions, working on their
+raw records. The comparisons that Cypher can express are also compiled
+into a predicate for the `WHERE` clause of a
+:class:`agentsmith.monitor.TransactionView`, so that the server can do
+the filtering. Only when the whole expression can be compiled in this
+way can the server also limit the number of rows returned.
+"""
+
+from __future__ import division
+
+import re
+
+
+class FilterError(ValueError):
+    """ Raised when a filter expression is not valid.
+    """
+
+
+_TEXT, _TIME, _BYTES, _COUNT = range(4)
+
+# Fields by name, as (record key, kind, Python expression deriving the
+# value from the raw record value (as "{}") or None, whether Cypher can
+# compare the column directly). Derivations are written inline rather
+# than as function calls, as they are evaluated for every row.
+FIELDS = {
+    u"id": (u"transactionId", _COUNT, u"int({}.rpartition('-')[2])", False),
+    u"user": (u"username", _TEXT, None, True),
+    u"client": (u"clientAddress", _TEXT, u"{}.rpartition(':')[0]", False),
+    u"address": (u"clientAddress", _TEXT, None, True),
+    u"protocol": (u"protocol", _TEXT, None, True),
+    u"status": (u"status", _TEXT, None, True),
+    u"query": (u"currentQuery", _TEXT, None, True),
+    u"elapsed": (u"elapsedTimeMillis", _TIME, None, True),
+    u"cpu": (u"cpuTimeMillis", _TIME, None, True),
+    u"wait": (u"waitTimeMillis", _TIME, None, True),
+    u"idle": (u"idleTimeMillis", _TIME, None, True),
+    u"locks": (u"activeLockCount", _COUNT, None, True),
+    u"mem": (u"allocatedBytes", _BYTES, None, True),
+    u"hits": (u"pageHits", _COUNT, None, True),
+    u"faults": (u"pageFaults", _COUNT, None, True),
+}
+
+_ALIASES = {
+    u"txid": u"id",
+    u"username": u"user",
+    u"elapsed_time": u"elapsed",
+    u"time": u"elapsed",
+    u"cpu_time": u"cpu",
+    u"wait_time": u"wait",
+    u"idle_time": u"idle",
+    u"memory": u"mem",
+    u"allocated": u"mem",
+    u"page_hits": u"hits",
+    u"page_faults": u"faults",
+}
+
+_UNITS = {
+    _TIME: {u"": 1, u"ms": 1, u"s": 1000, u"m": 60000, u"h": 3600000},
+    _BYTES: {u"": 1, u"b": 1, u"k": 1024, u"kb": 1024, u"kib": 1024, u"m": 1024 ** 2, u"mb": 1024 ** 2,
+             u"mib": 1024 ** 2, u"g": 1024 ** 3, u"gb": 1024 ** 3, u"gib": 1024 ** 3, u"t": 1024 ** 4,
+             u"tb": 1024 ** 4, u"tib": 1024 ** 4},
+    _COUNT: {u"": 1, u"k": 1000, u"m": 1000000},
+}
+
+_TEXT_OPERATORS = {u"==", u"!=", u"~", u"!~"}
+_NUMBER_OPERATORS = {u"==", u"!=", u"<", u"<=", u">", u">="}
+
+_TOKENS = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<number>\d+(?:\.\d+)?[A-Za-z]*)
+  | (?P<operator>==|!=|<=|>=|!~|=|<|>|~)
+  | (?P<paren>[()])
+  | (?P<word>[A-Za-z_]\w*)
+""", re.VERBOSE)
+
+_NUMBER = re.compile(r"(\d+(?:\.\d+)?)([A-Za-z]*)$")
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = _TOKENS.match(text, position)
+        if match is None:
+            raise FilterError("Unexpected %r at position %d" % (text[position], position + 1))
+        kind = match.lastgroup
+        if kind != u"space":
+            value = match.group()
+            if kind == u"word" and value.lower() in (u"and", u"or", u"not"):
+                kind, value = u"keyword", value.lower()
+            elif kind == u"operator" and value == u"=":
+                value = u"=="
+            tokens.append((kind, value, position + 1))
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+    """ Recursive descent parser, producing a tree of tuples:
+
+        ("or", [node, ...])
+        ("and", [node, ...])
+        ("not", node)
+        ("compare", field, operator, value)
+    """
+
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.index = 0
+
+    def parse(self):
+        if not self.tokens:
+            return None
+        node = self.parse_or()
+        if self.index < len(self.tokens):
+            _, value, position = self.tokens[self.index]
+            raise FilterError("Unexpected %r at position %d" % (value, position))
+        return node
+
+    def peek(self):
+        try:
+            return self.tokens[self.index]
+        except IndexError:
+            return (None, None, None)
+
+    def next(self, expected):
+        kind, value, position = self.peek()
+        if kind is None:
+            raise FilterError("Expected %s at end of expression" % expected)
+        self.index += 1
+        return kind, value, position
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek()[:2] == (u"keyword", u"or"):
+            self.index += 1
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else (u"or", nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek()[:2] == (u"keyword", u"and"):
+            self.index += 1
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else (u"and", nodes)
+
+    def parse_not(self):
+        kind, value, position = self.next(u"a comparison")
+        if (kind, value) == (u"keyword", u"not"):
+            return (u"not", self.parse_not())
+        elif (kind, value) == (u"paren", u"("):
+            node = self.parse_or()
+            kind, value, position = self.next(u"')'")
+            if value != u")":
+                raise FilterError("Expected ')' at position %d" % position)
+            return node
+        elif kind == u"word":
+            return self.parse_comparison(value, position)
+        else:
+            raise FilterError("Expected a field name at position %d" % position)
+
+    def parse_comparison(self, name, position):
+        field = _ALIASES.get(name.lower(), name.lower())
+        if field not in FIELDS:
+            raise FilterError("Unknown field %r at position %d (expected one of %s)" % (
+                name, position, u", ".join(sorted(FIELDS))))
+        _, field_kind, _, _ = FIELDS[field]
+        kind, op, position = self.next(u"an operator")
+        if kind != u"operator":
+            raise FilterError("Expected an operator at position %d" % position)
+        allowed = _TEXT_OPERATORS if field_kind == _TEXT else _NUMBER_OPERATORS
+        if op not in allowed:
+            raise FilterError("Operator %r cannot be used with %r at position %d" % (op, name, position))
+        kind, literal, position = self.next(u"a value")
+        if field_kind == _TEXT:
+            if kind != u"string":
+                raise FilterError("Expected a quoted string at position %d" % position)
+            value = re.sub(r"\\(.)", r"\1", literal[1:-1])
+            if op in (u"~", u"!~"):
+                try:
+                    re.compile(value)
+                except re.error as error:
+                    raise FilterError("Invalid pattern at position %d: %s" % (position, error))
+        else:
+            if kind != u"number":
+                raise FilterError("Expected a number at position %d" % position)
+            number, unit = _NUMBER.match(literal).groups()
+            try:
+                scale = _UNITS[field_kind][unit.lower()]
+            except KeyError:
+                raise FilterError("Unknown unit %r for %r at position %d" % (unit, name, position))
+            value = float(number) * scale
+            if value == int(value):
+                value = int(value)
+        return (u"compare", field, op, value)
+
+
+class TransactionFilter(object):
+    """ A compiled filter expression.
+
+    :param text: the filter expression
+    :raise FilterError: if the expression is not valid
+
+    :ivar where: Cypher predicate for as much of the expression as can be
+        expressed in Cypher, or :const:`None`
+    :ivar parameters: parameters referred to by `where`
+    :ivar complete: whether `where` expresses the whole expression, so
+        that the server returns only the rows that match
+    """
+
+    def __init__(self, text):
+        self.text = text.strip()
+        self.tree = _Parser(self.text).parse()
+        self.__constants = {}
+        self.parameters = {}
+        self.complete = True
+        if self.tree is None:
+            self.where = None
+            self.select = list
+        else:
+            source = (u"def select(transactions):\n"
+                      u"    return [tx for tx in transactions for r in (tx._record,) if %s]\n" %
+                      self.__python(self.tree))
+            namespace = dict(self.__constants)
+            exec(compile(source, u"<filter>", u"exec"), namespace)
+            self.select = namespace[u"select"]
+            self.where = self.__cypher(self.tree)
+            # Drop the parameters of any parts left out
+            used = set(re.findall(r"\$(filter\d+)", self.where or u""))
+            self.parameters = {name: value for name, value in self.parameters.items() if name in used}
+
+    def __repr__(self):
+        return "<TransactionFilter text=%r where=%r>" % (self.text, self.where)
+
+    def __eq__(self, other):
+        return isinstance(other, TransactionFilter) and self.text == other.text
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __bool__(self):
+        return self.tree is not None
+
+    __nonzero__ = __bool__
+
+    def __constant(self, value):
+        name = u"c%d" % len(self.__constants)
+        self.__constants[name] = value
+        return name
+
+    def __python(self, node):
+        """ Return Python source for a node, as an expression over the raw
+        record `r`.
+        """
+        if node[0] == u"or":
+            return u"(" + u" or ".join(map(self.__python, node[1])) + u")"
+        elif node[0] == u"and":
+            return u"(" + u" and ".join(map(self.__python, node[1])) + u")"
+        elif node[0] == u"not":
+            return u"(not " + self.__python(node[1]) + u")"
+        _, field, op, value = node
+        key, _, derive, _ = FIELDS[field]
+        raw = u"r[%r]" % key
+        v = raw if derive is None else derive.format(raw)
+        if op == u"~":
+            return u"(%s is not None and %s(%s) is not None)" % (raw, self.__constant(re.compile(value).search), v)
+        elif op == u"!~":
+            return u"(%s is not None and %s(%s) is None)" % (raw, self.__constant(re.compile(value).search), v)
+        else:
+            return u"(%s is not None and %s %s %s)" % (raw, v, op, self.__constant(value))
+
+    def __cypher(self, node):
+        """ Return a Cypher predicate for as much of a node as can be
+        expressed in Cypher, or :const:`None`. Parts of a conjunction may
+        be left out, since every row is filtered again locally; parts of a
+        disjunction, or a negation, may not.
+        """
+        if node[0] == u"and":
+            parts = [part for part in map(self.__cypher, node[1]) if part is not None]
+            if not parts:
+                return None
+            return parts[0] if len(parts) == 1 else u"(" + u" AND ".join(parts) + u")"
+        elif node[0] == u"or":
+            parts = list(map(self.__cypher, node[1]))
+            if None in parts:
+                return None
+            return u"(" + u" OR ".join(parts) + u")"
+        elif node[0] == u"not":
+            # Cypher treats missing values differently under negation
+            self.complete = False
+            return None
+        _, field, op, value = node
+        key, _, _, pushable = FIELDS[field]
+        name = u"filter%d" % len(self.parameters)
+        if field == u"client" and op in (u"==", u"!=") and value:
+            # The host is everything before the last colon
+            predicate = (u"(%s STARTS WITH $%s + ':' AND NOT substring(%s, size($%s) + 1) CONTAINS ':')" %
+                         (key, name, key, name))
+            if op == u"!=":
+                predicate = u"NOT %s" % predicate
+        elif field == u"id" and op in (u"==", u"!="):
+            predicate = u"%s %s 'transaction-' + $%s" % (key, u"=" if op == u"==" else u"<>", name)
+        elif not pushable:
+            self.complete = False
+            return None
+        elif op in (u"~", u"!~"):
+            if re.escape(value) == value:
+                predicate = u"%s CONTAINS $%s" % (key, name)
+            else:
+                predicate = u"%s =~ $%s" % (key, name)
+                value = u"(?s).*(?:%s).*" % value
+            if op == u"!~":
+                predicate = u"NOT %s" % predicate
+        else:
+            predicate = u"%s %s $%s" % (key, u"=" if op == u"==" else u"<>" if op == u"!=" else op, name)
+        self.parameters[name] = value
+        return predicate
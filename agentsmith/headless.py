@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Headless monitoring, writing one JSON object per server per snapshot
+(JSON Lines) for consumption by log shippers and other tools.
+
+Each line is encoded directly from the snapshot objects into a list of
+text fragments, using precomputed key fragments and the C string
+encoder from the standard library, so no intermediate dictionaries are
+built and the cost per line stays small.
+"""
+
+from __future__ import division
+
+from json import dumps
+from json.encoder import encode_basestring_ascii
+from math import isinf, isnan
+from operator import attrgetter
+from threading import Lock
+from time import sleep
+
+from agentsmith.rates import COUNTERS, numeric
+
+
+# Field kinds
+_TEXT, _NUMBER, _MILLIS, _RAW = range(4)
+
+# Fields written for each section, as (JSON key, attribute path, kind)
+SYSTEM_FIELDS = [
+    (u"dbms_version", u"dbms.version", _TEXT),
+    (u"dbms_edition", u"dbms.edition", _TEXT),
+    (u"dbms_mode", u"dbms.mode", _TEXT),
+    (u"dbms_uptime_ms", u"dbms_uptime", _MILLIS),
+    (u"jvm_uptime_ms", u"jvm_uptime", _MILLIS),
+    (u"available_processors", u"available_processors", _NUMBER),
+    (u"process_cpu_load", u"process_cpu_load", _NUMBER),
+    (u"system_cpu_load", u"system_cpu_load", _NUMBER),
+    (u"system_load_average", u"system_load_average", _NUMBER),
+    (u"process_cpu_time_ms", u"process_cpu_time", _MILLIS),
+    (u"thread_count", u"thread_count", _NUMBER),
+    (u"daemon_thread_count", u"daemon_thread_count", _NUMBER),
+    (u"peak_thread_count", u"peak_thread_count", _NUMBER),
+    (u"total_started_thread_count", u"total_started_thread_count", _NUMBER),
+]
+
+MEMORY_FIELDS = [(name, name, _NUMBER) for name in [
+    u"total_physical_memory_size",
+    u"free_physical_memory_size",
+    u"total_swap_space_size",
+    u"free_swap_space_size",
+    u"committed_virtual_memory_size",
+    u"committed_heap_memory_size",
+    u"initial_heap_memory_size",
+    u"max_heap_memory_size",
+    u"used_heap_memory_size",
+    u"committed_non_heap_memory_size",
+    u"initial_non_heap_memory_size",
+    u"max_non_heap_memory_size",
+    u"used_non_heap_memory_size",
+]]
+
+STORAGE_FIELDS = [
+    (u"database_name", u"database_name", _TEXT),
+    (u"read_only", u"read_only", _NUMBER),
+    (u"store_id", u"store_id", _RAW),
+    (u"max_file_descriptor_count", u"max_file_descriptor_count", _NUMBER),
+    (u"open_file_descriptor_count", u"open_file_descriptor_count", _NUMBER),
+] + [(name, name, _NUMBER) for name in [
+    u"array_store_size",
+    u"count_store_size",
+    u"index_store_size",
+    u"label_store_size",
+    u"node_store_size",
+    u"property_store_size",
+    u"relationship_store_size",
+    u"schema_store_size",
+    u"string_store_size",
+    u"total_store_size",
+    u"transaction_logs_size",
+    u"node_id_count",
+    u"property_id_count",
+    u"relationship_id_count",
+    u"relationship_type_id_count",
+]]
+
+PAGE_CACHE_FIELDS = [(name, name, _NUMBER) for name in [
+    u"bytes_read",
+    u"bytes_written",
+    u"eviction_exceptions",
+    u"evictions",
+    u"faults",
+    u"file_mappings",
+    u"file_unmappings",
+    u"flushes",
+    u"hit_ratio",
+    u"hits",
+    u"pins",
+    u"unpins",
+    u"usage_ratio",
+]]
+
+TRANSACTION_LIST_FIELDS = [(name, name, _NUMBER) for name in [
+    u"last_committed_id",
+    u"begin_count",
+    u"open_count",
+    u"commit_count",
+    u"rollback_count",
+    u"peak_concurrent",
+]]
+
+TRANSACTION_FIELDS = [
+    (u"id", u"id", _NUMBER),
+    (u"user", u"user", _TEXT),
+    (u"status", u"status", _TEXT),
+    (u"protocol", u"protocol", _TEXT),
+    (u"client_address", u"client_address", _TEXT),
+    (u"start_time", u"start_time", _TEXT),
+    (u"current_query_id", u"current_query_id", _NUMBER),
+    (u"current_query", u"current_query", _TEXT),
+    (u"elapsed_time_ms", u"elapsed_time", _MILLIS),
+    (u"cpu_time_ms", u"cpu_time", _MILLIS),
+    (u"wait_time_ms", u"wait_time", _MILLIS),
+    (u"idle_time_ms", u"idle_time", _MILLIS),
+    (u"active_lock_count", u"active_lock_count", _NUMBER),
+    (u"allocated_bytes", u"allocated_bytes", _NUMBER),
+    (u"page_hits", u"page_hits", _NUMBER),
+    (u"page_faults", u"page_faults", _NUMBER),
+    (u"metadata", u"metadata", _RAW),
+]
+
+ACCOUNT_FIELDS = [
+    (u"user", u"user", _TEXT),
+    (u"client", u"client", _TEXT),
+    (u"protocol", u"protocol", _TEXT),
+    (u"running_count", u"running_count", _NUMBER),
+    (u"active_lock_count", u"active_lock_count", _NUMBER),
+    (u"transaction_count", u"transaction_count", _NUMBER),
+    (u"cpu_time_ms", u"cpu_time", _MILLIS),
+    (u"wait_time_ms", u"wait_time", _MILLIS),
+    (u"allocated_bytes", u"allocated_bytes", _NUMBER),
+    (u"page_faults", u"page_faults", _NUMBER),
+    (u"lock_share", u"lock_share", _NUMBER),
+    (u"cpu_share", u"cpu_share", _NUMBER),
+    (u"allocation_share", u"allocation_share", _NUMBER),
+]
+
+LOCK_WAIT_LIST_FIELDS = [
+    (u"waiting_count", u"waiting_count", _NUMBER),
+    (u"root_count", u"root_count", _NUMBER),
+    (u"longest_chain", u"longest_chain", _NUMBER),
+    (u"wait_count", u"wait_count", _NUMBER),
+    (u"cycles", u"cycles", _RAW),
+]
+
+LOCK_WAIT_FIELDS = [
+    (u"id", u"id", _NUMBER),
+    (u"role", u"role", _TEXT),
+    (u"depth", u"depth", _NUMBER),
+    (u"blocker_ids", u"blocker_ids", _RAW),
+    (u"blocked_count", u"blocked_count", _NUMBER),
+    (u"user", u"user", _TEXT),
+    (u"wait_time_ms", u"wait_time", _MILLIS),
+    (u"active_lock_count", u"active_lock_count", _NUMBER),
+    (u"waiting_for", u"waiting_for", _TEXT),
+    (u"held_locks", u"held_locks", _TEXT),
+    (u"current_query", u"current_query", _TEXT),
+]
+
+QUERY_FIELDS = [
+    (u"id", u"id", _NUMBER),
+    (u"user", u"user", _TEXT),
+    (u"status", u"status", _TEXT),
+    (u"protocol", u"protocol", _TEXT),
+    (u"client_address", u"client_address", _TEXT),
+    (u"start_time", u"start_time", _TEXT),
+    (u"query", u"text", _TEXT),
+    (u"planner", u"planner", _TEXT),
+    (u"runtime", u"runtime", _TEXT),
+    (u"elapsed_time_ms", u"elapsed_time", _MILLIS),
+    (u"cpu_time_ms", u"cpu_time", _MILLIS),
+    (u"wait_time_ms", u"wait_time", _MILLIS),
+    (u"idle_time_ms", u"idle_time", _MILLIS),
+    (u"active_lock_count", u"active_lock_count", _NUMBER),
+    (u"allocated_bytes", u"allocated_bytes", _NUMBER),
+    (u"page_hits", u"page_hits", _NUMBER),
+    (u"page_faults", u"page_faults", _NUMBER),
+    (u"metadata", u"metadata", _RAW),
+]
+
+
+def _compile(fields):
+    """ Turn a field list into (key fragment, getter, kind) triples,
+    where each key fragment is the encoded key and colon, ready to be
+    written out.
+    """
+    return [(encode_basestring_ascii(key) + u":", attrgetter(attr), kind) for key, attr, kind in fields]
+
+
+def _number(value):
+    value = numeric(value)
+    if value is None:
+        return u"null"
+    elif value is True:
+        return u"true"
+    elif value is False:
+        return u"false"
+    elif isinstance(value, float) and (isnan(value) or isinf(value)):
+        return u"null"
+    else:
+        return repr(value)
+
+
+def _millis(value):
+    if value is None or value.ns is None:
+        return u"null"
+    return repr(value.ns / 1000000)
+
+
+def _text(value):
+    if value is None:
+        return u"null"
+    return encode_basestring_ascii(u"%s" % value)
+
+
+def _raw(value):
+    return dumps(value, separators=(u",", u":"), default=str)
+
+
+_ENCODERS = {
+    _TEXT: _text,
+    _NUMBER: _number,
+    _MILLIS: _millis,
+    _RAW: _raw,
+}
+
+
+def _fields(parts, obj, fields):
+    """ Append the members of an object, made up of the fields given, to
+    `parts`, without the enclosing braces.
+    """
+    for i, (key, get, kind) in enumerate(fields):
+        if i:
+            parts.append(u",")
+        parts.append(key)
+        try:
+            value = get(obj)
+        except AttributeError:
+            value = None
+        parts.append(_ENCODERS[kind](value))
+
+
+def _object(parts, obj, fields):
+    parts.append(u"{")
+    _fields(parts, obj, fields)
+    parts.append(u"}")
+
+
+def _list(parts, items, fields):
+    parts.append(u"[")
+    for i, item in enumerate(items):
+        if i:
+            parts.append(u",")
+        _object(parts, item, fields)
+    parts.append(u"]")
+
+
+def _encode_system(parts, data):
+    _object(parts, data.system, _SYSTEM)
+
+
+def _encode_memory(parts, data):
+    _object(parts, data.memory, _MEMORY)
+
+
+def _encode_storage(parts, data):
+    _object(parts, data.storage, _STORAGE)
+
+
+def _encode_page_cache(parts, data):
+    _object(parts, data.page_cache, _PAGE_CACHE)
+
+
+def _encode_transactions(parts, data):
+    transactions = data.transactions
+    parts.append(u"{")
+    _fields(parts, transactions, _TRANSACTION_LIST)
+    parts.append(u',"list":')
+    _list(parts, transactions, _TRANSACTION)
+    parts.append(u"}")
+
+
+def _encode_accounts(parts, data):
+    _list(parts, data.accounts, _ACCOUNT)
+
+
+def _encode_locks(parts, data):
+    lock_waits = data.lock_waits
+    parts.append(u"{")
+    _fields(parts, lock_waits, _LOCK_WAIT_LIST)
+    parts.append(u',"list":')
+    _list(parts, lock_waits, _LOCK_WAIT)
+    parts.append(u"}")
+
+
+def _encode_queries(parts, data):
+    _list(parts, data.queries, _QUERY)
+
+
+def _encode_rates(parts, data):
+    rates = data.rates
+    parts.append(u"{")
+    for name in _RATE_NAMES:
+        parts.append(_RATE_KEYS[name])
+        parts.append(_number(rates.rate(name)))
+        parts.append(u",")
+    parts.append(u'"hit_ratio":')
+    parts.append(_number(rates.hit_ratio))
+    parts.append(u"}")
+
+
+def _encode_cluster(parts, data):
+    parts.append(_raw(data.cluster_overview.data))
+
+
+_SYSTEM = _compile(SYSTEM_FIELDS)
+_MEMORY = _compile(MEMORY_FIELDS)
+_STORAGE = _compile(STORAGE_FIELDS)
+_PAGE_CACHE = _compile(PAGE_CACHE_FIELDS)
+_TRANSACTION_LIST = _compile(TRANSACTION_LIST_FIELDS)
+_TRANSACTION = _compile(TRANSACTION_FIELDS)
+_ACCOUNT = _compile(ACCOUNT_FIELDS)
+_LOCK_WAIT_LIST = _compile(LOCK_WAIT_LIST_FIELDS)
+_LOCK_WAIT = _compile(LOCK_WAIT_FIELDS)
+_QUERY = _compile(QUERY_FIELDS)
+_RATE_NAMES = sorted(COUNTERS)
+_RATE_KEYS = {name: encode_basestring_ascii(name + u"_per_second") + u":" for name in _RATE_NAMES}
+
+# Sections that can be written, by name, as (ServerData attribute, encoder)
+SECTIONS = {
+    u"system": (u"system", _encode_system),
+    u"memory": (u"memory", _encode_memory),
+    u"storage": (u"storage", _encode_storage),
+    u"page_cache": (u"page_cache", _encode_page_cache),
+    u"transactions": (u"transactions", _encode_transactions),
+    u"accounts": (u"accounts", _encode_accounts),
+    u"locks": (u"lock_waits", _encode_locks),
+    u"queries": (u"queries", _encode_queries),
+    u"rates": (u"rates", _encode_rates),
+    u"cluster": (u"cluster_overview", _encode_cluster),
+}
+
+DEFAULT_SECTIONS = (u"system", u"memory", u"storage", u"page_cache", u"transactions", u"accounts", u"rates")
+
+
+class JsonLinesWriter(object):
+    """ Writes snapshots from any number of monitors to a single stream,
+    one JSON object per line. Sections missing from a snapshot (such as
+    Enterprise-only data on Community Edition) are left out of the line.
+    """
+
+    def __init__(self, stream, sections=DEFAULT_SECTIONS):
+        for section in sections:
+            if section not in SECTIONS:
+                raise ValueError("Unknown section %r" % section)
+        self.stream = stream
+        self.sections = [(encode_basestring_ascii(section) + u":",) + SECTIONS[section] for section in sections]
+        self._lock = Lock()
+
+    def handler(self, address):
+        """ Return a snapshot handler for the server at `address`, for
+        attaching to its monitor.
+        """
+
+        def f(data):
+            if data is not None:
+                self.write(address, data)
+
+        return f
+
+    def error_handler(self, address):
+        """ Return an error handler for the server at `address`, which
+        writes a line describing the error.
+        """
+
+        def f(error):
+            self.write_line(u'{"address":%s,"error":%s}\n' % (_text(address), _text(error)))
+
+        return f
+
+    def write(self, address, data):
+        parts = [u'{"address":', _text(address), u',"t":', _number(data.collected_at)]
+        for key, attr, encode in self.sections:
+            if getattr(data, attr, None) is not None:
+                parts.append(u",")
+                parts.append(key)
+                encode(parts, data)
+        parts.append(u"}\n")
+        self.write_line(u"".join(parts))
+
+    def write_line(self, line):
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+def run(addresses, auth, stream, sections=DEFAULT_SECTIONS):
+    """ Monitor the servers at the addresses given, writing JSON Lines to
+    `stream` until interrupted.
+    """
+    from agentsmith.monitor import ServerMonitor
+    writer = JsonLinesWriter(stream, sections)
+    monitors = []
+    try:
+        for address in addresses:
+            host, _, port = address.partition(":")
+            address = "%s:%s" % (host or "localhost", port or 7687)
+            monitor = ServerMonitor(address, auth, on_error=writer.error_handler(address))
+            monitor.attach(writer.handler(address))
+            monitors.append(monitor)
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for monitor in monitors:
+            monitor.exit()
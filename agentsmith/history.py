@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bounded, in-memory time series of numeric metrics. Memory use is fixed
+when the store is created and does not grow with session length.
+"""
+
+from __future__ import division
+
+from array import array
+from threading import Lock
+
+
+# (resolution in seconds, number of points) for each tier: one second
+# points for ten minutes, then ten second points for six hours
+DEFAULT_TIERS = ((1, 600), (10, 2160))
+
+
+def _value(data, section, attr):
+    value = getattr(getattr(data, section, None), attr, None)
+    return None if value is None else value.value
+
+
+def _rate(name):
+    def f(data):
+        return None if data.rates is None else data.rates.rate(name)
+    return f
+
+
+# Numeric metrics extracted from each snapshot, by name
+METRICS = {
+    u"process_cpu_load": lambda data: _value(data, u"system", u"process_cpu_load"),
+    u"system_cpu_load": lambda data: _value(data, u"system", u"system_cpu_load"),
+    u"heap_used": lambda data: _value(data, u"memory", u"used_heap_memory_size"),
+    u"heap_committed": lambda data: _value(data, u"memory", u"committed_heap_memory_size"),
+    u"total_store_size": lambda data: _value(data, u"storage", u"total_store_size"),
+    u"open_transactions": lambda data: _value(data, u"transactions", u"open_count"),
+    u"waiting_transactions": lambda data: _value(data, u"lock_waits", u"waiting_count"),
+    u"commits_per_second": _rate(u"commits"),
+    u"rollbacks_per_second": _rate(u"rollbacks"),
+    u"lock_waits_per_second": _rate(u"lock_waits"),
+    u"page_faults_per_second": _rate(u"page_faults"),
+    u"bytes_read_per_second": _rate(u"bytes_read"),
+    u"bytes_written_per_second": _rate(u"bytes_written"),
+    u"hit_ratio": lambda data: None if data.rates is None else data.rates.hit_ratio,
+}
+
+
+class RingBuffer(object):
+    """ Fixed-capacity buffer of (time, value) points, backed by two
+    preallocated arrays of doubles.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._times = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, value):
+        self._times[self._next] = t
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def last(self):
+        if self._count == 0:
+            return None
+        i = (self._next - 1) % self.capacity
+        return self._times[i], self._values[i]
+
+    def points(self, since=None):
+        """ Return all points (oldest first) at or after the time given.
+        Only the points returned are visited, working backwards from the
+        newest.
+        """
+        points = []
+        i = self._next
+        for _ in range(self._count):
+            i = (i - 1) % self.capacity
+            t = self._times[i]
+            if since is not None and t < since:
+                break
+            points.append((t, self._values[i]))
+        points.reverse()
+        return points
+
+
+class Series(object):
+    """ A single metric, held at several resolutions. Each tier above the
+    first is a downsampled copy of the raw points, with each point the
+    mean of all samples in its bucket.
+    """
+
+    def __init__(self, tiers=DEFAULT_TIERS):
+        self.tiers = tuple(tiers)
+        self._buffers = [RingBuffer(size) for _, size in self.tiers]
+        # Open bucket per downsampled tier: [bucket start, sum, count]
+        self._buckets = [None] * len(self.tiers)
+
+    def append(self, t, value):
+        for i, (resolution, _) in enumerate(self.tiers):
+            if i == 0:
+                self._buffers[0].append(t, value)
+                continue
+            start = t - t % resolution
+            bucket = self._buckets[i]
+            if bucket is not None and bucket[0] != start:
+                self._buffers[i].append(bucket[0], bucket[1] / bucket[2])
+                bucket = None
+            if bucket is None:
+                self._buckets[i] = [start, value, 1]
+            else:
+                bucket[1] += value
+                bucket[2] += 1
+
+    def last(self):
+        return self._buffers[0].last()
+
+    def window(self, seconds, now):
+        """ Return the points covering the last `seconds` seconds, from
+        the finest tier that retains that much history.
+        """
+        since = now - seconds
+        for (resolution, size), buffer in zip(self.tiers, self._buffers):
+            if resolution * size >= seconds:
+                return buffer.points(since)
+        return self._buffers[-1].points(since)
+
+
+class MetricHistory(object):
+    """ Time series of every metric in :data:`METRICS` for one server.
+    """
+
+    def __init__(self, tiers=DEFAULT_TIERS):
+        self.tiers = tuple(tiers)
+        self._lock = Lock()
+        self._series = {name: Series(self.tiers) for name in METRICS}
+        self._last_time = None
+
+    def __contains__(self, name):
+        return name in self._series
+
+    @property
+    def last_time(self):
+        return self._last_time
+
+    def append(self, data):
+        """ Extract every metric from a snapshot and add it to the store.
+        Metrics that are missing from the snapshot are skipped.
+        """
+        t = data.collected_at
+        if t is None:
+            return
+        with self._lock:
+            for name, extract in METRICS.items():
+                try:
+                    value = extract(data)
+                except AttributeError:
+                    value = None
+                if value is not None:
+                    self._series[name].append(t, float(value))
+            self._last_time = t
+
+    def last(self, name):
+        with self._lock:
+            return self._series[name].last()
+
+    def window(self, name, seconds, now=None):
+        """ Return (time, value) points for a metric over the last
+        `seconds` seconds, oldest first.
+        """
+        with self._lock:
+            if now is None:
+                now = self._last_time
+            if now is None:
+                return []
+            return self._series[name].window(seconds, now)
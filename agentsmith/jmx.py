@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import division
+
+
+JMX_OPERATING_SYSTEM = u"java.lang:type=OperatingSystem"
+JMX_RUNTIME = u"java.lang:type=Runtime"
+JMX_THREADING = u"java.lang:type=Threading"
+JMX_MEMORY = u"java.lang:type=Memory"
+JMX_CONFIGURATION = u"org.neo4j:instance=kernel#0,name=Configuration"
+JMX_KERNEL = u"org.neo4j:instance=kernel#0,name=Kernel"
+JMX_STORE_SIZES = u"org.neo4j:instance=kernel#0,name=Store sizes"
+JMX_PRIMITIVE_COUNT = u"org.neo4j:instance=kernel#0,name=Primitive count"
+JMX_TRANSACTIONS = u"org.neo4j:instance=kernel#0,name=Transactions"
+JMX_PAGE_CACHE = u"org.neo4j:instance=kernel#0,name=Page cache"
+JMX_CAUSAL_CLUSTERING = u"org.neo4j:instance=kernel#0,name=Causal Clustering"
+JMX_LOCKING = u"org.neo4j:instance=kernel#0,name=Locking"
+
+JMX_ALL = u"*:*"
+
+
+def estimate_size(value):
+    """ Estimate the number of bytes taken on the wire by a value
+    returned over Bolt. This follows the PackStream encoding closely
+    enough to compare two payloads, without actually packing either.
+    """
+    if value is None or isinstance(value, bool):
+        return 1
+    elif isinstance(value, int):
+        return 1 if -16 <= value < 128 else 9
+    elif isinstance(value, float):
+        return 9
+    elif isinstance(value, (bytes, bytearray)):
+        return 5 + len(value)
+    elif isinstance(value, (list, tuple)):
+        return 5 + sum(map(estimate_size, value))
+    elif isinstance(value, dict):
+        return 5 + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    else:
+        return 5 + len(u"%s" % value)
+
+
+# Attributes kept of MBeans that also carry bulky attributes which are
+# never used; the Locking MBean lists every lock held on the server
+JMX_TRIMMED = {
+    JMX_LOCKING: (u"NumberOfAvertedDeadlocks",),
+}
+
+
+def _trimmed_attributes(trimmed):
+    """ Return a Cypher expression for the `attributes` of the MBean named
+    `mbean`, projected down to the attributes in `trimmed` for the MBeans
+    listed there.
+    """
+    if not trimmed:
+        return u"attributes"
+    cases = u" ".join(u"WHEN '%s' THEN attributes {%s}" % (name, u", ".join(u"." + key for key in keys))
+                      for name, keys in sorted(trimmed.items()))
+    return u"CASE mbean %s ELSE attributes END" % cases
+
+
+class JmxProjection(object):
+    """ A fixed selection of MBeans, fetched from the server in a single
+    `dbms.queryJmx` call per tick instead of pulling every MBean with
+    `*:*` and discarding most of them.
+
+    The first fetch also pulls the full MBean set, once only, so that the
+    number of bytes saved by the projection can be reported for every
+    subsequent tick. This is not repeated on reconnection, as it is the
+    very call that the projection exists to avoid.
+
+    MBeans in `JMX_TRIMMED` are also cut down, on the server, to the
+    attributes actually used.
+    """
+
+    statement = (u"UNWIND $names AS name "
+                 u"CALL dbms.queryJmx(name) YIELD name AS mbean, attributes "
+                 u"RETURN mbean AS name, " + _trimmed_attributes(JMX_TRIMMED) + u" AS attributes")
+
+    def __init__(self, *names):
+        self.names = []
+        for name in names:
+            self.add(name)
+        self.full_size = None
+        self.size = None
+
+    def __repr__(self):
+        return "<JmxProjection names=%r>" % self.names
+
+    def add(self, *names):
+        for name in names:
+            if name not in self.names:
+                self.names.append(name)
+
+    def fetch(self, tx, names=None):
+        """ Fetch the projected MBeans (or the subset given in `names`)
+        within the transaction supplied.
+
+        :return: list of dictionaries with `name` and `attributes` keys
+        """
+        if self.full_size is None:
+            self.full_size = estimate_size(tx.run(u"CALL dbms.queryJmx($name)", name=JMX_ALL).data())
+        return self.receive(self.submit(tx, names))
+
+    def submit(self, tx, names=None):
+        """ Run the projection without waiting for its result, so that
+        further statements can be pipelined behind it.
+
+        :return: the pending result, to be passed to :meth:`.receive`
+        """
+        return tx.run(self.statement, names=list(self.names if names is None else names))
+
+    def receive(self, result):
+        """ Wait for and return the records of a pending result.
+        """
+        records = result.data()
+        self.size = estimate_size(records)
+        return records
+
+    def reset(self):
+        """ Forget the size of the last fetch. This should be called on
+        reconnection. The full payload size is kept, as it is measured
+        only once.
+        """
+        self.size = None
+
+    @property
+    def bytes_saved(self):
+        """ The estimated number of bytes saved on the last tick, compared
+        with fetching every MBean.
+        """
+        if self.full_size is None or self.size is None:
+            return None
+        return self.full_size - self.size
+
+
+def parse_object_name(name):
+    """ Split a JMX object name into its domain and a dictionary of key
+    properties, e.g. `java.lang:type=GarbageCollector,name=G1 Young Generation`
+    becomes `("java.lang", {"type": "GarbageCollector", "name": "G1 Young Generation"})`.
+    """
+    domain, _, key_properties = name.partition(u":")
+    properties = {}
+    key, value, quoted = [], [], False
+    target = key
+    for ch in key_properties:
+        if ch == u'"':
+            quoted = not quoted
+            target.append(ch)
+        elif quoted:
+            target.append(ch)
+        elif ch == u"=" and target is key:
+            target = value
+        elif ch == u",":
+            properties[u"".join(key)] = u"".join(value)
+            key, value = [], []
+            target = key
+        else:
+            target.append(ch)
+    if key:
+        properties[u"".join(key)] = u"".join(value)
+    return domain, properties
+
+
+class JmxSection(object):
+    """ A single MBean from a JMX result. The attributes are flattened
+    from their `{"value": ..., "description": ...}` form on first access,
+    unless already-flattened values are supplied instead.
+    """
+
+    def __init__(self, name, attributes=None, values=None):
+        self.name = name
+        self.domain, self.properties = parse_object_name(name)
+        self.__attributes = attributes
+        self.__values = values
+
+    def __repr__(self):
+        return "<JmxSection name=%r>" % self.name
+
+    @property
+    def values(self):
+        if self.__values is None:
+            self.__values = {key: value[u"value"] for key, value in self.__attributes.items()}
+        return self.__values
+
+
+class JmxIndex(object):
+    """ Index over a single JMX result, built once per snapshot. Sections
+    can be looked up by full object name, or matched against an object
+    name pattern such as `java.lang:type=GarbageCollector,*`.
+    """
+
+    def __init__(self, records=()):
+        self.__by_name = {}
+        self.__by_domain = {}
+        self.__by_property = {}
+        self.add(records)
+
+    @classmethod
+    def from_values(cls, values):
+        """ Build an index from a dictionary of object name to flattened
+        attributes, as held in :attr:`ServerData.sources`.
+        """
+        inst = cls()
+        for name, attributes in values.items():
+            inst.__add_section(JmxSection(name, values=attributes))
+        return inst
+
+    def add(self, records):
+        """ Add further records to the index, such as those fetched by a
+        follow-up query within the same snapshot.
+        """
+        for record in records:
+            self.__add_section(JmxSection(record[u"name"], record[u"attributes"]))
+
+    def __add_section(self, section):
+        self.__by_name[section.name] = section
+        self.__by_domain.setdefault(section.domain, []).append(section)
+        for item in section.properties.items():
+            self.__by_property.setdefault((section.domain,) + item, []).append(section)
+
+    def __len__(self):
+        return len(self.__by_name)
+
+    def __contains__(self, name):
+        return name in self.__by_name
+
+    def __iter__(self):
+        return iter(self.__by_name.values())
+
+    def get(self, name):
+        """ Return the flattened attributes of the named MBean, or
+        :const:`None` if no such MBean was returned.
+        """
+        try:
+            return self.__by_name[name].values
+        except KeyError:
+            return None
+
+    def match(self, pattern):
+        """ Return all sections whose object names match the pattern
+        given. Only a trailing `*` property wildcard and a `*` domain
+        are supported, as these cover the patterns used in practice.
+        """
+        domain, _, key_properties = pattern.partition(u":")
+        wildcard = key_properties == u"*" or key_properties.endswith(u",*")
+        if wildcard:
+            key_properties = key_properties[:-1].rstrip(u",")
+        _, properties = parse_object_name(u":" + key_properties)
+        properties.pop(u"", None)
+        if domain == u"*":
+            candidates = list(self)
+        elif properties:
+            # Start from the smallest candidate set available
+            candidates = min((self.__by_property.get((domain,) + item, []) for item in properties.items()),
+                             key=len)
+        else:
+            candidates = self.__by_domain.get(domain, [])
+        return [section for section in candidates
+                if all(section.properties.get(key) == value for key, value in properties.items())
+                and (wildcard or len(section.properties) == len(properties))]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Killing of transactions, apart from monitoring.
+
+Each monitor hands the transactions to be killed to its own
+:class:`.KillWorker`, which kills them on a thread and connection of its
+own, so that a slow or failed kill never holds up or breaks a poll.
+"""
+
+from collections import namedtuple, OrderedDict
+from sys import stderr
+from threading import Condition, Thread
+from traceback import print_exception
+
+from neo4j.v1 import GraphDatabase, CypherError, ServiceUnavailable, SessionExpired
+
+
+# Kill outcomes
+KILLED = u"killed"
+NOT_FOUND = u"not found"
+QUERY_CHANGED = u"query changed"
+NO_QUERY = u"no query"
+FAILED = u"failed"
+
+KillResult = namedtuple("KillResult", ["transaction_id", "query_id", "outcome", "message"])
+
+
+class KillWorker(object):
+    """ Kills transactions for a single server, batching every request
+    queued since the last batch into a single `dbms.killQueries` call.
+
+    A transaction is killed by killing its current query, as identified
+    when the kill was requested. If the latest snapshot shows that the
+    transaction has since moved on to another query, it is left alone.
+    Requests for a query that is already queued are dropped.
+
+    :param uri: URI of the server
+    :param auth: authentication details
+    :param latest: function returning the latest :class:`.ServerData`
+        snapshot of the server, or :const:`None`
+    :param report: function called with a list of :class:`.KillResult`
+        objects after each batch
+    """
+
+    statement = (u"CALL dbms.killQueries($ids) YIELD queryId, username, message "
+                 u"RETURN queryId, username, message")
+
+    def __init__(self, uri, auth, latest, report):
+        self.uri = uri
+        self.auth = auth
+        self.latest = latest
+        self.report = report
+        self._cond = Condition()
+        self._queue = OrderedDict()
+        self._in_flight = set()
+        self._running = True
+        self._driver = None
+        self._thread = None
+
+    def __repr__(self):
+        return "<KillWorker uri=%r>" % self.uri
+
+    def submit(self, transactions):
+        """ Queue transactions to be killed.
+        """
+        results = []
+        with self._cond:
+            if not self._running:
+                return
+            for tx in transactions:
+                query_id = tx.raw(u"current_query_id")
+                if not query_id:
+                    results.append(KillResult(tx.id, None, NO_QUERY, u"Transaction is not running a query"))
+                elif query_id not in self._queue and query_id not in self._in_flight:
+                    self._queue[query_id] = tx.id
+            if self._queue:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name="agentsmith-killer", daemon=True)
+                    self._thread.start()
+                self._cond.notify_all()
+        if results:
+            self.report(results)
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self._close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                batch, self._queue = self._queue, OrderedDict()
+                self._in_flight.update(batch)
+            try:
+                results = self._kill(batch)
+            except Exception as error:
+                # Keep the worker alive for later batches, whatever went
+                # wrong with this one
+                self._close()
+                results = [KillResult(tx_id, query_id, FAILED, u"%s" % error) for query_id, tx_id in batch.items()]
+            finally:
+                with self._cond:
+                    self._in_flight.difference_update(batch)
+            try:
+                self.report(results)
+            except Exception as error:
+                # A failing handler must not stop later kills either
+                print_exception(type(error), error, error.__traceback__, file=stderr)
+
+    def _kill(self, batch):
+        """ Kill a batch of queries, given as an ordered dictionary of query
+        ID to transaction ID, and return the outcome for each.
+        """
+        results = []
+        current = {}
+        data = self.latest()
+        if data is not None and data.transactions is not None:
+            current = {tx.id: tx.raw(u"current_query_id") for tx in data.transactions}
+        query_ids = []
+        for query_id, tx_id in batch.items():
+            if current.get(tx_id, query_id) != query_id:
+                results.append(KillResult(tx_id, query_id, QUERY_CHANGED,
+                                          u"Transaction has moved on to %s" % current[tx_id]))
+            else:
+                query_ids.append(query_id)
+        if not query_ids:
+            return results
+        try:
+            if self._driver is None:
+                self._driver = GraphDatabase.driver(self.uri, auth=self.auth, max_retry_time=1.0)
+            with self._driver.session() as session:
+                records = session.run(self.statement, {u"ids": query_ids}).data()
+        except (CypherError, ServiceUnavailable, SessionExpired) as error:
+            if not isinstance(error, CypherError):
+                self._close()
+            for query_id in query_ids:
+                results.append(KillResult(batch[query_id], query_id, FAILED, u"%s" % error))
+            return results
+        messages = {record[u"queryId"]: record[u"message"] for record in records}
+        for query_id in query_ids:
+            message = messages.get(query_id)
+            if message == u"Query found":
+                results.append(KillResult(batch[query_id], query_id, KILLED, message))
+            else:
+                results.append(KillResult(batch[query_id], query_id, NOT_FOUND,
+                                          message or u"No query found with this id"))
+        return results
+
+    def _close(self):
+        if self._driver is not None:
+            try:
+                self._driver.close()
+            except (CypherError, ServiceUnavailable, SessionExpired):
+                pass
+            self._driver = None
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lock contention, as a wait-for graph of transactions.
+
+Neo4j 3.4 and above report a transaction that is waiting for a lock with
+a status such as "Blocked by: [transaction-12, transaction-15]", which
+gives the edges of the graph without any further queries. The locks
+held by the transactions involved can then be listed with
+`dbms.listActiveLocks`, one query at a time, so this is only done for
+transactions that are waiting or being waited on.
+"""
+
+from __future__ import division
+
+from collections import deque
+import re
+
+from agentsmith.tracking import ListData
+from agentsmith.units import Amount, Time
+
+
+_BLOCKED_BY = u"Blocked by: "
+_TRANSACTION_ID = re.compile(r"transaction-(\d+)")
+
+# Statement listing the locks held by each of the queries in `$ids`
+LIST_LOCKS = (u"UNWIND $ids AS queryId CALL dbms.listActiveLocks(queryId) YIELD mode, resourceType, resourceId "
+              u"RETURN queryId, mode, resourceType, resourceId")
+
+# Maximum number of queries for which held locks are listed on each tick
+MAX_LOCK_QUERIES = 50
+
+# Roles of transactions in the wait-for graph
+ROOT = u"root"
+CYCLE = u"cycle"
+WAITING = u"waiting"
+
+
+def blocker_ids(status):
+    """ Return the IDs of the transactions that a transaction with the
+    status given is waiting for, or an empty list if it is not waiting.
+    """
+    if status and status.startswith(_BLOCKED_BY):
+        return [int(tx_id) for tx_id in _TRANSACTION_ID.findall(status)]
+    return []
+
+
+def describe_wait(resource_information):
+    """ Describe the lock a transaction is waiting for, such as
+    "EXCLUSIVE NODE(42)", from its resource information.
+    """
+    info = resource_information or {}
+    resource_type = info.get(u"resourceType")
+    if not resource_type:
+        return u""
+    resource_ids = info.get(u"resourceIds") or []
+    text = u"%s %s(%s)" % (info.get(u"lockMode") or u"", resource_type,
+                           u",".join(u"%s" % resource_id for resource_id in resource_ids[:3]))
+    if len(resource_ids) > 3:
+        text += u"+%d" % (len(resource_ids) - 3)
+    return text.strip()
+
+
+def describe_locks(locks):
+    """ Summarise a list of (mode, resource type, resource ID) locks as
+    counts by mode and resource type, such as "EXCLUSIVE NODE x3".
+    """
+    counts = {}
+    for mode, resource_type, _ in locks:
+        key = u"%s %s" % (mode, resource_type)
+        counts[key] = counts.get(key, 0) + 1
+    return u", ".join(u"%s x%d" % (key, count) if count > 1 else key
+                      for key, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+class LockWaitData(object):
+    """ A single transaction in the wait-for graph.
+
+    The transaction itself may be :const:`None` if it blocks others but
+    was not fetched (for instance, because of a
+    :class:`agentsmith.monitor.TransactionView` limit).
+    """
+
+    __slots__ = ["id", "transaction", "role", "depth", "blocker_ids", "blocked_count", "held_locks"]
+
+    def __init__(self, tx_id, transaction, role, depth, blocker_ids, blocked_count, held_locks):
+        self.id = tx_id
+        self.transaction = transaction
+        self.role = role
+        self.depth = depth
+        self.blocker_ids = blocker_ids
+        self.blocked_count = blocked_count
+        self.held_locks = held_locks
+
+    def __repr__(self):
+        return "<LockWaitData id=%r role=%r depth=%r blocked_count=%r>" % (
+            self.id, self.role, self.depth, self.blocked_count)
+
+    def _tx_raw(self, name):
+        return None if self.transaction is None else self.transaction.raw(name)
+
+    @property
+    def user(self):
+        return self._tx_raw(u"user")
+
+    @property
+    def wait_time(self):
+        """ Time spent waiting so far, by the transaction as a whole.
+        """
+        return Time(ms=self._tx_raw(u"wait_time"))
+
+    @property
+    def active_lock_count(self):
+        return Amount(self._tx_raw(u"active_lock_count"))
+
+    @property
+    def waiting_for(self):
+        """ Description of the lock being waited for, if known.
+        """
+        return describe_wait(self._tx_raw(u"resource_information"))
+
+    @property
+    def current_query(self):
+        return self._tx_raw(u"current_query") or u""
+
+    def raw(self, name):
+        """ Return the raw, undecoded value behind an attribute, which is
+        cheap to compare between snapshots.
+        """
+        if name in (u"wait_time", u"active_lock_count", u"current_query", u"current_query_id",
+                    u"resource_information"):
+            return self._tx_raw(name)
+        return getattr(self, name)
+
+
+class LockWaitListData(ListData):
+    """ Wait-for graph of the transactions on a server, in display order:
+    each root blocker (a transaction that blocks others while not waiting
+    itself) followed by the transactions waiting on it, breadth first,
+    with the roots blocking most transactions first. Deadlock cycles,
+    and the transactions waiting on them, come after the roots. A
+    transaction waiting on more than one root is listed once, under the
+    first, but counted as blocked by each.
+
+    :ivar waiting_count: number of transactions waiting for a lock
+    :ivar root_count: number of root blockers
+    :ivar cycles: lists of IDs of transactions waiting on one another
+    :ivar longest_chain: most transactions in a single chain of waits,
+        counting the blocker at its head
+    :ivar wait_count: total number of waits seen since monitoring began,
+        counting each query of a transaction once
+    """
+
+    def __init__(self, items, waiting_count, root_count, cycles, longest_chain, wait_count):
+        super(LockWaitListData, self).__init__(items)
+        self.waiting_count = Amount(waiting_count)
+        self.root_count = Amount(root_count)
+        self.cycles = cycles
+        self.longest_chain = Amount(longest_chain)
+        self.wait_count = Amount(wait_count)
+
+    def __repr__(self):
+        return "<LockWaitListData waiting_count=%r root_count=%r cycles=%r>" % (
+            self.waiting_count, self.root_count, len(self.cycles))
+
+    @property
+    def cycle_count(self):
+        return Amount(len(self.cycles))
+
+    def query_ids(self, limit=MAX_LOCK_QUERIES):
+        """ Return the IDs of the current queries of the transactions in
+        the graph, root blockers first, for which to list held locks.
+        """
+        query_ids = []
+        seen = set()
+        for item in self._items:
+            query_id = item.raw(u"current_query_id")
+            if query_id and query_id not in seen:
+                seen.add(query_id)
+                query_ids.append(query_id)
+                if len(query_ids) == limit:
+                    break
+        return query_ids
+
+
+def _cycles(edges):
+    """ Find the strongly connected components of a wait-for graph (as a
+    dictionary of waiter to blockers) that form cycles, using an
+    iterative form of Tarjan's algorithm.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    counter = 0
+    for start in edges:
+        if start in index:
+            continue
+        work = [(start, iter(edges.get(start, ())))]
+        index[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack.add(start)
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = low[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges.get(successor, ()))))
+                    break
+                elif successor in on_stack:
+                    low[node] = min(low[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in edges.get(node, ()):
+                        cycles.append(sorted(component))
+    return cycles
+
+
+class LockWaitTracker(object):
+    """ Builds :class:`.LockWaitListData` for a single server from the
+    transaction list in each snapshot, together with the locks held by
+    the transactions involved, where these have been listed.
+
+    Only the transactions fetched are seen, so when the list is limited
+    on the server, waiters may be missed and blockers may appear without
+    any details.
+    """
+
+    def __init__(self):
+        self._waits = set()
+        self._wait_count = 0
+        self._updated = None
+        self._data = None
+
+    def update(self, data, locks=None):
+        """ Build the wait-for graph for a snapshot.
+
+        :param data: :class:`agentsmith.monitor.ServerData` snapshot
+        :param locks: rows from `dbms.listActiveLocks`, each with
+            `queryId`, `mode`, `resourceType` and `resourceId`, or
+            :const:`None`
+        """
+        transactions = data.transactions
+        if transactions is None:
+            return None
+        updated = (data.updated or {}).get(u"transactions")
+        if self._data is not None and updated == self._updated and locks is None:
+            return self._data
+        by_id = {}
+        edges = {}
+        waits = set()
+        for tx in transactions:
+            status = tx.raw(u"status")
+            if status and status.startswith(_BLOCKED_BY):
+                tx_id = tx.id
+                edges[tx_id] = blocker_ids(status)
+                by_id[tx_id] = tx
+                waits.add((tx_id, tx.raw(u"current_query_id")))
+        if edges:
+            blocking = {blocker for blockers in edges.values() for blocker in blockers}
+            for tx in transactions:
+                if tx.id in blocking:
+                    by_id[tx.id] = tx
+        self._wait_count += len(waits - self._waits)
+        self._waits = waits
+        self._updated = updated
+        self._data = self._build(edges, by_id, self._held_locks(locks))
+        return self._data
+
+    def _held_locks(self, locks):
+        held = {}
+        for row in locks or ():
+            held.setdefault(row[u"queryId"], []).append((row[u"mode"], row[u"resourceType"], row[u"resourceId"]))
+        return {query_id: describe_locks(query_locks) for query_id, query_locks in held.items()}
+
+    def _build(self, edges, by_id, held):
+        waiters = {}
+        for waiter, blockers in edges.items():
+            for blocker in blockers:
+                waiters.setdefault(blocker, []).append(waiter)
+        cycles = _cycles(edges)
+        in_cycle = {member for cycle in cycles for member in cycle}
+        roots = [blocker for blocker in waiters if blocker not in edges]
+        placed = set()
+        longest_chain = 0
+
+        def reach(heads):
+            # Number of transactions waiting, directly or not, on the heads
+            # of a group, and the length of the longest chain of waits
+            seen = set(heads)
+            queue = deque((head, 0) for head in heads)
+            depth = 0
+            while queue:
+                tx_id, depth = queue.popleft()
+                for waiter in waiters.get(tx_id, ()):
+                    if waiter not in seen:
+                        seen.add(waiter)
+                        queue.append((waiter, depth + 1))
+            return len(seen) - len(heads), depth + 1
+
+        def walk(heads, role):
+            # Breadth first from the heads of a group, placing each
+            # transaction under the first group to reach it
+            rows = []
+            queue = deque((head, 0) for head in heads)
+            placed.update(heads)
+            while queue:
+                tx_id, depth = queue.popleft()
+                rows.append((tx_id, role if depth == 0 else WAITING, depth))
+                for waiter in sorted(waiters.get(tx_id, ())):
+                    if waiter not in placed:
+                        placed.add(waiter)
+                        queue.append((waiter, depth + 1))
+            return rows
+
+        ranked = []
+        for root in roots:
+            blocked, chain = reach([root])
+            longest_chain = max(longest_chain, chain)
+            tx = by_id.get(root)
+            elapsed_time = 0 if tx is None else tx.raw(u"elapsed_time") or 0
+            ranked.append((-blocked, -elapsed_time, root, blocked))
+        ranked.sort()
+        groups = [(walk([root], ROOT), blocked) for _, _, root, blocked in ranked]
+        for cycle in cycles:
+            if not placed.issuperset(cycle):
+                blocked, chain = reach(cycle)
+                longest_chain = max(longest_chain, chain)
+                groups.append((walk(cycle, CYCLE), blocked))
+
+        items = []
+        for rows, blocked in groups:
+            for tx_id, role, depth in rows:
+                tx = by_id.get(tx_id)
+                query_id = None if tx is None else tx.raw(u"current_query_id")
+                items.append(LockWaitData(tx_id, tx, CYCLE if tx_id in in_cycle else role, depth,
+                                          edges.get(tx_id, []), blocked if depth == 0 else 0,
+                                          held.get(query_id, u"")))
+        return LockWaitListData(items, len(edges), len(roots), cycles, longest_chain, self._wait_count)
+
+    def reset(self):
+        self._waits = set()
+        self._wait_count = 0
+        self._updated = None
+        self._data = None
@@ -18,14 +18,27 @@
 
 from __future__ import division
 
-from collections import deque
-from datetime import datetime
+from collections import Counter
+from copy import copy
+from functools import partial
+from sys import stderr
 from threading import Thread, Lock
-from time import sleep
+from time import sleep, time, monotonic
+from traceback import print_exception
 
 from neo4j.v1 import GraphDatabase, CypherError, ServiceUnavailable, READ_ACCESS, SessionExpired
 from neo4j.compat import urlparse
 
+from agentsmith.accounts import AccountTracker
+from agentsmith.history import MetricHistory, DEFAULT_TIERS
+from agentsmith.jmx import JmxIndex, JmxProjection, JMX_OPERATING_SYSTEM, JMX_RUNTIME, JMX_THREADING, JMX_MEMORY, \
+    JMX_CONFIGURATION, JMX_KERNEL, JMX_STORE_SIZES, JMX_PRIMITIVE_COUNT, JMX_TRANSACTIONS, JMX_PAGE_CACHE, \
+    JMX_CAUSAL_CLUSTERING, JMX_LOCKING
+from agentsmith.killer import KillWorker
+from agentsmith.locks import LIST_LOCKS, LockWaitTracker
+from agentsmith.rates import RateTracker
+from agentsmith.schedule import Schedule
+from agentsmith.statements import StatementTracker
 from agentsmith.units import Load, BytesAmount, Time, Product, Amount
 
 
@@ -39,45 +52,158 @@ def nested_get(d, *keys):
         return d
 
 
-class SystemData(object):
+def millis(value):
+    return Time(ms=value)
+
+
+def serial_number(value):
+    """ Extract the number from an ID string such as "transaction-96".
+    """
+    if value:
+        return int(value.partition("-")[-1])
+    else:
+        return None
+
+
+class RecordField(object):
+    """ Attribute backed by a single field of a raw record, decoded on
+    first access and then kept in a slot of the same name with a leading
+    underscore. The owning class must declare both `_record` and that
+    slot in `__slots__`. Assigning to the attribute replaces the decoded
+    value.
+    """
+
+    def __init__(self, key, decode=None):
+        self.key = key
+        self.decode = decode
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.slot = "_" + name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.slot)
+        except AttributeError:
+            value = instance._record[self.key]
+            if self.decode is not None:
+                value = self.decode(value)
+            setattr(instance, self.slot, value)
+            return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.slot, value)
+
+    def raw(self, instance):
+        """ Return the undecoded field value from the record.
+        """
+        return instance._record[self.key]
+
+
+class ServerFacts(object):
+    """ Facts about a server that cannot change while it is running. These
+    are collected once per connection and reused on every subsequent
+    poll until either the connection is lost or a change in kernel start
+    time shows that the server has been restarted.
+    """
+
+    jmx = (JMX_CONFIGURATION,)
 
     os = None
     jvm = None
     dbms = None
+    available_processors = None
+    store_id = None
+    store_creation_date = None
+    kernel_start_time = None
 
     _editions = {
         u"community": u"CE",
         u"enterprise": u"EE",
     }
 
-    def __init__(self, os, java_runtime, java_threading, dbms_components, dbms_kernel, dbms_config):
+    def __init__(self, os, java_runtime, dbms_components, dbms_kernel, dbms_config):
+        # Keep just the raw values used here, so that the facts can be
+        # recorded and rebuilt later
+        self.sources = {
+            u"os": {key: os[key] for key in (u"Name", u"Version", u"Arch", u"AvailableProcessors")} if os else None,
+            u"java_runtime": {key: java_runtime[key] for key in (u"VmName", u"SpecVersion")} if java_runtime else None,
+            u"dbms_components": dbms_components,
+            u"dbms_kernel": {key: dbms_kernel[key] for key in (u"KernelStartTime", u"StoreId", u"StoreCreationDate")}
+            if dbms_kernel else None,
+            u"dbms_config": {u"dbms.mode": dbms_config[u"dbms.mode"]} if dbms_config and u"dbms.mode" in dbms_config
+            else None,
+        }
         if os:
             self.os = Product(os[u"Name"], os[u"Version"], arch=os[u"Arch"])
             self.available_processors = Amount(os[u"AvailableProcessors"])
+        if java_runtime:
+            self.jvm = Product(java_runtime[u"VmName"], java_runtime[u"SpecVersion"])
+        if dbms_kernel:
+            self.kernel_start_time = dbms_kernel[u"KernelStartTime"]
+            self.store_id = dbms_kernel[u"StoreId"]
+            self.store_creation_date = dbms_kernel[u"StoreCreationDate"]    # TODO
+        if dbms_components:
+            dbms_component = dbms_components[0]
+            dbms_component_name = dbms_component[u"name"]
+            if dbms_component_name == "Neo4j Kernel":
+                dbms_component_name = "Neo4j"
+            self.dbms = Product(dbms_component_name,
+                                dbms_component[u"versions"][0],
+                                edition=self._editions[dbms_component[u"edition"]],
+                                mode=(dbms_config or {}).get(u"dbms.mode", u"SINGLE"))
+
+    def __repr__(self):
+        s = ["Facts:"]
+        for attr in sorted(dir(self)):
+            if not attr.startswith("_") and attr != "sources" and not callable(getattr(self, attr)):
+                s.append("    %s: %r" % (attr, getattr(self, attr)))
+        return "\n".join(s)
+
+    def is_current(self, dbms_kernel):
+        """ Check whether these facts still describe the server, given its
+        current Kernel MBean.
+        """
+        return bool(dbms_kernel) and dbms_kernel[u"KernelStartTime"] == self.kernel_start_time
+
+
+class SystemData(object):
+
+    jmx = (JMX_OPERATING_SYSTEM, JMX_RUNTIME, JMX_THREADING, JMX_KERNEL)
+
+    os = None
+    jvm = None
+    jvm_uptime = None
+    dbms = None
+    dbms_uptime = None
+
+    def __init__(self, os, java_runtime, java_threading, dbms_kernel, facts, collected_at=None):
+        """
+        :param collected_at: collection timestamp (seconds since the
+            epoch) against which uptime is measured; defaults to now
+        """
+        self.os = facts.os
+        self.jvm = facts.jvm
+        self.dbms = facts.dbms
+        self.available_processors = facts.available_processors
+        if os:
             self.process_cpu_time = Time(ns=os[u"ProcessCpuTime"])
             self.process_cpu_load = Load(os[u"ProcessCpuLoad"])
             self.system_cpu_load = Load(os[u"SystemCpuLoad"])
             self.system_load_average = Load(os[u"SystemLoadAverage"])
         if java_runtime:
-            self.jvm = Product(java_runtime[u"VmName"], java_runtime[u"SpecVersion"],
-                               uptime=Time(ms=java_runtime[u"Uptime"]))
+            self.jvm_uptime = Time(ms=java_runtime[u"Uptime"])
         if java_threading:
             self.daemon_thread_count = Amount(java_threading[u"DaemonThreadCount"])
             self.peak_thread_count = Amount(java_threading[u"PeakThreadCount"])
             self.thread_count = Amount(java_threading[u"ThreadCount"])
             self.total_started_thread_count = Amount(java_threading[u"TotalStartedThreadCount"])
-        if dbms_components:
+        if dbms_kernel:
             t0 = dbms_kernel[u"KernelStartTime"]
-            t1 = 1000 * datetime.now().timestamp()
-            dbms_component = dbms_components[0]
-            dbms_component_name = dbms_component[u"name"]
-            if dbms_component_name == "Neo4j Kernel":
-                dbms_component_name = "Neo4j"
-            self.dbms = Product(dbms_component_name,
-                                dbms_component[u"versions"][0],
-                                edition=self._editions[dbms_component[u"edition"]],
-                                mode=dbms_config.get(u"dbms.mode", u"SINGLE"),
-                                uptime=(Time(ms=(t1 - t0))))
+            t1 = 1000 * (time() if collected_at is None else collected_at)
+            self.dbms_uptime = Time(ms=(t1 - t0))
 
     def __repr__(self):
         s = ["System:"]
@@ -94,7 +220,7 @@ class SystemData(object):
                     major=self.dbms.version.major,
                     minor=self.dbms.version.minor,
                     dbms_edition=self.dbms.edition,
-                    dbms_uptime=self.dbms.uptime))
+                    dbms_uptime=self.dbms_uptime))
 
     def cpu_meter(self, size):
         process_load = int(round(size * self.process_cpu_load.value))
@@ -104,6 +230,8 @@ class SystemData(object):
 
 class MemoryData(object):
 
+    jmx = (JMX_OPERATING_SYSTEM, JMX_MEMORY)
+
     def __init__(self, os, java_memory):
         """
         TotalPhysicalMemorySize: 33588854784
@@ -144,7 +272,9 @@ class MemoryData(object):
 
 class StorageData(object):
 
-    def __init__(self, os, dbms_kernel, dbms_stores, dbms_primitives):
+    jmx = (JMX_OPERATING_SYSTEM, JMX_KERNEL, JMX_STORE_SIZES, JMX_PRIMITIVE_COUNT)
+
+    def __init__(self, os, dbms_kernel, dbms_stores, dbms_primitives, facts):
         """
         MaxFileDescriptorCount: 40000
         OpenFileDescriptorCount: 515
@@ -153,8 +283,8 @@ class StorageData(object):
         self.open_file_descriptor_count = Amount(os[u"OpenFileDescriptorCount"])
         self.database_name = dbms_kernel[u"DatabaseName"]
         self.read_only = dbms_kernel[u"ReadOnly"]
-        self.store_creation_date = dbms_kernel[u"StoreCreationDate"]    # TODO
-        self.store_id = dbms_kernel[u"StoreId"]
+        self.store_creation_date = facts.store_creation_date
+        self.store_id = facts.store_id
         self.array_store_size = BytesAmount(dbms_stores[u"ArrayStoreSize"])
         self.count_store_size = BytesAmount(dbms_stores[u"CountStoreSize"])
         self.index_store_size = BytesAmount(dbms_stores[u"IndexStoreSize"])
@@ -181,6 +311,8 @@ class StorageData(object):
 
 class QueryListData(object):
 
+    jmx = ()
+
     def __init__(self, queries):
         self.__items = list(map(QueryData, queries))
 
@@ -202,9 +334,8 @@ class QueryListData(object):
 
 
 class QueryData(object):
+    """ A single row from `dbms.listQueries`:
 
-    def __init__(self, query):
-        """
         'activeLockCount': 0,
         'allocatedBytes': None,
         'clientAddress': '127.0.0.1:46718',
@@ -228,30 +359,45 @@ class QueryData(object):
         'username': 'neo4j',
         'waitTimeMillis': 0,
 
-        :param query:
-        """
-        self.active_lock_count = Amount(query[u"activeLockCount"])
-        self.allocated_bytes = BytesAmount(query[u"allocatedBytes"])
-        self.client_address = query[u"clientAddress"]
-        self.cpu_time = Time(ms=query[u"cpuTimeMillis"])
-        self.elapsed_time = Time(ms=query[u"elapsedTimeMillis"])
-        self.idle_time = Time(ms=query[u"idleTimeMillis"])
-        self.wait_time = Time(ms=query[u"waitTimeMillis"])
-        self.indexes = query[u"indexes"]
-        self.metadata = query[u"metaData"]
-        self.page_faults = Amount(query[u"pageFaults"])
-        self.page_hits = Amount(query[u"pageHits"])
-        self.parameters = query[u"parameters"]
-        self.planner = query[u"planner"]
-        self.protocol = query[u"protocol"]
-        self.text = query[u"query"]
-        self.request_uri = query[u"requestUri"]
-        self.resource_information = query[u"resourceInformation"]
-        self.runtime = query[u"runtime"]
-        self.start_time = query[u"startTime"]  # TODO: unit
-        self.status = query[u"status"]
-        self.user = query[u"username"]
-        self.id = int(query[u"queryId"].partition("-")[-1])
+    Fields are decoded from the raw record on first access.
+    """
+
+    __slots__ = ["_record", "_active_lock_count", "_allocated_bytes", "_client_address", "_cpu_time",
+                 "_elapsed_time", "_idle_time", "_wait_time", "_indexes", "_metadata", "_page_faults",
+                 "_page_hits", "_parameters", "_planner", "_protocol", "_text", "_request_uri",
+                 "_resource_information", "_runtime", "_start_time", "_status", "_user", "_id"]
+
+    active_lock_count = RecordField(u"activeLockCount", Amount)
+    allocated_bytes = RecordField(u"allocatedBytes", BytesAmount)
+    client_address = RecordField(u"clientAddress")
+    cpu_time = RecordField(u"cpuTimeMillis", millis)
+    elapsed_time = RecordField(u"elapsedTimeMillis", millis)
+    idle_time = RecordField(u"idleTimeMillis", millis)
+    wait_time = RecordField(u"waitTimeMillis", millis)
+    indexes = RecordField(u"indexes")
+    metadata = RecordField(u"metaData")
+    page_faults = RecordField(u"pageFaults", Amount)
+    page_hits = RecordField(u"pageHits", Amount)
+    parameters = RecordField(u"parameters")
+    planner = RecordField(u"planner")
+    protocol = RecordField(u"protocol")
+    text = RecordField(u"query")
+    request_uri = RecordField(u"requestUri")
+    resource_information = RecordField(u"resourceInformation")
+    runtime = RecordField(u"runtime")
+    start_time = RecordField(u"startTime")  # TODO: unit
+    status = RecordField(u"status")
+    user = RecordField(u"username")
+    id = RecordField(u"queryId", serial_number)
+
+    def __init__(self, query):
+        self._record = query
+
+    def raw(self, name):
+        """ Return the raw, undecoded value behind an attribute, which is
+        cheap to compare between snapshots.
+        """
+        return getattr(QueryData, name).raw(self)
 
     def __repr__(self):
         s = ["Query:"]
@@ -263,6 +409,8 @@ class QueryData(object):
 
 class TransactionListData(object):
 
+    jmx = (JMX_TRANSACTIONS,)
+
     def __init__(self, transactions, metadata):
         """
         {'LastCommittedTxId': 1,
@@ -272,13 +420,23 @@ class TransactionListData(object):
          'NumberOfRolledBackTransactions': 8,
          'PeakNumberOfConcurrentTransactions': 2}
 
-        :param transactions:
+        :param transactions: rows from `dbms.listTransactions`, either as
+            returned by the procedure or in the form produced by a
+            :class:`.TransactionView`
         :param metadata:
         """
         if transactions is None:
             self.__items = []
+            self.status_counts = None
+        elif transactions and u"transaction" in transactions[0]:
+            # Sorted, filtered and limited on the server, with counts
+            self.__items = [TransactionData(row[u"transaction"]) for row in transactions
+                            if row[u"transaction"] is not None]
+            self.status_counts = {row[u"summaryStatus"]: row[u"summaryCount"] for row in transactions
+                                  if row[u"transaction"] is None}
         else:
             self.__items = list(map(TransactionData, transactions))
+            self.status_counts = Counter(item.status for item in self.__items)
         self.last_committed_id = metadata[u"LastCommittedTxId"]
         self.begin_count = Amount(metadata[u"NumberOfOpenedTransactions"])
         self.open_count = Amount(metadata[u"NumberOfOpenTransactions"])
@@ -295,6 +453,16 @@ class TransactionListData(object):
     def __iter__(self):
         return iter(self.__items)
 
+    @property
+    def listed_count(self):
+        """ Total number of transactions listed by the server, including
+        any not fetched because of a :class:`.TransactionView` limit or
+        filter.
+        """
+        if self.status_counts is None:
+            return None
+        return sum(self.status_counts.values())
+
     def __repr__(self):
         s = ["Transactions:", "    list: [...]"]
         for attr in sorted(dir(self)):
@@ -304,9 +472,8 @@ class TransactionListData(object):
 
 
 class TransactionData(object):
+    """ A single row from `dbms.listTransactions`:
 
-    def __init__(self, transaction):
-        """
         {'transactionId': 'transaction-96',
          'username': 'neo4j',
          'metaData': {},
@@ -327,31 +494,48 @@ class TransactionData(object):
          'allocatedDirectBytes': 0,
          'pageHits': 0,
          'pageFaults': 0}
+
+    Busy servers can have thousands of open transactions, most of which
+    are never displayed, so fields are decoded from the raw record on
+    first access rather than up front.
+    """
+
+    __slots__ = ["_record", "_id", "_user", "_metadata", "_start_time", "_protocol", "_client_address",
+                 "_request_uri", "_current_query_id_string", "_current_query_id", "_current_query",
+                 "_active_lock_count", "_status", "_resource_information", "_elapsed_time", "_cpu_time",
+                 "_wait_time", "_idle_time", "_allocated_bytes", "_allocated_direct_bytes", "_page_hits",
+                 "_page_faults"]
+
+    id = RecordField(u"transactionId", serial_number)
+    user = RecordField(u"username")
+    metadata = RecordField(u"metaData")
+    start_time = RecordField(u"startTime")  # TODO: unit
+    protocol = RecordField(u"protocol")
+    client_address = RecordField(u"clientAddress")
+    request_uri = RecordField(u"requestUri")
+    current_query_id_string = RecordField(u"currentQueryId")
+    current_query_id = RecordField(u"currentQueryId", serial_number)
+    current_query = RecordField(u"currentQuery")
+    active_lock_count = RecordField(u"activeLockCount", Amount)
+    status = RecordField(u"status")
+    resource_information = RecordField(u"resourceInformation")
+    elapsed_time = RecordField(u"elapsedTimeMillis", millis)
+    cpu_time = RecordField(u"cpuTimeMillis", millis)
+    wait_time = RecordField(u"waitTimeMillis", millis)
+    idle_time = RecordField(u"idleTimeMillis", millis)
+    allocated_bytes = RecordField(u"allocatedBytes", BytesAmount)
+    allocated_direct_bytes = RecordField(u"allocatedDirectBytes", BytesAmount)
+    page_hits = RecordField(u"pageHits", Amount)
+    page_faults = RecordField(u"pageFaults", Amount)
+
+    def __init__(self, transaction):
+        self._record = transaction
+
+    def raw(self, name):
+        """ Return the raw, undecoded value behind an attribute, which is
+        cheap to compare between snapshots.
         """
-        self.id = int(transaction[u"transactionId"].partition("-")[-1])
-        self.user = transaction[u"username"]
-        self.metadata = transaction[u"metaData"]
-        self.start_time = transaction[u"startTime"]  # TODO: unit
-        self.protocol = transaction[u"protocol"]
-        self.client_address = transaction[u"clientAddress"]
-        self.request_uri = transaction[u"requestUri"]
-        self.current_query_id_string = transaction[u"currentQueryId"]
-        if self.current_query_id_string:
-            self.current_query_id = int(self.current_query_id_string.partition("-")[-1])
-        else:
-            self.current_query_id = None
-        self.current_query = transaction[u"currentQuery"]
-        self.active_lock_count = Amount(transaction[u"activeLockCount"])
-        self.status = transaction[u"status"]
-        self.resource_information = transaction[u"resourceInformation"]
-        self.elapsed_time = Time(ms=transaction[u"elapsedTimeMillis"])
-        self.cpu_time = Time(ms=transaction[u"cpuTimeMillis"])
-        self.wait_time = Time(ms=transaction[u"waitTimeMillis"])
-        self.idle_time = Time(ms=transaction[u"idleTimeMillis"])
-        self.allocated_bytes = BytesAmount(transaction[u"allocatedBytes"])
-        self.allocated_direct_bytes = BytesAmount(transaction[u"allocatedDirectBytes"])
-        self.page_hits = Amount(transaction[u"pageHits"])
-        self.page_faults = Amount(transaction[u"pageFaults"])
+        return getattr(TransactionData, name).raw(self)
 
     def __repr__(self):
         s = ["Transaction:"]
@@ -361,8 +545,90 @@ class TransactionData(object):
         return "\n".join(s)
 
 
+class TransactionView(object):
+    """ Sort order, filter and row limit for the transaction list, to be
+    applied on the server so that only the rows actually displayed are
+    transferred. Counts of all transactions by status are returned in
+    the same call.
+
+    :param order_by: :class:`.TransactionData` attribute to sort by
+    :param descending: sort direction
+    :param limit: maximum number of rows to fetch, or :const:`None` for
+        all rows
+    :param where: optional Cypher predicate over the columns of
+        `dbms.listTransactions`
+    :param parameters: parameters referred to by `where`
+    """
+
+    columns = [
+        u"transactionId", u"username", u"metaData", u"startTime", u"protocol", u"clientAddress",
+        u"requestUri", u"currentQueryId", u"currentQuery", u"activeLockCount", u"status",
+        u"resourceInformation", u"elapsedTimeMillis", u"cpuTimeMillis", u"waitTimeMillis",
+        u"idleTimeMillis", u"allocatedBytes", u"allocatedDirectBytes", u"pageHits", u"pageFaults",
+    ]
+
+    def __init__(self, order_by=u"elapsed_time", descending=True, limit=None, where=None, parameters=None):
+        field = getattr(TransactionData, order_by, None)
+        if not isinstance(field, RecordField):
+            raise ValueError("Cannot sort transactions by %r" % order_by)
+        if limit is not None and limit < 0:
+            raise ValueError("Limit must not be negative")
+        self.order_by = order_by
+        self.descending = descending
+        self.limit = limit
+        self.where = where
+        self.parameters = dict(parameters or {})
+        self.__statement = None
+
+    def __repr__(self):
+        return "<TransactionView order_by=%r descending=%r limit=%r where=%r>" % (
+            self.order_by, self.descending, self.limit, self.where)
+
+    def __eq__(self, other):
+        return (isinstance(other, TransactionView) and self.order_by == other.order_by and
+                self.descending == other.descending and self.limit == other.limit and
+                self.where == other.where and self.parameters == other.parameters)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    @property
+    def statement(self):
+        """ Cypher statement for this view. One branch returns the
+        selected rows, each as a map under `transaction`; the other
+        returns a `summaryStatus` and `summaryCount` for every status.
+        """
+        if self.__statement is None:
+            yield_clause = u"CALL dbms.listTransactions() YIELD " + u", ".join(self.columns)
+            if self.where:
+                yield_clause += u" WHERE " + self.where
+            row = u"{" + u", ".join(u"%s: %s" % (column, column) for column in self.columns) + u"}"
+            order = getattr(TransactionData, self.order_by).key + (u" DESC" if self.descending else u"")
+            self.__statement = (
+                yield_clause + u" "
+                u"RETURN " + row + u" AS transaction, null AS summaryStatus, null AS summaryCount "
+                u"ORDER BY " + order +
+                (u" LIMIT $limit" if self.limit is not None else u"") + u" "
+                u"UNION ALL "
+                u"CALL dbms.listTransactions() YIELD status "
+                u"RETURN null AS transaction, status AS summaryStatus, count(*) AS summaryCount"
+            )
+        return self.__statement
+
+    @property
+    def statement_parameters(self):
+        parameters = dict(self.parameters)
+        if self.limit is not None:
+            parameters[u"limit"] = self.limit
+        return parameters
+
+
 class PageCacheData(object):
 
+    jmx = (JMX_PAGE_CACHE,)
+
     def __init__(self, page_cache):
         """
         {'BytesRead': 147542,
@@ -401,8 +667,33 @@ class PageCacheData(object):
         return "\n".join(s)
 
 
+class LockingData(object):
+
+    jmx = (JMX_LOCKING,)
+
+    def __init__(self, locking):
+        """
+        {'NumberOfAvertedDeadlocks': 0}
+
+        The `Locks` attribute, which lists every lock held, is trimmed off
+        on the server (see :data:`agentsmith.jmx.JMX_TRIMMED`). Lock waits
+        are derived from the transaction list instead (see
+        :mod:`agentsmith.locks`).
+        """
+        self.averted_deadlocks = Amount(locking[u"NumberOfAvertedDeadlocks"])
+
+    def __repr__(self):
+        s = ["Locking:"]
+        for attr in sorted(dir(self)):
+            if not attr.startswith("_"):
+                s.append("    %s: %r" % (attr, getattr(self, attr)))
+        return "\n".join(s)
+
+
 class ClusterOverviewData(object):
 
+    jmx = (JMX_CAUSAL_CLUSTERING,)
+
     def __init__(self, data):
         self.data = data
 
@@ -421,6 +712,7 @@ class ClusterOverviewData(object):
 class ServerData(object):
 
     # System and common DBMS data
+    facts = None
     system = None
     process = None
     memory = None
@@ -430,13 +722,44 @@ class ServerData(object):
     queries = None
     page_cache = None
     transactions = None
-    # TODO: locking = None
+    locking = None
     # TODO: memory_mapping = None
 
     # Causal cluster data
     cluster_membership = None
     cluster_overview = None
 
+    # Index over the raw JMX result for this snapshot
+    mbeans = None
+
+    # Estimated bytes saved by projecting JMX rather than fetching '*:*'
+    jmx_bytes_saved = None
+
+    # Raw data collected on the tick that produced this snapshot, as
+    # a dictionary of "due" (collectors run), "jmx" (flattened MBean
+    # attributes by name) and "results" (procedure results by collector)
+    sources = None
+
+    # Per-second rates and deltas of monotonic counters
+    rates = None
+
+    # Statistics accumulated per statement fingerprint across polls
+    statements = None
+
+    # Resources used per user, client host and protocol across polls
+    accounts = None
+
+    # Wait-for graph of transactions waiting for locks
+    lock_waits = None
+
+    # Time (seconds since the epoch) at which each collector last ran
+    updated = None
+
+    # Time (seconds since the epoch) at which this snapshot was collected;
+    # snapshots of different servers taken on the same coordinated tick
+    # share the same value
+    collected_at = None
+
     @property
     def enterprise(self):
         return self.system.dbms.edition == u"EE"
@@ -446,11 +769,165 @@ class ServerData(object):
         return self.system.dbms.mode == u"CORE"
 
 
+class SnapshotBuilder(object):
+    """ Assembles :class:`.ServerData` snapshots for a single server from
+    raw collector results, keeping the latest result of every collector
+    so that a snapshot is complete even when only some have run. Rates,
+    statement statistics, accounts, lock waits and metric history are
+    derived from each snapshot as it is built.
+    """
+
+    def __init__(self, history_tiers=DEFAULT_TIERS):
+        self.latest = ServerData()
+        self.rates = RateTracker()
+        self.statements = StatementTracker()
+        self.accounts = AccountTracker()
+        self.lock_waits = LockWaitTracker()
+        self.history = MetricHistory(history_tiers)
+
+    def reset(self):
+        """ Discard the latest collector results, e.g. after the server
+        has been restarted or the connection has been lost.
+        """
+        self.latest = ServerData()
+
+    def update(self, facts, jmx, results, due, collected_at):
+        """ Build data objects for the collectors that have run, and
+        assemble a new snapshot from these and the latest results of
+        the others.
+
+        :param facts: :class:`.ServerFacts` for the server
+        :param jmx: :class:`agentsmith.jmx.JmxIndex` of the MBeans fetched
+        :param results: dictionary of procedure results by collector
+        :param due: names of the collectors that have run
+        :param collected_at: collection timestamp
+        :return: new :class:`.ServerData` snapshot
+        """
+        latest = self.latest
+        latest.sources = {
+            u"due": sorted(due),
+            u"jmx": {section.name: section.values for section in jmx},
+            u"results": results,
+        }
+        latest.mbeans = jmx
+        latest.facts = facts
+        updated = dict(latest.updated or {})
+        timestamp = collected_at
+        os = jmx.get(JMX_OPERATING_SYSTEM)
+        dbms_kernel = jmx.get(JMX_KERNEL)
+
+        if u"system" in due:
+            latest.system = SystemData(os, jmx.get(JMX_RUNTIME), jmx.get(JMX_THREADING), dbms_kernel, facts,
+                                       collected_at)
+            updated[u"system"] = timestamp
+
+        if u"memory" in due:
+            latest.memory = MemoryData(os, jmx.get(JMX_MEMORY))
+            updated[u"memory"] = timestamp
+
+        if u"storage" in due:
+            latest.storage = StorageData(os, dbms_kernel, jmx.get(JMX_STORE_SIZES), jmx.get(JMX_PRIMITIVE_COUNT), facts)
+            updated[u"storage"] = timestamp
+
+        if facts.dbms.edition == u"EE":
+
+            if u"queries" in due:
+                latest.queries = QueryListData(results[u"queries"])
+                updated[u"queries"] = timestamp
+
+            if u"transactions" in due:
+                latest.transactions = TransactionListData(
+                    results.get(u"transactions"),
+                    jmx.get(JMX_TRANSACTIONS))
+                updated[u"transactions"] = timestamp
+
+            if u"page_cache" in due:
+                latest.page_cache = PageCacheData(
+                    jmx.get(JMX_PAGE_CACHE))
+                updated[u"page_cache"] = timestamp
+
+            if u"locking" in due:
+                locking = jmx.get(JMX_LOCKING)
+                latest.locking = None if locking is None else LockingData(locking)
+                updated[u"locking"] = timestamp
+
+            # TODO: data.memory_mapping = jmx.get(u"org.neo4j:instance=kernel#0,name=Memory Mapping")
+
+            if u"cluster_overview" in results:
+                latest.cluster_membership = jmx.get(JMX_CAUSAL_CLUSTERING)
+                latest.cluster_overview = ClusterOverviewData(results[u"cluster_overview"])
+                updated[u"cluster_overview"] = timestamp
+
+        else:
+
+            latest.queries = None
+
+        latest.updated = updated
+        latest.collected_at = timestamp
+        latest.lock_waits = self.lock_waits.update(latest, results.get(u"locks"))
+        if latest.lock_waits is not None:
+            # Derived from the transaction list, so as of the same time
+            updated[u"lock_waits"] = updated.get(u"transactions")
+        latest.rates = self.rates.update(latest)
+        latest.statements = self.statements.update(latest)
+        latest.accounts = self.accounts.update(latest)
+        data = copy(latest)
+        self.history.append(data)
+        return data
+
+
+# Codes of errors showing that a server cannot run a tick pipelined
+_PIPELINE_UNSUPPORTED = (u"Neo.ClientError.Request.Invalid",
+                         u"Neo.ClientError.Request.InvalidFormat",
+                         u"Neo.ClientError.Request.InvalidUsage")
+
+
+class _Retry(Exception):
+    """ Raised when a poll fails in a way that can be dealt with by
+    retrying it in a new transaction, with one statement at a time.
+    """
+
+
 class ServerMonitor(object):
 
     __lock = Lock()
     __instances = {}
 
+    #: Optional :class:`agentsmith.engine.CollectionEngine` or
+    #: :class:`agentsmith.coordinator.SnapshotCoordinator` used to drive
+    #: new monitors. If this is not set, each monitor runs in its own thread.
+    engine = None
+
+    #: Whether to pipeline all statements for a tick into a single
+    #: round trip. This is switched off for any monitor whose server
+    #: rejects the pipelined form as unsupported.
+    pipelining = True
+
+    #: Optional :class:`agentsmith.recording.Recorder` to which every
+    #: snapshot is passed.
+    recorder = None
+
+    #: Optional :class:`agentsmith.policy.KillPolicy` against which every
+    #: snapshot is evaluated.
+    policy = None
+
+    #: Retention of metric history, as (resolution in seconds, number of
+    #: points) for each tier.
+    history_tiers = DEFAULT_TIERS
+
+    # Data classes (and hence MBeans) used by each collector
+    collectors = {
+        u"system": (SystemData,),
+        u"memory": (MemoryData,),
+        u"storage": (StorageData,),
+        u"queries": (QueryListData,),
+        u"transactions": (TransactionListData,),
+        u"page_cache": (PageCacheData,),
+        u"locking": (LockingData,),
+        u"locks": (),
+        u"cluster_overview": (ClusterOverviewData,),
+    }
+
     _address = None
     _routing = None
     _uri = None
@@ -486,148 +963,360 @@ class ServerMonitor(object):
                 inst._uri = uri
                 inst._auth = auth
                 inst._driver = None
-                inst._death_row = deque()
+                inst._session = None
+                inst._tx = None
+                inst._killer = KillWorker(uri, auth, lambda: inst._data, inst._report_kills)
+                inst._kill_handlers = set()
                 inst._running = True
                 inst._refresh_period = 1.0
-                inst._refresh_thread = Thread(target=inst.loop)
-                inst._refresh_thread.start()
+                inst._facts = None
+                inst._jmx = JmxProjection(*ServerFacts.jmx)
+                for data_classes in cls.collectors.values():
+                    for data_class in data_classes:
+                        inst._jmx.add(*data_class.jmx)
+                inst._schedule = Schedule()
+                inst._builder = SnapshotBuilder(cls.history_tiers)
                 inst._handlers = set()
                 inst._on_error = on_error
                 inst._lock = Lock()
                 inst._data = None
+                inst._tick_lock = Lock()
+                inst._collected_at = None
+                inst._has_list_transactions = True
+                inst._transaction_view = None
+                inst._rejected_view = None
+                inst._engine = cls.engine
+                if inst._engine is None:
+                    inst._refresh_thread = Thread(target=inst.loop)
+                    inst._refresh_thread.start()
+                else:
+                    inst._engine.start(inst)
             return cls.__instances[uri]
 
     def attach(self, handler):
         with self._lock:
             self._handlers.add(handler)
+        if self._engine is not None:
+            self._engine.wake(self)
 
     def detach(self, handler):
         with self._lock:
             self._handlers.discard(handler)
 
+    @property
+    def intervals(self):
+        """ Dictionary of collector name to refresh interval in seconds.
+        """
+        return self._schedule.intervals
+
+    def set_interval(self, collector, interval):
+        """ Change how often a collector runs. The new interval applies
+        from the next tick.
+        """
+        self._schedule.set_interval(collector, interval)
+
+    @property
+    def transaction_view(self):
+        """ :class:`.TransactionView` applied on the server when listing
+        transactions, or :const:`None` to fetch every transaction.
+        """
+        return self._transaction_view
+
+    def set_transaction_view(self, view):
+        """ Change how the transaction list is sorted, filtered and limited
+        on the server. The new view applies from the next tick.
+        """
+        self._transaction_view = view
+
     def kill(self, tx):
-        self._death_row.append(tx)
+        self._killer.submit([tx])
+
+    def kill_all(self, transactions):
+        """ Queue several transactions to be killed together.
+        """
+        self._killer.submit(transactions)
+
+    def attach_kill_handler(self, handler):
+        """ Add a function to be called with a list of
+        :class:`agentsmith.killer.KillResult` objects whenever kills
+        have been carried out.
+        """
+        with self._lock:
+            self._kill_handlers.add(handler)
+
+    def detach_kill_handler(self, handler):
+        with self._lock:
+            self._kill_handlers.discard(handler)
+
+    def _report_kills(self, results):
+        with self._lock:
+            handlers = list(self._kill_handlers)
+        for handler in handlers:
+            handler(results)
 
     def exit(self):
         with self._lock:
-            if self._running:
-                self._running = False
-                self._refresh_thread.join()
-                del self.__instances[self.uri]
+            if not self._running:
+                return
+            self._running = False
+        if self._engine is None:
+            self._refresh_thread.join()
+        else:
+            self._engine.stop(self)
+        self._killer.close()
+        with self._tick_lock:
+            self._close(driver=True)
+        with self.__lock:
+            del self.__instances[self.uri]
 
     def loop(self):
-        with GraphDatabase.driver(self._uri, auth=self._auth, max_retry_time=1.0) as driver:
-
-            def kill():
-                with driver.session() as s:
-                    with s.begin_transaction() as t:
-                        while self._death_row:
-                            tx_to_kill = self._death_row.pop()
-                            qid_to_kill = tx_to_kill.current_query_id_string
-                            if qid_to_kill:
-                                t.run("CALL dbms.killQuery($qid)", qid=qid_to_kill).consume()
-
-            while self._running:
+        while self._running:
+            try:
+                self._sleep(self.tick())
+            except KeyboardInterrupt:
+                self._running = False
+
+    def _sleep(self, seconds):
+        deadline = monotonic() + seconds
+        idle = not self._handlers
+        while self._running and idle != bool(self._handlers):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            sleep(min(0.1, remaining))
+
+    def tick(self, collected_at=None):
+        """ Carry out one round of monitoring work: run the collectors that
+        are due and pass the resulting snapshot to every attached handler.
+        Kills are carried out separately, by a
+        :class:`agentsmith.killer.KillWorker`.
+
+        :param collected_at: collection timestamp (seconds since the epoch)
+            to stamp on the snapshot, allowing several monitors to share a
+            common timestamp; defaults to the current time
+        :return: number of seconds until the next tick is needed
+        """
+        with self._tick_lock:
+            self._collected_at = time() if collected_at is None else collected_at
+            if not self._running:
+                return self._refresh_period
+            with self._lock:
+                handlers = list(self._handlers)
+            if not handlers:
+                # Nobody is watching, so don't hold a transaction open
+                self._close()
+                return self._refresh_period
+            previous = self._data
+            fetch_data = self.fetch_data
+            while True:
                 try:
-                    if self._handlers:
-                        with driver.session() as session:
-                            with session.begin_transaction() as tx:
-                                while self._handlers:
-                                    if self._death_row:
-                                        kill()
-                                    self.work(tx, self.fetch_data)
-                                    for handler in self._handlers:
-                                        if callable(handler):
-                                            handler(self._data)
-                                    for _ in range(int(10 * self._refresh_period)):
-                                        if self._handlers and self._running:
-                                            sleep(0.1)
-                                        else:
-                                            break
-                    else:
-                        for _ in range(int(10 * self._refresh_period)):
-                            if self._running:
-                                sleep(0.1)
-                            else:
-                                break
-                except KeyboardInterrupt:
-                    self._running = False
-
-    def work(self, tx, unit):
+                    self.work(fetch_data)
+                except _Retry:
+                    # The transaction is unusable after the failure, so
+                    # retry in a new one, this time without pipelining
+                    self._close()
+                    fetch_data = partial(self.fetch_data, pipelining=False)
+                else:
+                    break
+            if self._data is not previous or previous is None:
+                for handler in handlers:
+                    if callable(handler):
+                        handler(self._data)
+            return self._schedule.wait_time(monotonic())
+
+    def _transaction(self):
+        if self._driver is None:
+            self._driver = GraphDatabase.driver(self._uri, auth=self._auth, max_retry_time=1.0)
+        if self._tx is None:
+            self._jmx.reset()
+            self._facts = None
+            self._session = self._driver.session()
+            self._tx = self._session.begin_transaction()
+        return self._tx
+
+    def _close(self, driver=False):
+        for resource in (self._tx, self._session) + ((self._driver,) if driver else ()):
+            if resource is not None:
+                try:
+                    resource.close()
+                except (CypherError, ServiceUnavailable, SessionExpired):
+                    pass
+        self._tx = None
+        self._session = None
+        if driver:
+            self._driver = None
+
+    def work(self, unit):
         try:
-            # if not self._driver:
-            #     self._driver = GraphDatabase.driver(self._uri, auth=self._auth, max_retry_time=1.0)
-            return unit(tx)
+            return unit(self._transaction())
         except (CypherError, ServiceUnavailable, SessionExpired) as error:
-            # self._driver = None
+            # A failed transaction cannot be reused, and a lost connection
+            # means the driver has to be rebuilt too
+            self._close(driver=not isinstance(error, CypherError))
             self._data = None
+            self._facts = None
+            self._builder.reset()
+            self._schedule.reset()
+            self._jmx.reset()
             if callable(self._on_error):
                 self._on_error(error)
             else:
                 raise
 
-    @classmethod
-    def _extract_jmx(cls, jmx, section_name):
-        sections = [section for section in jmx if section[u"name"] == section_name]
-        return {key: value[u"value"] for key, value in sections[0][u"attributes"].items()} if sections else None
+    def fetch_data(self, tx, pipelining=True):
+        """ Retrieve data from database. Only the collectors that are due
+        are run; the snapshot is assembled from the latest result of
+        every collector.
 
-    def fetch_data(self, tx):
-        """ Retrieve data from database.
+        Once the server facts are known, every statement needed for a
+        tick is pipelined so that the whole poll costs a single network
+        round trip. If the server rejects this as unsupported, the
+        monitor falls back to running each statement in turn from then
+        on. A missing procedure causes a fallback for a single tick only,
+        so that the statement responsible can be found. Any other error
+        is raised as usual.
 
+        :param pipelining: whether pipelining may be used for this tick
         :return:
         """
-        data = ServerData()
-
-        jmx = tx.run("CALL dbms.queryJmx('*:*')").data()
-        os = self._extract_jmx(jmx, u"java.lang:type=OperatingSystem")
-        dbms_config = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Configuration")
-
-        components = tx.run("CALL dbms.components").data()
-        jvm = self._extract_jmx(jmx, u"java.lang:type=Runtime")
-        java_threading = self._extract_jmx(jmx, u"java.lang:type=Threading")
-        dbms_kernel = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Kernel")
-        data.system = SystemData(os, jvm, java_threading, components, dbms_kernel, dbms_config)
-
-        java_memory = self._extract_jmx(jmx, u"java.lang:type=Memory")
-        data.memory = MemoryData(os, java_memory)
-
-        dbms_stores = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Store sizes")
-        dbms_primitives = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Primitive count")
-        data.storage = StorageData(os, dbms_kernel, dbms_stores, dbms_primitives)
-
-        if data.system.dbms.edition == u"EE":
-
-            data.queries = QueryListData(
-                tx.run("CALL dbms.listQueries").data())
-
-            # # TODO: detect dbms.listTransactions (only available in 3.4+)
+        now = monotonic()
+        if self._facts is None:
+            self._schedule.reset()
+        due = self._schedule.due(now)
+        if not due:
+            return
+        names = set()
+        for collector in due:
+            for data_class in self.collectors[collector]:
+                names.update(data_class.jmx)
+        if self._facts is None:
+            names.update(ServerFacts.jmx)
+        jmx_names = [name for name in self._jmx.names if name in names]
+        if self._facts is not None and self.pipelining and pipelining:
+            try:
+                jmx, results = self._fetch_pipelined(tx, jmx_names, self._procedures(self._facts, due))
+            except CypherError as error:
+                if error.code in _PIPELINE_UNSUPPORTED:
+                    self.pipelining = False
+                    raise _Retry()
+                if error.code.endswith(u"ProcedureNotFound"):
+                    raise _Retry()
+                raise
+        else:
+            jmx, results = self._fetch_sequential(tx, jmx_names, due)
+        dbms_kernel = jmx.get(JMX_KERNEL)
+        if self._facts is not None and dbms_kernel and not self._facts.is_current(dbms_kernel):
+            # The server has restarted since the facts were collected, so
+            # drop everything and start again on the next tick
+            self._facts = None
+            self._builder.reset()
+            self._schedule.reset()
+            return
+        self._update(jmx, results, due)
+        self._schedule.mark(due, now)
+
+    def _procedures(self, facts, due):
+        """ Return the (collector, statement, parameters) triples that need
+        to be run for the collectors that are due.
+        """
+        procedures = []
+        if facts.dbms.edition == u"EE":
+            if u"queries" in due:
+                procedures.append((u"queries", u"CALL dbms.listQueries", {}))
+            if u"transactions" in due and self._has_list_transactions:
+                view = self._transaction_view
+                if view is None or view == self._rejected_view:
+                    procedures.append((u"transactions", u"CALL dbms.listTransactions", {}))
+                else:
+                    procedures.append((u"transactions", view.statement, view.statement_parameters))
+            if u"locks" in due and self._data is not None and self._data.lock_waits:
+                # Locks held by the transactions waiting, or waited on,
+                # as of the last snapshot
+                query_ids = self._data.lock_waits.query_ids()
+                if query_ids:
+                    procedures.append((u"locks", LIST_LOCKS, {u"ids": query_ids}))
+            if u"cluster_overview" in due and facts.dbms.mode == u"CORE":
+                procedures.append((u"cluster_overview", u"CALL dbms.cluster.overview", {}))
+        return procedures
+
+    def _fetch_sequential(self, tx, jmx_names, due):
+        jmx = JmxIndex(self._jmx.fetch(tx, jmx_names))
+        if self._facts is None:
+            self._facts = ServerFacts(jmx.get(JMX_OPERATING_SYSTEM), jmx.get(JMX_RUNTIME),
+                                      tx.run("CALL dbms.components").data(), jmx.get(JMX_KERNEL),
+                                      jmx.get(JMX_CONFIGURATION))
+        results = {}
+        for collector, statement, parameters in self._procedures(self._facts, due):
             try:
-                transactions = tx.run("CALL dbms.listTransactions").data()
+                results[collector] = tx.run(statement, parameters).data()
             except CypherError as error:
-                if error.code.endswith("ProcedureNotFound"):
-                    transactions = None
+                # dbms.listTransactions is only available in 3.4+
+                if collector == u"transactions" and error.code.endswith("ProcedureNotFound"):
+                    self._has_list_transactions = False
+                    results[collector] = None
+                elif self._reject_view(collector, error):
+                    raise _Retry()
                 else:
                     raise
-            data.transactions = TransactionListData(
-                transactions,
-                self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Transactions"))
-
-            data.page_cache = PageCacheData(
-                self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Page cache"))
-
-            # TODO: data.locking = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Locking")
-
-            # TODO: data.memory_mapping = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Memory Mapping")
-
-            if data.system.dbms.mode == u"CORE":
-                data.cluster_membership = self._extract_jmx(jmx, u"org.neo4j:instance=kernel#0,name=Causal Clustering")
-                data.cluster_overview = ClusterOverviewData(tx.run("CALL dbms.cluster.overview").data())
-
+        return jmx, results
+
+    def _fetch_pipelined(self, tx, jmx_names, procedures):
+        pending_jmx = self._jmx.submit(tx, jmx_names)
+        pending = [(collector, tx.run(statement, parameters)) for collector, statement, parameters in procedures]
+        jmx = JmxIndex(self._jmx.receive(pending_jmx))
+        results = {}
+        for collector, result in pending:
+            try:
+                results[collector] = result.data()
+            except CypherError as error:
+                if self._reject_view(collector, error):
+                    raise _Retry()
+                raise
+        return jmx, results
+
+    def _reject_view(self, collector, error):
+        """ Check whether an error raised by a collector is the server
+        rejecting the transaction view, such as for a filter holding a
+        regular expression that Java cannot compile. If so, transactions
+        are listed in full, and filtered on the client only, for as long
+        as that view is in place.
+        """
+        view = self._transaction_view
+        if collector != u"transactions" or view is None or view == self._rejected_view:
+            return False
+        code = error.code or u""
+        if not code.startswith(u"Neo.ClientError.") or code in _PIPELINE_UNSUPPORTED:
+            return False
+        if code.startswith(u"Neo.ClientError.Security.") or code.endswith(u"ProcedureNotFound"):
+            return False
+        self._rejected_view = view
+        return True
+
+    def _update(self, jmx, results, due):
+        data = self._builder.update(self._facts, jmx, results, due, self._collected_at)
+        data.jmx_bytes_saved = self._jmx.bytes_saved
+        self._data = data
+        if self.recorder is not None and not self._for_cluster_core:
+            self.recorder.record(self._address, data)
+        if self.policy is not None and not self._for_cluster_core:
+            self.policy.evaluate(self, data)
+
+    def report_error(self, error):
+        """ Pass on an error raised by a tick outside of the usual handling
+        in :meth:`.work`, such as one caught by an engine driving this
+        monitor. Without an error handler, the error is printed.
+        """
+        if callable(self._on_error):
+            self._on_error(error)
         else:
+            print_exception(type(error), error, error.__traceback__, file=stderr)
 
-            data.queries = None
-
-        self._data = data
+    @property
+    def refresh_period(self):
+        """ Number of seconds between ticks when nothing else is due,
+        and before a tick is tried again after a failure.
+        """
+        return self._refresh_period
 
     @property
     def for_cluster_core(self):
@@ -641,6 +1330,20 @@ class ServerMonitor(object):
     def address(self):
         return self._address
 
+    @property
+    def history(self):
+        """ :class:`agentsmith.history.MetricHistory` of every snapshot
+        collected by this monitor.
+        """
+        return self._builder.history
+
+    @property
+    def jmx_bytes_saved(self):
+        """ Estimated number of bytes saved on the last tick by fetching
+        only the MBeans that are actually used.
+        """
+        return self._jmx.bytes_saved
+
     @property
     def up(self):
         return bool(self._driver)
@@ -656,6 +1359,7 @@ def print_stats(data):
             print(data.queries)       # 5
             print(data.transactions)  # 6
             print(data.page_cache)
+            print(data.rates)
             if data.cluster:
                 print("Cluster Overview: {}".format(data.cluster_overview))
     else:
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Automatic killing of runaway transactions according to declarative rules.
+
+A policy file is a JSON document holding a list of rules (or an object
+with such a list under "rules"). Each rule has a name and a "when"
+object of conditions on transaction fields, all of which must hold for
+the rule to match:
+
+    {"rules": [
+        {"name": "long reports",
+         "when": {"user": "reporting", "elapsed_time_ms": {">": 60000}}},
+        {"name": "lock hogs",
+         "when": {"active_lock_count": {">=": 1000}, "wait_time_ms": {">": 5000}},
+         "dry_run": true}
+    ]}
+
+A condition is either a plain value, which must be equal to that of the
+field, or an object of operator to operand. The operators are `==`,
+`!=`, `<`, `<=`, `>`, `>=`, `in`, `not in` and `matches` (a regular
+expression search). Field names are those used in headless output, plus
+`client` (the client host) and `fingerprint` (see
+:mod:`agentsmith.statements`).
+
+Every action is written to an audit log: "dry-run", "rate-limited" or
+"kill-requested" when a rule matches, then, once the kill has been
+carried out, its outcome as "killed", "not-found", "query-changed" or
+"failed".
+"""
+
+from __future__ import division
+
+from functools import partial
+from json import dumps, load
+import operator
+import re
+from threading import Lock
+from time import monotonic, time
+
+from agentsmith.accounts import client_host
+from agentsmith.killer import KILLED, NOT_FOUND, QUERY_CHANGED, NO_QUERY, FAILED
+from agentsmith.statements import fingerprint
+
+
+class PolicyError(ValueError):
+    """ Raised when a policy is not valid.
+    """
+
+
+# Fields that rules can test, by name, as functions of a transaction
+# returning a raw value
+FIELDS = {
+    u"id": lambda tx: tx.id,
+    u"user": lambda tx: tx.raw(u"user"),
+    u"status": lambda tx: tx.raw(u"status"),
+    u"protocol": lambda tx: tx.raw(u"protocol"),
+    u"client_address": lambda tx: tx.raw(u"client_address"),
+    u"client": lambda tx: client_host(tx.raw(u"client_address")),
+    u"current_query": lambda tx: tx.raw(u"current_query"),
+    u"fingerprint": lambda tx: fingerprint(tx.raw(u"current_query")),
+    u"elapsed_time_ms": lambda tx: tx.raw(u"elapsed_time"),
+    u"cpu_time_ms": lambda tx: tx.raw(u"cpu_time"),
+    u"wait_time_ms": lambda tx: tx.raw(u"wait_time"),
+    u"idle_time_ms": lambda tx: tx.raw(u"idle_time"),
+    u"active_lock_count": lambda tx: tx.raw(u"active_lock_count"),
+    u"allocated_bytes": lambda tx: tx.raw(u"allocated_bytes"),
+    u"page_hits": lambda tx: tx.raw(u"page_hits"),
+    u"page_faults": lambda tx: tx.raw(u"page_faults"),
+}
+
+
+def _matches(value, pattern):
+    return pattern.search(value) is not None
+
+
+# Audit log actions for the outcomes of kills
+OUTCOMES = {
+    KILLED: u"killed",
+    NOT_FOUND: u"not-found",
+    QUERY_CHANGED: u"query-changed",
+    NO_QUERY: u"no-query",
+    FAILED: u"failed",
+}
+
+
+OPERATORS = {
+    u"==": operator.eq,
+    u"!=": operator.ne,
+    u"<": operator.lt,
+    u"<=": operator.le,
+    u">": operator.gt,
+    u">=": operator.ge,
+    u"in": lambda value, operand: value in operand,
+    u"not in": lambda value, operand: value not in operand,
+    u"matches": _matches,
+}
+
+
+def _condition(field, op, operand):
+    """ Compile a single condition into a predicate over transactions. A
+    field without a value (such as CPU time when CPU time tracking is
+    disabled) never satisfies a condition.
+    """
+    try:
+        get = FIELDS[field]
+    except KeyError:
+        raise PolicyError("Unknown field %r" % field)
+    try:
+        compare = OPERATORS[op]
+    except KeyError:
+        raise PolicyError("Unknown operator %r for field %r" % (op, field))
+    if op == u"matches":
+        try:
+            operand = re.compile(operand)
+        except (TypeError, re.error) as error:
+            raise PolicyError("Invalid pattern for field %r: %s" % (field, error))
+    elif op in (u"in", u"not in"):
+        try:
+            operand = frozenset(operand if isinstance(operand, list) else None)
+        except TypeError:
+            raise PolicyError("Operand of %r for field %r must be a list of values" % (op, field))
+
+    def predicate(tx):
+        value = get(tx)
+        if value is None:
+            return False
+        try:
+            return compare(value, operand)
+        except TypeError:
+            return False
+
+    return predicate
+
+
+class Rule(object):
+    """ A named set of conditions, compiled from its JSON form.
+    """
+
+    def __init__(self, name, when, dry_run=False):
+        if not when:
+            raise PolicyError("Rule %r has no conditions" % name)
+        self.name = name
+        self.dry_run = dry_run
+        self.__predicates = []
+        for field, condition in sorted(when.items()):
+            if isinstance(condition, dict):
+                for op, operand in sorted(condition.items()):
+                    self.__predicates.append(_condition(field, op, operand))
+            else:
+                self.__predicates.append(_condition(field, u"==", condition))
+
+    def __repr__(self):
+        return "<Rule name=%r>" % self.name
+
+    @classmethod
+    def from_json(cls, value):
+        if not isinstance(value, dict):
+            raise PolicyError("Rule must be an object, not %r" % value)
+        unknown = set(value) - {u"name", u"when", u"dry_run"}
+        if unknown:
+            raise PolicyError("Unknown rule key(s) %s" % ", ".join(map(repr, sorted(unknown))))
+        try:
+            name = value[u"name"]
+        except KeyError:
+            raise PolicyError("Rule has no name")
+        when = value.get(u"when")
+        if not isinstance(when, dict):
+            raise PolicyError("Rule %r must have a \"when\" object" % name)
+        return cls(name, when, bool(value.get(u"dry_run", False)))
+
+    def matches(self, tx):
+        for predicate in self.__predicates:
+            if not predicate(tx):
+                return False
+        return True
+
+
+class AuditLog(object):
+    """ Writes every action taken (or not taken) by a policy to a stream,
+    one JSON object per line.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = Lock()
+
+    def write(self, action, address, rule, tx, message=None):
+        entry = {
+            u"t": time(),
+            u"action": action,
+            u"server": address,
+            u"rule": rule.name,
+            u"transaction_id": tx.id,
+            u"query_id": tx.raw(u"current_query_id"),
+            u"user": tx.raw(u"user"),
+            u"client_address": tx.raw(u"client_address"),
+            u"elapsed_time_ms": tx.raw(u"elapsed_time"),
+            u"active_lock_count": tx.raw(u"active_lock_count"),
+            u"allocated_bytes": tx.raw(u"allocated_bytes"),
+            u"query": tx.raw(u"current_query"),
+        }
+        if message is not None:
+            entry[u"message"] = message
+        line = dumps(entry, separators=(u",", u":"), default=str)
+        with self._lock:
+            self.stream.write(line + u"\n")
+            self.stream.flush()
+
+
+class KillPolicy(object):
+    """ Evaluates rules against each snapshot of the transaction list and
+    kills the transactions that match.
+
+    Rules are tried in order, and the first to match a transaction is the
+    one applied. Each running query is dealt with at most once, so a
+    transaction that has been killed (or would have been, in a dry run)
+    is not matched again until it starts another query. All matches from
+    a snapshot are queued on the monitor together, to be killed in one go
+    by its :class:`agentsmith.killer.KillWorker`. Each match queued is
+    logged as "kill-requested", and its outcome is logged once reported.
+
+    Kills across all servers are limited to `max_kills_per_second`, with
+    bursts of up to one second's worth. Matches over the limit are logged
+    as "rate-limited" and tried again on the next snapshot.
+
+    Only the transactions fetched are evaluated, so a limited
+    :class:`agentsmith.monitor.TransactionView` limits what can be
+    matched.
+
+    :param rules: list of :class:`.Rule` objects
+    :param dry_run: if true, log matches as "dry-run" without killing
+    :param max_kills_per_second: rate limit on kills
+    :param audit: :class:`.AuditLog` for every action, or :const:`None`
+    """
+
+    def __init__(self, rules, dry_run=False, max_kills_per_second=20.0, audit=None):
+        self.rules = list(rules)
+        self.dry_run = dry_run
+        self.max_kills_per_second = max_kills_per_second
+        self.audit = audit
+        self._lock = Lock()
+        self._tokens = max_kills_per_second
+        self._refilled = monotonic()
+        self._handled = {}
+        self._limited = {}
+        self._requested = {}
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """ Load rules from a JSON policy file.
+        """
+        with open(path) as f:
+            try:
+                value = load(f)
+            except ValueError as error:
+                raise PolicyError("Invalid JSON in %s: %s" % (path, error))
+        if isinstance(value, dict):
+            value = value.get(u"rules")
+        if not isinstance(value, list):
+            raise PolicyError("Policy must be a list of rules")
+        return cls([Rule.from_json(rule) for rule in value], **kwargs)
+
+    def match(self, tx):
+        """ Return the first rule matching a transaction, or :const:`None`.
+        """
+        for rule in self.rules:
+            if rule.matches(tx):
+                return rule
+        return None
+
+    def evaluate(self, monitor, data):
+        """ Apply the rules to a snapshot from a monitor, queueing any kills
+        on that monitor.
+        """
+        transactions = data.transactions
+        if transactions is None:
+            return
+        address = monitor.address
+        victims = []
+        with self._lock:
+            if address not in self._requested:
+                self._requested[address] = {}
+                monitor.attach_kill_handler(partial(self._report, address))
+            requested = self._requested[address]
+            handled = self._handled.setdefault(address, set())
+            limited = self._limited.setdefault(address, set())
+            present = set()
+            for tx in transactions:
+                query_id = tx.raw(u"current_query_id")
+                if not query_id:
+                    # Nothing to kill until the transaction runs a query
+                    continue
+                key = (tx.raw(u"id"), query_id)
+                present.add(key)
+                if key in handled:
+                    continue
+                rule = self.match(tx)
+                if rule is None:
+                    continue
+                if self.dry_run or rule.dry_run:
+                    handled.add(key)
+                    self._log(u"dry-run", address, rule, tx)
+                elif self._take():
+                    handled.add(key)
+                    limited.discard(key)
+                    victims.append(tx)
+                    requested[query_id] = (rule, tx)
+                    self._log(u"kill-requested", address, rule, tx)
+                elif key not in limited:
+                    limited.add(key)
+                    self._log(u"rate-limited", address, rule, tx)
+            handled.intersection_update(present)
+            limited.intersection_update(present)
+        if victims:
+            monitor.kill_all(victims)
+
+    def _report(self, address, results):
+        """ Log the outcomes of the kills requested by this policy, out of
+        the :class:`agentsmith.killer.KillResult` objects reported by the
+        monitor of a server.
+        """
+        with self._lock:
+            requested = self._requested[address]
+            outcomes = [(requested.pop(result.query_id), result) for result in results
+                        if result.query_id in requested]
+        for (rule, tx), result in outcomes:
+            self._log(OUTCOMES.get(result.outcome, result.outcome), address, rule, tx, result.message)
+
+    def _take(self):
+        """ Take a token from the rate limiting bucket, if there is one.
+        """
+        now = monotonic()
+        rate = self.max_kills_per_second
+        self._tokens = min(max(rate, 1), self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _log(self, action, address, rule, tx, message=None):
+        if self.audit is not None:
+            self.audit.write(action, address, rule, tx, message)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import division
+
+from agentsmith.units import Time
+
+
+# Monotonic counters, by name, as (ServerData attribute, data attribute).
+# The ServerData attribute doubles as the name of the collector that
+# updates the counter.
+COUNTERS = {
+    u"begins": (u"transactions", u"begin_count"),
+    u"commits": (u"transactions", u"commit_count"),
+    u"rollbacks": (u"transactions", u"rollback_count"),
+    u"last_committed_id": (u"transactions", u"last_committed_id"),
+    u"page_hits": (u"page_cache", u"hits"),
+    u"page_faults": (u"page_cache", u"faults"),
+    u"page_pins": (u"page_cache", u"pins"),
+    u"page_evictions": (u"page_cache", u"evictions"),
+    u"page_flushes": (u"page_cache", u"flushes"),
+    u"bytes_read": (u"page_cache", u"bytes_read"),
+    u"bytes_written": (u"page_cache", u"bytes_written"),
+    u"process_cpu_time": (u"system", u"process_cpu_time"),
+    u"started_threads": (u"system", u"total_started_thread_count"),
+    u"averted_deadlocks": (u"locking", u"averted_deadlocks"),
+    u"lock_waits": (u"lock_waits", u"wait_count"),
+}
+
+
+def numeric(value):
+    """ Extract a raw number from a unit wrapper (or a plain number).
+    Times are returned in nanoseconds.
+    """
+    if value is None:
+        return None
+    elif isinstance(value, Time):
+        return value.ns
+    else:
+        return getattr(value, "value", value)
+
+
+class RateData(object):
+    """ Deltas and per-second rates of every monotonic counter, over the
+    most recent collection interval of the counter concerned.
+    """
+
+    def __init__(self, deltas):
+        self.__deltas = deltas
+
+    def __repr__(self):
+        s = ["Rates:"]
+        for name in sorted(self.__deltas):
+            s.append("    %s: %r/s" % (name, self.rate(name)))
+        return "\n".join(s)
+
+    def __contains__(self, name):
+        return name in self.__deltas
+
+    def delta(self, name):
+        """ Change in the named counter over its last interval, or
+        :const:`None` if fewer than two samples have been seen.
+        """
+        try:
+            return self.__deltas[name][0]
+        except KeyError:
+            return None
+
+    def interval(self, name):
+        """ Length of the last interval of the named counter, in seconds.
+        """
+        try:
+            return self.__deltas[name][1]
+        except KeyError:
+            return None
+
+    def rate(self, name):
+        """ Per-second rate of change of the named counter.
+        """
+        try:
+            delta, interval = self.__deltas[name]
+        except KeyError:
+            return None
+        return delta / interval
+
+    @property
+    def commit_rate(self):
+        return self.rate(u"commits")
+
+    @property
+    def rollback_rate(self):
+        return self.rate(u"rollbacks")
+
+    @property
+    def page_fault_rate(self):
+        return self.rate(u"page_faults")
+
+    @property
+    def bytes_read_rate(self):
+        return self.rate(u"bytes_read")
+
+    @property
+    def bytes_written_rate(self):
+        return self.rate(u"bytes_written")
+
+    @property
+    def lock_wait_rate(self):
+        """ Transactions starting to wait for a lock, per second.
+        """
+        return self.rate(u"lock_waits")
+
+    @property
+    def deadlock_rate(self):
+        """ Deadlocks detected (and broken) by the server, per second.
+        """
+        return self.rate(u"averted_deadlocks")
+
+    @property
+    def hit_ratio(self):
+        """ Page cache hit ratio over the last interval, as opposed to the
+        lifetime ratio reported by the server.
+        """
+        hits = self.delta(u"page_hits")
+        faults = self.delta(u"page_faults")
+        if hits is None or faults is None or hits + faults == 0:
+            return None
+        return hits / (hits + faults)
+
+
+class RateTracker(object):
+    """ Keeps the previous sample of every counter for a single server,
+    and derives :class:`.RateData` from each new snapshot.
+
+    A counter is only sampled when the collector that owns it has run
+    since the previous snapshot, so tiered collection intervals do not
+    produce spurious zero rates. A counter that goes backwards is taken
+    to have been reset by a restart; as with Prometheus, the new value is
+    then used as the delta, since it counts from zero.
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._deltas = {}
+
+    def update(self, data):
+        updated = data.updated or {}
+        for name, (section, attr) in COUNTERS.items():
+            t = updated.get(section)
+            value = numeric(getattr(getattr(data, section, None), attr, None))
+            if t is None or value is None:
+                continue
+            previous = self._samples.get(name)
+            if previous is not None and t <= previous[0]:
+                continue
+            if previous is not None:
+                delta = value - previous[1]
+                if delta < 0:
+                    delta = value
+                self._deltas[name] = (delta, t - previous[0])
+            self._samples[name] = (t, value)
+        return RateData(dict(self._deltas))
+
+    def reset(self):
+        self._samples.clear()
+        self._deltas.clear()
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact, append-only recording of monitor sessions.
+
+A recording file starts with an 8-byte magic string, followed by any
+number of chunks. Each chunk has a fixed-size header (marker, payload
+size, frame count, first and last frame time) and a zlib-compressed
+payload of frames. Chunks are self-contained: the string dictionary and
+the baselines for delta encoding are reset at the start of each one, so
+any chunk can be decoded without reading those before it, and the
+headers alone act as a time index.
+
+Frames are either facts frames, holding the static facts of a server,
+which are written once per chunk per server and again whenever they
+change, or snapshot frames, holding the raw data collected on a single
+tick. Within a frame, every string (including dictionary keys) is
+written once per chunk and referred to by number thereafter, and any
+integer that also appears at the same position in the previous snapshot
+frame of the same server is written as a difference from it.
+"""
+
+from __future__ import division
+
+from queue import Queue, Empty
+from struct import Struct
+from sys import stderr
+from threading import Thread
+from traceback import print_exception
+from zlib import compress, decompress
+
+
+MAGIC = b"AGSMREC1"
+
+CHUNK_MARKER = b"CHNK"
+CHUNK_HEADER = Struct(">4sIIdd")
+
+FACTS = u"F"
+SNAPSHOT = u"S"
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _NEW_STRING, _STRING, _LIST, _DICT, _DELTA = range(10)
+
+_DOUBLE = Struct(">d")
+
+
+class RecordingError(Exception):
+    """ Raised when a recording file cannot be read.
+    """
+
+
+def _scan(data):
+    """ Scan the chunk headers in the mapped contents of a recording file,
+    returning a list of (first time, last time, payload offset, payload
+    size, frame count) tuples for the complete chunks, and the offset at
+    which they end.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise RecordingError("File is not a recording")
+    chunks = []
+    offset = len(MAGIC)
+    while offset + CHUNK_HEADER.size <= len(data):
+        marker, size, count, first_time, last_time = CHUNK_HEADER.unpack_from(data, offset)
+        start = offset + CHUNK_HEADER.size
+        if marker != CHUNK_MARKER or start + size > len(data):
+            # Trailing garbage or a partly written final chunk
+            break
+        chunks.append((first_time, last_time, start, size, count))
+        offset = start + size
+    return chunks, offset
+
+
+class FrameEncoder(object):
+    """ Encodes the frames of a single chunk.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.strings = {}
+        self.count = 0
+        self.first_time = None
+        self.last_time = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def encode(self, frame, previous=None):
+        """ Encode a frame, leaving the chunk as it was if this fails.
+        """
+        size = len(self.buffer)
+        string_count = len(self.strings)
+        try:
+            self.value(frame, previous)
+        except Exception:
+            del self.buffer[size:]
+            if len(self.strings) > string_count:
+                self.strings = {string: index for string, index in self.strings.items() if index < string_count}
+            raise
+        self.count += 1
+        t = frame.get(u"t")
+        if t is not None:
+            if self.first_time is None:
+                self.first_time = t
+            self.last_time = t
+
+    def varint(self, n):
+        buffer = self.buffer
+        while n > 0x7F:
+            buffer.append(0x80 | (n & 0x7F))
+            n >>= 7
+        buffer.append(n)
+
+    def integer(self, n):
+        self.varint(2 * n if n >= 0 else -2 * n - 1)
+
+    def string(self, s):
+        try:
+            index = self.strings[s]
+        except KeyError:
+            self.strings[s] = len(self.strings)
+            data = s.encode("utf-8")
+            self.buffer.append(_NEW_STRING)
+            self.varint(len(data))
+            self.buffer.extend(data)
+        else:
+            self.buffer.append(_STRING)
+            self.varint(index)
+
+    def value(self, value, previous=None):
+        buffer = self.buffer
+        if value is None:
+            buffer.append(_NONE)
+        elif value is True:
+            buffer.append(_TRUE)
+        elif value is False:
+            buffer.append(_FALSE)
+        elif isinstance(value, int):
+            if isinstance(previous, int) and not isinstance(previous, bool):
+                buffer.append(_DELTA)
+                self.integer(value - previous)
+            else:
+                buffer.append(_INT)
+                self.integer(value)
+        elif isinstance(value, float):
+            buffer.append(_FLOAT)
+            buffer.extend(_DOUBLE.pack(value))
+        elif isinstance(value, (list, tuple)):
+            buffer.append(_LIST)
+            self.varint(len(value))
+            for item in value:
+                self.value(item)
+        elif isinstance(value, dict):
+            if not isinstance(previous, dict):
+                previous = {}
+            buffer.append(_DICT)
+            self.varint(len(value))
+            for key, item in value.items():
+                self.string(key)
+                self.value(item, previous.get(key))
+        else:
+            # Anything else (such as temporal values) is kept as text
+            self.string(u"%s" % value)
+
+
+class FrameDecoder(object):
+    """ Decodes the frames of a single chunk.
+    """
+
+    def __init__(self, payload):
+        self.data = payload
+        self.offset = 0
+        self.strings = []
+
+    def __iter__(self):
+        previous = {}
+        while self.offset < len(self.data):
+            frame = self.value()
+            if frame.get(u"k") == SNAPSHOT:
+                address = frame[u"a"]
+                frame = self.rebase(frame, previous.get(address))
+                previous[address] = frame
+            yield frame
+
+    def varint(self):
+        data = self.data
+        shift = n = 0
+        while True:
+            b = data[self.offset]
+            self.offset += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def integer(self):
+        n = self.varint()
+        return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+    def value(self):
+        tag = self.data[self.offset]
+        self.offset += 1
+        if tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            return self.integer()
+        elif tag == _DELTA:
+            return _Delta(self.integer())
+        elif tag == _FLOAT:
+            value, = _DOUBLE.unpack_from(self.data, self.offset)
+            self.offset += 8
+            return value
+        elif tag == _NEW_STRING:
+            size = self.varint()
+            s = bytes(self.data[self.offset:self.offset + size]).decode("utf-8")
+            self.offset += size
+            self.strings.append(s)
+            return s
+        elif tag == _STRING:
+            return self.strings[self.varint()]
+        elif tag == _LIST:
+            return [self.value() for _ in range(self.varint())]
+        elif tag == _DICT:
+            d = {}
+            for _ in range(self.varint()):
+                key = self.value()
+                d[key] = self.value()
+            return d
+        else:
+            raise RecordingError("Unknown tag %r at offset %d" % (tag, self.offset - 1))
+
+    def rebase(self, value, previous):
+        """ Replace delta-encoded integers with absolute values.
+        """
+        if isinstance(value, _Delta):
+            return previous + value.delta
+        elif isinstance(value, dict):
+            if not isinstance(previous, dict):
+                previous = {}
+            return {key: self.rebase(item, previous.get(key)) for key, item in value.items()}
+        elif isinstance(value, list):
+            return [self.rebase(item, None) for item in value]
+        else:
+            return value
+
+
+class _Delta(object):
+
+    __slots__ = ["delta"]
+
+    def __init__(self, delta):
+        self.delta = delta
+
+
+class Recorder(object):
+    """ Appends snapshots to a recording file. Encoding, compression and
+    writing all happen on a background thread, so :meth:`.record` never
+    blocks the poll loop.
+
+    If the file already exists, anything after its last complete chunk
+    (such as a chunk left partly written by a crash) is cut off before
+    appending, so that the new chunks can be read.
+
+    A snapshot that cannot be encoded is reported and left out. If the
+    file cannot be written, the error is reported and no more snapshots
+    are taken.
+    """
+
+    def __init__(self, path, chunk_size=1048576, chunk_seconds=60.0):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk_seconds = chunk_seconds
+        self._file = open(path, "a+b")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        else:
+            self._truncate()
+        self._failed = False
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name="agentsmith-recorder", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<Recorder path=%r>" % self.path
+
+    def record(self, address, data):
+        if self._failed:
+            return
+        if data is not None and data.sources is not None and data.collected_at is not None:
+            self._queue.put((address, data))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _truncate(self):
+        from mmap import mmap, ACCESS_READ
+        data = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        size = len(data)
+        try:
+            _, end = _scan(data)
+        except RecordingError:
+            self._file.close()
+            raise RecordingError("File %r is not a recording" % self.path)
+        finally:
+            data.close()
+        if end < size:
+            self._file.truncate(end)
+        self._file.seek(end)
+
+    def _run(self):
+        try:
+            self._encode_all()
+        except Exception as error:
+            # Nothing more can be written, so stop taking snapshots and
+            # drop any that are waiting
+            self._failed = True
+            print_exception(type(error), error, error.__traceback__, file=stderr)
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except Empty:
+                pass
+        finally:
+            self._file.close()
+
+    def _encode_all(self):
+        encoder = FrameEncoder()
+        facts = {}
+        previous = {}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            address, data = item
+            try:
+                if facts.get(address) is not data.facts:
+                    encoder.encode({u"k": FACTS, u"a": address, u"f": data.facts.sources})
+                    facts[address] = data.facts
+                frame = {u"k": SNAPSHOT, u"a": address, u"t": data.collected_at, u"s": data.sources}
+                encoder.encode(frame, previous.get(address))
+            except Exception as error:
+                # Leave out this snapshot, but carry on with the others
+                print_exception(type(error), error, error.__traceback__, file=stderr)
+                continue
+            previous[address] = frame
+            if len(encoder) >= self.chunk_size or encoder.last_time - encoder.first_time >= self.chunk_seconds:
+                self._write(encoder)
+                encoder = FrameEncoder()
+                facts.clear()
+                previous.clear()
+        self._write(encoder)
+
+    def _write(self, encoder):
+        if encoder.count == 0:
+            return
+        payload = compress(bytes(encoder.buffer), 6)
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MARKER, len(payload), encoder.count,
+                                           encoder.first_time, encoder.last_time))
+        self._file.write(payload)
+        self._file.flush()
+
+
+class Recording(object):
+    """ Read access to a recording file. The file is memory-mapped and
+    the chunk headers are scanned once on opening to form a time index,
+    without decompressing any payloads.
+    """
+
+    def __init__(self, path):
+        from mmap import mmap, ACCESS_READ
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            raise RecordingError("Recording %r is empty" % path)
+        try:
+            self.chunks, _ = _scan(self._map)
+        except RecordingError:
+            raise RecordingError("File %r is not a recording" % path)
+
+    def __repr__(self):
+        return "<Recording path=%r chunks=%d>" % (self.path, len(self.chunks))
+
+    def __len__(self):
+        return sum(chunk[4] for chunk in self.chunks)
+
+    @property
+    def start_time(self):
+        return self.chunks[0][0] if self.chunks else None
+
+    @property
+    def end_time(self):
+        return self.chunks[-1][1] if self.chunks else None
+
+    def chunk_index(self, t):
+        """ Return the index of the first chunk that may hold frames at or
+        after time `t`, by binary search over the chunk headers.
+        """
+        lo, hi = 0, len(self.chunks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.chunks[mid][1] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_chunk(self, index):
+        """ Decode and return all frames in a chunk.
+        """
+        _, _, start, size, _ = self.chunks[index]
+        return list(FrameDecoder(decompress(self._map[start:start + size])))
+
+    def frames(self, since=None):
+        """ Iterate through frames in order, starting from the given time.
+        Facts frames are always included, so that a reader starting part
+        way through a chunk still knows the facts of every server.
+        """
+        first = 0 if since is None else self.chunk_index(since)
+        for index in range(first, len(self.chunks)):
+            for frame in self.read_chunk(index):
+                if since is None or frame[u"k"] == FACTS or frame[u"t"] >= since:
+                    yield frame
+
+    def close(self):
+        self._map.close()
+        self._file.close()
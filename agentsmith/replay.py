@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Playback of recording files. A :class:`.Player` reads frames from a
+:class:`agentsmith.recording.Recording` on a background thread, pacing
+them by their timestamps, and hands each one to a :class:`.ReplayMonitor`
+for its server. Replay monitors rebuild snapshots from the raw data in
+each frame, in exactly the same way as a live monitor, and present the
+same interface to the controls that display them.
+"""
+
+from __future__ import division
+
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+from agentsmith.jmx import JmxIndex
+from agentsmith.monitor import ServerFacts, SnapshotBuilder
+from agentsmith.recording import Recording, FACTS
+
+
+SPEEDS = (1.0, 10.0, 100.0)
+
+
+def parse_offset(text):
+    """ Parse a time offset given as seconds, "MM:SS" or "HH:MM:SS".
+    """
+    seconds = 0.0
+    for part in text.split(u":"):
+        seconds = 60 * seconds + float(part)
+    return seconds
+
+
+def format_offset(seconds):
+    """ Format a time offset as "MM:SS", or "H:MM:SS" if over an hour.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%02d:%02d" % (minutes, seconds)
+
+
+class ReplayMonitor(object):
+    """ Stand-in for :class:`agentsmith.monitor.ServerMonitor` that is fed
+    by a :class:`.Player` instead of a server.
+    """
+
+    def __init__(self, player, address):
+        self._player = player
+        self._address = address
+        self._lock = Lock()
+        self._handlers = set()
+        self._facts = None
+        self._builder = SnapshotBuilder()
+        self._data = None
+
+    def __repr__(self):
+        return "<ReplayMonitor address=%r>" % self._address
+
+    def attach(self, handler):
+        with self._lock:
+            self._handlers.add(handler)
+            data = self._data
+        if data is not None and callable(handler):
+            handler(data)
+
+    def detach(self, handler):
+        with self._lock:
+            self._handlers.discard(handler)
+
+    @property
+    def intervals(self):
+        return {}
+
+    def set_interval(self, collector, interval):
+        pass
+
+    @property
+    def transaction_view(self):
+        return None
+
+    def set_transaction_view(self, view):
+        # Recorded transactions are already sorted and limited as they
+        # were when collected
+        pass
+
+    def kill(self, tx):
+        # Recorded transactions cannot be killed
+        pass
+
+    def kill_all(self, transactions):
+        pass
+
+    def attach_kill_handler(self, handler):
+        pass
+
+    def detach_kill_handler(self, handler):
+        pass
+
+    def exit(self):
+        pass
+
+    def reset(self):
+        """ Discard all state, ready to play from a new position.
+        """
+        with self._lock:
+            self._facts = None
+            self._builder = SnapshotBuilder()
+            self._data = None
+
+    def replay(self, frame):
+        """ Rebuild state from a single frame, without notifying any
+        handlers.
+        """
+        if frame[u"k"] == FACTS:
+            self._facts = ServerFacts(**frame[u"f"])
+        elif self._facts is not None:
+            sources = frame[u"s"]
+            data = self._builder.update(self._facts, JmxIndex.from_values(sources[u"jmx"]),
+                                        sources[u"results"], sources[u"due"], frame[u"t"])
+            with self._lock:
+                self._data = data
+
+    def notify(self):
+        with self._lock:
+            handlers = list(self._handlers)
+            data = self._data
+        if data is None:
+            return
+        for handler in handlers:
+            if callable(handler):
+                handler(data)
+
+    @property
+    def for_cluster_core(self):
+        return False
+
+    @property
+    def uri(self):
+        return "file://{}#{}".format(self._player.recording.path, self._address)
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def history(self):
+        return self._builder.history
+
+    @property
+    def jmx_bytes_saved(self):
+        return None
+
+    @property
+    def up(self):
+        return self._data is not None
+
+
+class Player(object):
+    """ Plays a recording back in (scaled) real time, with pause, seek and
+    speed control. All controls may be used from any thread.
+
+    Playback follows a virtual clock, which runs at `speed` times wall
+    clock time while playing and stands still while paused. Frames are
+    released as the clock passes their timestamps. Seeking uses the
+    chunk index of the recording to find the right place in the file
+    without decoding anything before it; frames earlier in the same
+    chunk are then applied without pacing, so that rates and history
+    are available as soon as playback resumes.
+    """
+
+    def __init__(self, path, speed=1.0, start=0.0):
+        self.recording = Recording(path)
+        self._cond = Condition()
+        self._monitors = {}
+        self._running = True
+        self._paused = False
+        self._speed = speed
+        self._anchor = self._anchor_wall = None
+        self._seek_to = self._clamp(self.start_time + start)
+        self._reanchor(self._seek_to)
+        self._thread = Thread(target=self._run, name="agentsmith-player", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<Player recording=%r>" % self.recording
+
+    @property
+    def start_time(self):
+        return self.recording.start_time or 0.0
+
+    @property
+    def end_time(self):
+        return self.recording.end_time or 0.0
+
+    @property
+    def addresses(self):
+        """ Addresses of all servers in the first chunk of the recording.
+        """
+        if not self.recording.chunks:
+            return []
+        addresses = []
+        for frame in self.recording.read_chunk(0):
+            if frame[u"a"] not in addresses:
+                addresses.append(frame[u"a"])
+        return addresses
+
+    def monitor(self, address, auth=None, prefer_routing=False, on_error=None):
+        """ Return the replay monitor for a server, creating it if need
+        be. The signature matches that of
+        :class:`agentsmith.monitor.ServerMonitor` so that this can be used
+        as a drop-in monitor factory.
+        """
+        with self._cond:
+            try:
+                return self._monitors[address]
+            except KeyError:
+                monitor = self._monitors[address] = ReplayMonitor(self, address)
+                return monitor
+
+    @property
+    def position(self):
+        """ Current position on the virtual clock, as seconds since the
+        epoch.
+        """
+        with self._cond:
+            return self._clamp(self._clock())
+
+    @property
+    def offset(self):
+        return self.position - self.start_time
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def set_speed(self, speed):
+        with self._cond:
+            self._reanchor(self._clock())
+            self._speed = speed
+            self._cond.notify_all()
+
+    def pause(self):
+        with self._cond:
+            self._reanchor(self._clock())
+            self._paused = True
+            self._cond.notify_all()
+
+    def resume(self):
+        with self._cond:
+            self._reanchor(self._clock())
+            self._paused = False
+            self._cond.notify_all()
+
+    def toggle(self):
+        if self._paused:
+            self.resume()
+        else:
+            self.pause()
+
+    def seek(self, t):
+        """ Move to an absolute time (seconds since the epoch).
+        """
+        with self._cond:
+            self._seek_to = self._clamp(t)
+            self._reanchor(self._seek_to)
+            self._cond.notify_all()
+
+    def skip(self, seconds):
+        """ Move forwards (or backwards, if negative) by a number of
+        seconds.
+        """
+        self.seek(self.position + seconds)
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self.recording.close()
+
+    def _clamp(self, t):
+        return min(max(t, self.start_time), self.end_time)
+
+    def _clock(self):
+        if self._paused:
+            return self._anchor
+        return self._anchor + (monotonic() - self._anchor_wall) * self._speed
+
+    def _reanchor(self, t):
+        self._anchor = t
+        self._anchor_wall = monotonic()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._seek_to is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                target, self._seek_to = self._seek_to, None
+            self._play(target)
+
+    def _play(self, target):
+        with self._cond:
+            monitors = list(self._monitors.values())
+        for monitor in monitors:
+            monitor.reset()
+        recording = self.recording
+        caught_up = set()
+        for index in range(recording.chunk_index(target), len(recording.chunks)):
+            for frame in recording.read_chunk(index):
+                monitor = self.monitor(frame[u"a"])
+                if frame[u"k"] == FACTS or frame[u"t"] < target:
+                    monitor.replay(frame)
+                    caught_up.add(monitor)
+                    continue
+                while caught_up:
+                    caught_up.pop().notify()
+                if not self._wait_until(frame[u"t"]):
+                    return
+                monitor.replay(frame)
+                monitor.notify()
+        while caught_up:
+            caught_up.pop().notify()
+
+    def _wait_until(self, t):
+        """ Wait until the virtual clock reaches time `t`, returning
+        :const:`False` if interrupted by a seek or by closing the player.
+        """
+        with self._cond:
+            while True:
+                if not self._running or self._seek_to is not None:
+                    return False
+                if self._paused:
+                    self._cond.wait()
+                    continue
+                remaining = t - self._clock()
+                if remaining <= 0:
+                    return True
+                self._cond.wait(remaining / self._speed)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import division
+
+from threading import Lock
+
+
+DEFAULT_INTERVALS = {
+    u"system": 1.0,
+    u"memory": 1.0,
+    u"transactions": 1.0,
+    u"queries": 1.0,
+    u"page_cache": 1.0,
+    u"locks": 1.0,
+    u"storage": 10.0,
+    u"cluster_overview": 10.0,
+    # Reading the Locking MBean makes the server list every lock held
+    u"locking": 10.0,
+}
+
+
+class Tier(object):
+    """ A family of metrics that is collected together, on its own
+    interval. A tier is considered due slightly before its interval has
+    fully elapsed, so that a tick fired on a fixed clock with a little
+    jitter does not skip it.
+    """
+
+    slack = 0.05
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.last = None
+
+    def __repr__(self):
+        return "<Tier name=%r interval=%r>" % (self.name, self.interval)
+
+    def due(self, now):
+        return self.last is None or now - self.last >= self.interval - self.slack
+
+    def next_due(self, now):
+        if self.last is None:
+            return now
+        return self.last + self.interval
+
+
+class Schedule(object):
+    """ Refresh schedule for a single server, made up of one tier per
+    collector. Intervals can be changed at any time, from any thread;
+    the change takes effect from the next tick.
+    """
+
+    def __init__(self, intervals=None):
+        self._lock = Lock()
+        self._tiers = {}
+        for name, interval in dict(DEFAULT_INTERVALS, **(intervals or {})).items():
+            self._tiers[name] = Tier(name, interval)
+
+    def __repr__(self):
+        return "<Schedule %r>" % self.intervals
+
+    def __contains__(self, name):
+        return name in self._tiers
+
+    @property
+    def intervals(self):
+        with self._lock:
+            return {name: tier.interval for name, tier in self._tiers.items()}
+
+    def set_interval(self, name, interval):
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        with self._lock:
+            self._tiers[name].interval = interval
+
+    def due(self, now):
+        """ Return the names of all tiers that are due for collection.
+        """
+        with self._lock:
+            return [name for name, tier in self._tiers.items() if tier.due(now)]
+
+    def mark(self, names, now):
+        """ Record that the tiers named have been collected.
+        """
+        with self._lock:
+            for name in names:
+                self._tiers[name].last = now
+
+    def reset(self):
+        """ Make every tier immediately due, e.g. following a reconnect.
+        """
+        with self._lock:
+            for tier in self._tiers.values():
+                tier.last = None
+
+    def wait_time(self, now):
+        """ Return the number of seconds until the next tier falls due.
+        """
+        with self._lock:
+            return max(0.0, min(tier.next_due(now) for tier in self._tiers.values()) - now)
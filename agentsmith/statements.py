@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Statement fingerprinting and per-statement statistics, in the manner of
+PostgreSQL's `pg_stat_statements`.
+
+A fingerprint is the text of a Cypher statement with its literals
+replaced by `?` and its whitespace and comments collapsed, so that the
+same statement run with different literal values is counted as one.
+"""
+
+from __future__ import division
+
+from functools import lru_cache
+import re
+
+from agentsmith.tracking import ListData, RowTracker
+from agentsmith.units import Amount, BytesAmount, Time
+
+
+_TOKENS = re.compile(r"""
+    (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<identifier>`(?:[^`]|``)*`)
+  | (?P<parameter>\$\w+|\{\w+\})
+  | (?P<number>\b(?:0x[0-9A-Fa-f]+|\d+(?:\.\d+)?(?:[Ee][+-]?\d+)?)\b)
+  | (?P<space>(?:\s|//[^\n]*|/\*.*?\*/)+)
+""", re.VERBOSE | re.DOTALL)
+
+_LITERAL_LISTS = re.compile(r"\[ ?\?(?: ?, ?\?)* ?\]")
+
+
+def _token(match):
+    kind = match.lastgroup
+    if kind == u"string" or kind == u"number":
+        return u"?"
+    elif kind == u"space":
+        return u" "
+    else:
+        return match.group()
+
+
+def normalize(text):
+    """ Return the fingerprint of a Cypher statement. String and number
+    literals become `?`, lists of literals become `[?]`, and comments
+    and runs of whitespace become a single space. Identifiers (quoted or
+    otherwise) and parameters are left as they are.
+    """
+    if text is None:
+        return None
+    return _LITERAL_LISTS.sub(u"[?]", _TOKENS.sub(_token, text).strip())
+
+
+# Statement texts repeat from one poll to the next, so fingerprints are
+# cached rather than worked out again
+fingerprint = lru_cache(maxsize=4096)(normalize)
+
+
+class StatementData(object):
+    """ Accumulated statistics for a single statement fingerprint.
+
+    Times are held in milliseconds and everything else as plain numbers,
+    and are wrapped in units on access.
+    """
+
+    __slots__ = ["fingerprint", "example", "_values"]
+
+    def __init__(self, fingerprint, example, values):
+        self.fingerprint = fingerprint
+        self.example = example
+        self._values = values
+
+    def __repr__(self):
+        return "<StatementData fingerprint=%r count=%r total_time=%r>" % (
+            self.fingerprint, self.count, self.total_time)
+
+    @property
+    def count(self):
+        """ Number of executions seen.
+        """
+        return Amount(self._values[0])
+
+    @property
+    def total_time(self):
+        return Time(ms=self._values[1])
+
+    @property
+    def mean_time(self):
+        return Time(ms=self._values[1] / self._values[0]) if self._values[0] else Time(ms=0)
+
+    @property
+    def max_time(self):
+        return Time(ms=self._values[2])
+
+    @property
+    def cpu_time(self):
+        return Time(ms=self._values[3])
+
+    @property
+    def wait_time(self):
+        return Time(ms=self._values[4])
+
+    @property
+    def page_faults(self):
+        return Amount(self._values[5])
+
+    @property
+    def allocated_bytes(self):
+        return BytesAmount(self._values[6])
+
+    def raw(self, name):
+        """ Return the raw, undecoded value behind an attribute, which is
+        cheap to compare between snapshots.
+        """
+        if name == u"fingerprint":
+            return self.fingerprint
+        return self._values[_VALUES.index(name)]
+
+
+_VALUES = (u"count", u"total_time", u"max_time", u"cpu_time", u"wait_time", u"page_faults", u"allocated_bytes")
+
+
+class StatementListData(ListData):
+    """ Statistics of every statement fingerprint seen, most costly (by
+    total elapsed time) first.
+    """
+
+    def __init__(self, statements):
+        super(StatementListData, self).__init__(
+            sorted(statements, key=lambda statement: statement.raw(u"total_time"), reverse=True))
+
+
+class StatementTracker(RowTracker):
+    """ Accumulates :class:`.StatementData` for a single server from the
+    query list in each snapshot.
+
+    Each query is tracked by its ID from one poll to the next (see
+    :class:`agentsmith.tracking.RowTracker`). A query adds one to the
+    count of its fingerprint when first seen, and on every poll adds the
+    growth of its elapsed time, CPU time, wait time, page faults and
+    allocated bytes since the previous poll. Queries that start and
+    finish between two polls are never seen, so counts are a lower bound.
+
+    At most `capacity` fingerprints are kept.
+    """
+
+    source = u"queries"
+
+    def _sample(self, query):
+        return query.raw(u"id"), fingerprint(query.raw(u"text")), (
+            query.raw(u"elapsed_time") or 0, query.raw(u"cpu_time") or 0, query.raw(u"wait_time") or 0,
+            query.raw(u"page_faults") or 0, query.raw(u"allocated_bytes") or 0)
+
+    def _new_values(self, query):
+        return [0, 0, 0, 0, 0, 0, 0, query.raw(u"text")]
+
+    def _accrue(self, values, query, growth, new):
+        if new:
+            values[0] += 1
+        values[1] += growth[0]
+        values[2] = max(values[2], query.raw(u"elapsed_time") or 0)
+        for i in range(1, 5):
+            values[i + 2] += growth[i]
+
+    def _build(self, queries, keys):
+        return StatementListData(StatementData(key, values[7], tuple(values[:7]))
+                                 for key, values in self._values.items())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Building blocks for the trackers that derive lists of statistics from
+the rows of each snapshot, such as statements and accounts.
+"""
+
+from __future__ import division
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+
+class ListData(object):
+    """ Read-only list of the items derived from a snapshot.
+    """
+
+    def __init__(self, items):
+        self._items = items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, item):
+        return self._items[item]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __repr__(self):
+        return "<%s size=%d>" % (type(self).__name__, len(self))
+
+
+class RowTracker(metaclass=ABCMeta):
+    """ Accumulates figures, by key, from the rows of a list in each
+    snapshot, such as running queries or transactions.
+
+    Rows are sampled while running, so each is followed by its ID from
+    one poll to the next. A row adds the growth of its sampled figures
+    since the previous poll (or the figures themselves, if it is new or
+    now falls under a different key); figures that shrink add nothing.
+
+    At most `capacity` keys are kept; once full, the one least recently
+    seen is dropped to make room for a new one.
+
+    Subclasses set `source` to the name of the
+    :class:`agentsmith.monitor.ServerData` attribute holding the rows and
+    implement :meth:`._sample`, :meth:`._new_values`, :meth:`._accrue` and
+    :meth:`._build`.
+    """
+
+    source = None
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._values = OrderedDict()
+        self._running = {}
+        self._updated = None
+        self._data = None
+
+    def update(self, data):
+        rows = getattr(data, self.source)
+        if rows is None:
+            return None
+        updated = (data.updated or {}).get(self.source)
+        if self._data is not None and updated == self._updated:
+            return self._data
+        values_by_key = self._values
+        running = {}
+        keys = []
+        for row in rows:
+            row_id, key, sample = self._sample(row)
+            running[row_id] = (key, sample)
+            keys.append(key)
+            try:
+                values = values_by_key[key]
+            except KeyError:
+                values = values_by_key[key] = self._new_values(row)
+                if len(values_by_key) > self.capacity:
+                    values_by_key.popitem(last=False)
+            else:
+                values_by_key.move_to_end(key)
+            previous = self._running.get(row_id)
+            new = previous is None or previous[0] != key
+            if new:
+                growth = tuple(max(figure, 0) for figure in sample)
+            else:
+                growth = tuple(max(figure - last, 0) for figure, last in zip(sample, previous[1]))
+            self._accrue(values, row, growth, new)
+        self._running = running
+        self._updated = updated
+        self._data = self._build(rows, keys)
+        return self._data
+
+    @abstractmethod
+    def _sample(self, row):
+        """ Return the ID, key and tuple of sampled figures of a row.
+        """
+
+    @abstractmethod
+    def _new_values(self, row):
+        """ Return the initial, mutable, values for the key of a row.
+        """
+
+    @abstractmethod
+    def _accrue(self, values, row, growth, new):
+        """ Add the growth in the figures of a row to the values for its
+        key. `new` is true the first time a row is seen under that key.
+        """
+
+    @abstractmethod
+    def _build(self, rows, keys):
+        """ Return the data for a snapshot, given its rows and the key of
+        each, once all rows have been accrued.
+        """
+
+    def reset(self):
+        self._values.clear()
+        self._running.clear()
+        self._updated = None
+        self._data = None
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmark of the per-tick cost of building the transaction list.
+
+A tick is modelled as the UI sees it: build a list of transactions from
+the raw `dbms.listTransactions` rows, sort it by elapsed time, then read
+the displayed fields of the top screenful. This is measured both for the
+original, eagerly decoded transaction class (reproduced below) and for
+the current, lazily decoded one.
+
+    python benchmarks/transactions.py [--rows N] [--ticks N] [--shown N]
+"""
+
+from __future__ import division, print_function
+
+from argparse import ArgumentParser
+from os.path import dirname, join as path_join
+from sys import path
+from timeit import default_timer
+import tracemalloc
+
+path.insert(0, path_join(dirname(__file__), ".."))
+
+from agentsmith.monitor import TransactionData
+from agentsmith.units import Amount, BytesAmount, Time
+
+
+class EagerTransactionData(object):
+    """ Transaction class as it was before lazy decoding.
+    """
+
+    def __init__(self, transaction):
+        self.id = int(transaction[u"transactionId"].partition("-")[-1])
+        self.user = transaction[u"username"]
+        self.metadata = transaction[u"metaData"]
+        self.start_time = transaction[u"startTime"]
+        self.protocol = transaction[u"protocol"]
+        self.client_address = transaction[u"clientAddress"]
+        self.request_uri = transaction[u"requestUri"]
+        self.current_query_id_string = transaction[u"currentQueryId"]
+        if self.current_query_id_string:
+            self.current_query_id = int(self.current_query_id_string.partition("-")[-1])
+        else:
+            self.current_query_id = None
+        self.current_query = transaction[u"currentQuery"]
+        self.active_lock_count = Amount(transaction[u"activeLockCount"])
+        self.status = transaction[u"status"]
+        self.resource_information = transaction[u"resourceInformation"]
+        self.elapsed_time = Time(ms=transaction[u"elapsedTimeMillis"])
+        self.cpu_time = Time(ms=transaction[u"cpuTimeMillis"])
+        self.wait_time = Time(ms=transaction[u"waitTimeMillis"])
+        self.idle_time = Time(ms=transaction[u"idleTimeMillis"])
+        self.allocated_bytes = BytesAmount(transaction[u"allocatedBytes"])
+        self.allocated_direct_bytes = BytesAmount(transaction[u"allocatedDirectBytes"])
+        self.page_hits = Amount(transaction[u"pageHits"])
+        self.page_faults = Amount(transaction[u"pageFaults"])
+
+
+def make_rows(n):
+    return [{
+        u"transactionId": u"transaction-%d" % i,
+        u"username": u"neo4j",
+        u"metaData": {},
+        u"startTime": u"2018-10-18T11:04:17.938Z",
+        u"protocol": u"bolt",
+        u"clientAddress": u"127.0.0.1:%d" % (40000 + i % 100),
+        u"requestUri": u"127.0.0.1:7687",
+        u"currentQueryId": u"query-%d" % (10 * i),
+        u"currentQuery": u"MATCH (a:Person {id: $id}) RETURN a",
+        u"activeLockCount": i % 4,
+        u"status": u"Running",
+        u"resourceInformation": {},
+        u"elapsedTimeMillis": (i * 7919) % 100000,
+        u"cpuTimeMillis": i % 1000,
+        u"waitTimeMillis": i % 10,
+        u"idleTimeMillis": i % 100,
+        u"allocatedBytes": 1024 * i,
+        u"allocatedDirectBytes": 0,
+        u"pageHits": i,
+        u"pageFaults": i % 3,
+    } for i in range(n)]
+
+
+def tick(cls, rows, shown):
+    transactions = sorted(map(cls, rows), key=lambda tx: tx.elapsed_time, reverse=True)
+    for tx in transactions[:shown]:
+        (tx.id, tx.user, tx.client_address, tx.protocol, tx.active_lock_count, tx.page_hits,
+         tx.page_faults, tx.elapsed_time, tx.cpu_time, tx.wait_time, tx.idle_time, tx.current_query)
+    return transactions
+
+
+def measure(cls, rows, ticks, shown):
+    tick(cls, rows, shown)
+    t0 = default_timer()
+    for _ in range(ticks):
+        tick(cls, rows, shown)
+    seconds = (default_timer() - t0) / ticks
+    tracemalloc.start()
+    snapshot_0 = tracemalloc.take_snapshot()
+    result = tick(cls, rows, shown)
+    snapshot_1 = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = snapshot_1.compare_to(snapshot_0, "filename")
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    del result
+    return seconds, blocks, size
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000, help="transactions per tick (default 5000)")
+    parser.add_argument("--ticks", type=int, default=50, help="ticks to time (default 50)")
+    parser.add_argument("--shown", type=int, default=50, help="rows displayed per tick (default 50)")
+    args = parser.parse_args()
+    rows = make_rows(args.rows)
+    print("{} transactions per tick, {} shown".format(args.rows, args.shown))
+    print("{:<8} {:>10} {:>12} {:>12}".format("", "ms/tick", "live blocks", "live KiB"))
+    for name, cls in [("eager", EagerTransactionData), ("lazy", TransactionData)]:
+        seconds, blocks, size = measure(cls, rows, args.ticks, args.shown)
+        print("{:<8} {:>10.2f} {:>12} {:>12.0f}".format(name, 1000 * seconds, blocks, size / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,7 +28,7 @@ from agentsmith.meta import __author__, __email__, __license__, __package__, __v
 with open(path_join(dirname(__file__), "README.rst")) as f:
     README = f.read()
 
-packages = find_packages(exclude=[])
+packages = find_packages(exclude=["test", "test.*"])
 package_metadata = {
     "name": __package__,
     "version": __version__,
@@ -43,6 +43,7 @@ package_metadata = {
         ],
     },
     "packages": packages,
+    "python_requires": ">=3.6",
     "install_requires": [
         "click~=7.0",
         "neo4j~=1.7.4",
@@ -58,11 +59,8 @@ package_metadata = {
         "Natural Language :: English",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3 :: Only",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: Implementation :: CPython",
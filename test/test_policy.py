@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Copyright 2018, Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from io import StringIO
+from json import loads
+from unittest import TestCase
+from unittest.mock import patch
+
+from agentsmith.killer import KillResult, KILLED, NOT_FOUND, QUERY_CHANGED, FAILED
+from agentsmith.policy import AuditLog, KillPolicy, PolicyError, Rule
+
+
+class FakeTransaction(object):
+
+    def __init__(self, tx_id, **fields):
+        self.id = tx_id
+        self.fields = dict(fields, id=tx_id)
+
+    def raw(self, name):
+        return self.fields.get(name)
+
+
+class FakeData(object):
+
+    def __init__(self, transactions):
+        self.transactions = transactions
+
+
+class FakeMonitor(object):
+
+    def __init__(self, address=u"localhost:7687"):
+        self.address = address
+        self.kill_handlers = []
+        self.killed = []
+
+    def attach_kill_handler(self, handler):
+        self.kill_handlers.append(handler)
+
+    def kill_all(self, transactions):
+        self.killed.append(list(transactions))
+
+    def report(self, results):
+        for handler in self.kill_handlers:
+            handler(results)
+
+
+def tx(tx_id, query_id=u"query-1", **fields):
+    fields.setdefault(u"user", u"neo4j")
+    fields.setdefault(u"elapsed_time", 1000)
+    return FakeTransaction(tx_id, current_query_id=query_id, **fields)
+
+
+class RuleCompilationTestCase(TestCase):
+
+    def test_from_json(self):
+        rule = Rule.from_json({u"name": u"slow", u"when": {u"elapsed_time_ms": {u">": 10}}, u"dry_run": True})
+        self.assertEqual(rule.name, u"slow")
+        self.assertTrue(rule.dry_run)
+
+    def test_rule_must_be_an_object(self):
+        with self.assertRaises(PolicyError):
+            Rule.from_json([u"slow"])
+
+    def test_rule_must_have_a_name(self):
+        with self.assertRaises(PolicyError):
+            Rule.from_json({u"when": {u"user": u"neo4j"}})
+
+    def test_rule_must_have_a_when_object(self):
+        with self.assertRaises(PolicyError):
+            Rule.from_json({u"name": u"slow", u"when": u"always"})
+
+    def test_rule_must_have_conditions(self):
+        with self.assertRaises(PolicyError):
+            Rule.from_json({u"name": u"slow", u"when": {}})
+
+    def test_unknown_rule_key(self):
+        with self.assertRaises(PolicyError):
+            Rule.from_json({u"name": u"slow", u"when": {u"user": u"neo4j"}, u"action": u"kill"})
+
+    def test_unknown_field(self):
+        with self.assertRaises(PolicyError):
+            Rule(u"slow", {u"colour": u"red"})
+
+    def test_unknown_operator(self):
+        with self.assertRaises(PolicyError):
+            Rule(u"slow", {u"elapsed_time_ms": {u"=>": 10}})
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(PolicyError):
+            Rule(u"slow", {u"current_query": {u"matches": u"("}})
+
+    def test_in_needs_a_list(self):
+        with self.assertRaises(PolicyError):
+            Rule(u"slow", {u"user": {u"in": u"neo4j"}})
+
+
+class RuleMatchingTestCase(TestCase):
+
+    def test_plain_value_is_equality(self):
+        rule = Rule(u"r", {u"user": u"reporting"})
+        self.assertTrue(rule.matches(tx(1, user=u"reporting")))
+        self.assertFalse(rule.matches(tx(1, user=u"neo4j")))
+
+    def test_comparisons(self):
+        rule = Rule(u"r", {u"elapsed_time_ms": {u">": 100, u"<=": 200}})
+        self.assertFalse(rule.matches(tx(1, elapsed_time=100)))
+        self.assertTrue(rule.matches(tx(1, elapsed_time=101)))
+        self.assertTrue(rule.matches(tx(1, elapsed_time=200)))
+        self.assertFalse(rule.matches(tx(1, elapsed_time=201)))
+
+    def test_all_conditions_must_hold(self):
+        rule = Rule(u"r", {u"user": u"reporting", u"elapsed_time_ms": {u">": 100}})
+        self.assertFalse(rule.matches(tx(1, user=u"reporting", elapsed_time=50)))
+        self.assertFalse(rule.matches(tx(1, user=u"neo4j", elapsed_time=500)))
+        self.assertTrue(rule.matches(tx(1, user=u"reporting", elapsed_time=500)))
+
+    def test_in_and_not_in(self):
+        self.assertTrue(Rule(u"r", {u"user": {u"in": [u"a", u"b"]}}).matches(tx(1, user=u"b")))
+        self.assertFalse(Rule(u"r", {u"user": {u"not in": [u"a", u"b"]}}).matches(tx(1, user=u"b")))
+
+    def test_matches_searches(self):
+        rule = Rule(u"r", {u"current_query": {u"matches": u"(?i)detach delete"}})
+        self.assertTrue(rule.matches(tx(1, current_query=u"MATCH (n) DETACH DELETE n")))
+        self.assertFalse(rule.matches(tx(1, current_query=u"MATCH (n) RETURN n")))
+
+    def test_derived_client_field(self):
+        rule = Rule(u"r", {u"client": u"10.0.0.1"})
+        self.assertTrue(rule.matches(tx(1, client_address=u"10.0.0.1:51234")))
+
+    def test_missing_value_never_matches(self):
+        self.assertFalse(Rule(u"r", {u"cpu_time_ms": {u">=": 0}}).matches(tx(1, cpu_time=None)))
+        self.assertFalse(Rule(u"r", {u"cpu_time_ms": {u"!=": 5}}).matches(tx(1, cpu_time=None)))
+
+    def test_incomparable_value_does_not_match(self):
+        self.assertFalse(Rule(u"r", {u"user": {u">": 5}}).matches(tx(1, user=u"neo4j")))
+
+    def test_first_matching_rule_is_applied(self):
+        first = Rule(u"first", {u"elapsed_time_ms": {u">": 100}})
+        second = Rule(u"second", {u"user": u"neo4j"})
+        policy = KillPolicy([first, second])
+        self.assertIs(policy.match(tx(1, elapsed_time=500)), first)
+        self.assertIs(policy.match(tx(1, elapsed_time=50)), second)
+        self.assertIsNone(policy.match(tx(1, user=u"other", elapsed_time=50)))
+
+
+class TokenBucketTestCase(TestCase):
+
+    def test_burst_is_one_seconds_worth(self):
+        with patch("agentsmith.policy.monotonic", return_value=100.0):
+            policy = KillPolicy([], max_kills_per_second=3)
+            self.assertEqual([policy._take() for _ in range(4)], [True, True, True, False])
+
+    def test_tokens_refill_at_the_rate(self):
+        with patch("agentsmith.policy.monotonic") as monotonic:
+            monotonic.return_value = 100.0
+            policy = KillPolicy([], max_kills_per_second=2)
+            self.assertTrue(policy._take())
+            self.assertTrue(policy._take())
+            self.assertFalse(policy._take())
+            monotonic.return_value = 100.5
+            self.assertTrue(policy._take())
+            self.assertFalse(policy._take())
+            monotonic.return_value = 110.0
+            self.assertEqual([policy._take() for _ in range(3)], [True, True, False])
+
+    def test_slow_rate_still_allows_one_kill(self):
+        with patch("agentsmith.policy.monotonic") as monotonic:
+            monotonic.return_value = 100.0
+            policy = KillPolicy([], max_kills_per_second=0.5)
+            self.assertFalse(policy._take())
+            monotonic.return_value = 102.0
+            self.assertTrue(policy._take())
+            self.assertFalse(policy._take())
+
+
+class EvaluationTestCase(TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.monitor = FakeMonitor()
+        self.rule = Rule(u"slow", {u"elapsed_time_ms": {u">": 100}})
+
+    def policy(self, **kwargs):
+        return KillPolicy([self.rule], audit=AuditLog(self.stream), **kwargs)
+
+    def actions(self):
+        return [(entry[u"action"], entry[u"transaction_id"])
+                for entry in map(loads, self.stream.getvalue().splitlines())]
+
+    def test_matches_are_killed_together(self):
+        policy = self.policy()
+        data = FakeData([tx(1, u"query-1"), tx(2, u"query-2"), tx(3, u"query-3", elapsed_time=5)])
+        policy.evaluate(self.monitor, data)
+        self.assertEqual([[t.id for t in batch] for batch in self.monitor.killed], [[1, 2]])
+        self.assertEqual(self.actions(), [(u"kill-requested", 1), (u"kill-requested", 2)])
+
+    def test_each_query_is_handled_once(self):
+        policy = self.policy()
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        self.assertEqual(len(self.monitor.killed), 1)
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-2")]))
+        self.assertEqual(len(self.monitor.killed), 2)
+
+    def test_handled_queries_are_forgotten_once_gone(self):
+        policy = self.policy()
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        policy.evaluate(self.monitor, FakeData([]))
+        self.assertEqual(policy._handled[self.monitor.address], set())
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        self.assertEqual(len(self.monitor.killed), 2)
+
+    def test_transactions_without_a_query_are_skipped(self):
+        policy = self.policy()
+        policy.evaluate(self.monitor, FakeData([tx(1, None)]))
+        self.assertEqual(self.monitor.killed, [])
+        self.assertEqual(self.actions(), [])
+
+    def test_dry_run(self):
+        policy = self.policy(dry_run=True)
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        self.assertEqual(self.monitor.killed, [])
+        self.assertEqual(self.actions(), [(u"dry-run", 1)])
+
+    def test_rate_limited_matches_are_logged_once_and_retried(self):
+        with patch("agentsmith.policy.monotonic") as monotonic:
+            monotonic.return_value = 100.0
+            policy = self.policy(max_kills_per_second=1)
+            data = FakeData([tx(1, u"query-1"), tx(2, u"query-2")])
+            policy.evaluate(self.monitor, data)
+            policy.evaluate(self.monitor, data)
+            self.assertEqual(self.actions(), [(u"kill-requested", 1), (u"rate-limited", 2)])
+            monotonic.return_value = 101.0
+            policy.evaluate(self.monitor, data)
+            self.assertEqual(self.actions()[-1], (u"kill-requested", 2))
+            self.assertEqual(policy._limited[self.monitor.address], set())
+            self.assertEqual([[t.id for t in batch] for batch in self.monitor.killed], [[1], [2]])
+
+    def test_outcomes_are_logged(self):
+        policy = self.policy()
+        policy.evaluate(self.monitor, FakeData([tx(n, u"query-%d" % n) for n in range(1, 5)]))
+        self.monitor.report([
+            KillResult(1, u"query-1", KILLED, u"Query found"),
+            KillResult(2, u"query-2", NOT_FOUND, u"No query found with this id"),
+            KillResult(3, u"query-3", QUERY_CHANGED, u"Transaction has moved on to query-9"),
+            KillResult(4, u"query-4", FAILED, u"Connection lost"),
+            KillResult(5, u"query-5", KILLED, u"Query found"),
+        ])
+        entries = list(map(loads, self.stream.getvalue().splitlines()))[4:]
+        self.assertEqual([(entry[u"action"], entry[u"transaction_id"], entry[u"rule"]) for entry in entries], [
+            (u"killed", 1, u"slow"),
+            (u"not-found", 2, u"slow"),
+            (u"query-changed", 3, u"slow"),
+            (u"failed", 4, u"slow"),
+        ])
+        self.assertEqual(entries[3][u"message"], u"Connection lost")
+        self.assertEqual(policy._requested[self.monitor.address], {})
+
+    def test_kill_handler_is_attached_once_per_monitor(self):
+        policy = self.policy()
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-1")]))
+        policy.evaluate(self.monitor, FakeData([tx(1, u"query-2")]))
+        self.assertEqual(len(self.monitor.kill_handlers), 1)